@@ -0,0 +1,112 @@
+"""
+Measures the service's throughput and latency under concurrent load, with the S3 writes made inline on the event loop,
+on the storage executor, and queued in write-behind mode, where requests are answered before their writes are made,
+with and without the writes synced to a local spool first. Requests go straight to the app in-process, and the writes go to a local HTTP server
+that takes --s3-latency seconds to answer each PUT, standing in for S3.
+
+Requests arrive at a fixed --rate whether or not earlier ones have finished, as they would from many clients, and
+each request's latency is measured from when it was due to arrive. That way time spent queued behind a blocked event
+loop is counted.
+
+> python benchmarks/bench_async_storage.py --requests 400 --rate 100
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+import main  # noqa: E402
+from clients import reset_clients  # noqa: E402
+from spool import Spool  # noqa: E402
+from storage import WriteBehindQueue  # noqa: E402
+
+payload = {"id": 1, "person": {"first_name": "Shirley", "last_name": "Anne"}, "address": {"zip_code": 12345}}
+
+
+class SlowPutHandler(BaseHTTPRequestHandler):
+    """
+    Accepts any PUT after a fixed delay, and keeps the connection open
+    """
+    protocol_version = "HTTP/1.1"
+    latency = 0.02
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("ETag", '"0"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+async def run_load(count: int, rate: float):
+    """
+    Posts count requests to the app, starting rate of them each second
+
+    :return:
+        float: the total time taken in seconds
+        list: the latency of each request in seconds, from when it was due to start
+    """
+    latencies = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send(due: float):
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            response = await client.post("/", json=payload)
+            latencies.append(time.perf_counter() - due)
+            assert response.status_code in (200, 202), response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*[send(start + i / rate) for i in range(count)])
+        return time.perf_counter() - start, latencies
+
+
+def report(name: str, elapsed: float, latencies: list):
+    latencies = sorted(latencies)
+    print("%-12s %8.1f req/s   p50 %7.1f ms   p99 %7.1f ms" % (
+        name, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares inline and executor S3 writes under concurrent load")
+    parser.add_argument("--requests", type=int, default=400, help="the number of requests for each mode")
+    parser.add_argument("--rate", type=float, default=100, help="the number of requests started each second")
+    parser.add_argument("--s3-latency", type=float, default=0.02, help="seconds the stand-in S3 takes per PUT")
+    args = parser.parse_args()
+
+    # dummy credentials, so no real AWS configuration is read or needed
+    os.environ.update(AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench", AWS_DEFAULT_REGION="us-east-1")
+    SlowPutHandler.latency = args.s3_latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowPutHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    main.s3_endpoint_url = "http://127.0.0.1:" + str(server.server_address[1])
+    reset_clients()
+
+    workers = main.storage_workers
+    executor = ThreadPoolExecutor(workers)
+    write_queue = WriteBehindQueue(workers=main.write_behind_workers)
+    spool_path = tempfile.mkdtemp()
+    spool = Spool(spool_path, main.spool_segment_bytes, main.spool_sync_delay)
+    # storage_workers is 0 for the inline mode, so that the requests don't start an executor of their own
+    for name, main.storage_workers, main.executor, main.write_queue, main.spool in [
+            ("inline", 0, None, None, None), ("executor", workers, executor, None, None),
+            ("write-behind", workers, executor, write_queue, None), ("spooled", workers, executor, write_queue, spool)]:
+        asyncio.run(run_load(10, 10))  # warm up the client and its connections
+        report(name, *asyncio.run(run_load(args.requests, args.rate)))
+    write_queue.close()
+    spool.close()
+    shutil.rmtree(spool_path)
+    server.shutdown()
@@ -0,0 +1,75 @@
+"""
+Compares the cost of decoding and encoding payloads of different sizes with each JSON codec. Decoding is timed from
+the bytes of a request body, as the service receives them, and encoding from the dict back to text, as the parsed
+results are written.
+
+The payloads come from test/generate_payloads.py with the "realistic" shape, scaled up by their fanout, and one case
+holds integers wider than 64 bits, which the orjson codec hands to the json module.
+
+> python benchmarks/bench_codec.py
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "python"))
+sys.path.insert(0, os.path.join(root, "test"))
+import codec  # noqa: E402
+import generate_payloads  # noqa: E402
+
+
+def payload_cases():
+    """
+    :return: list: (name, payload) for each payload size
+    """
+    cases = []
+    for fanout in [4, 12, 40, 120]:
+        settings = dict(generate_payloads.presets["realistic"], fanout=fanout)
+        payload = generate_payloads.generate_payload(0, 0, **settings)
+        cases.append(("fanout=%d" % fanout, payload))
+    cases.append(("big_ints", {"ids": [2 ** 64 + i for i in range(200)], "first_name": "Shirley"}))
+    return cases
+
+
+def time_call(call, min_time: float):
+    """
+    :return: float: the median time of one call in microseconds, over at least min_time seconds of calls
+    """
+    call()
+    timings = []
+    started = time.perf_counter()
+    while True:
+        start = time.perf_counter()
+        call()
+        end = time.perf_counter()
+        timings.append(end - start)
+        if end - started >= min_time and len(timings) >= 10:
+            break
+    timings.sort()
+    return timings[len(timings) // 2] * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times decoding and encoding with each JSON codec")
+    parser.add_argument("--min-time", type=float, default=0.3, help="the least time in seconds to time each case for")
+    args = parser.parse_args()
+
+    names = [name for name in codec.codecs if name != "orjson" or codec.orjson is not None]
+    if len(names) < len(codec.codecs):
+        print("orjson isn't installed, so only the json module is timed\n")
+
+    print("%-14s %10s" % ("payload", "bytes") + "".join(" %16s %16s" % (name + " decode", name + " encode")
+                                                        for name in names))
+    for case, payload in payload_cases():
+        body = json.dumps(payload).encode("utf-8")
+        row = "%-14s %10d" % (case, len(body))
+        for name in names:
+            chosen = codec.get_codec(name)
+            assert chosen.loads(body) == json.loads(body) and chosen.dumps(payload) == json.dumps(payload)
+            decode = time_call(lambda: chosen.loads(body), args.min_time)
+            encode = time_call(lambda: chosen.dumps(payload), args.min_time)
+            row += " %13.1f us %13.1f us" % (decode, encode)
+        print(row)
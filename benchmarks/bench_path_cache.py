@@ -0,0 +1,70 @@
+"""
+Measures whether the path cache pays off, by timing the field search over sets of generated payloads with and without
+it. Each set is searched for the plain field names and for a rule set that ignores case and separators, which costs
+more per key to walk. The cache starts empty for every timed pass over a set, so its hit rate and its cost include the
+walks that fill it, as they would for a warm service seeing the same mix of payloads.
+
+Turn the cache on (path_cache_size in main.py and process_json.py) only if it shows a win for payloads like yours.
+
+> python benchmarks/bench_path_cache.py --presets reference realistic --count 300
+"""
+import argparse
+import os
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "python"))
+sys.path.insert(0, os.path.join(root, "test"))
+import generate_payloads  # noqa: E402
+from extract import FieldMatcher, PathCache, find_fields  # noqa: E402
+
+field_names = ['zip_code', 'first_name', 'middle_name', 'last_name']
+
+
+def time_pass(search, payloads: list, repeats: int):
+    """
+    :param search: a function that makes a fresh search function for each pass, such as a walk or an empty cache
+    :return: float: the fastest pass, in microseconds per payload
+    """
+    best = None
+    for _ in range(repeats):
+        find = search()
+        start = time.perf_counter()
+        for payload in payloads:
+            find(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(payloads) * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the field search with and without the path cache")
+    parser.add_argument("--presets", nargs="*", default=["reference", "realistic", "decoy", "list_heavy"],
+                        choices=sorted(generate_payloads.presets), help="the payload presets to search")
+    parser.add_argument("--count", type=int, default=300, help="payloads in each set")
+    parser.add_argument("--seed", type=int, default=1, help="the seed for the generated payloads")
+    parser.add_argument("--cache-size", type=int, default=256, help="payload shapes the cache keeps")
+    parser.add_argument("--cache-depth", type=int, default=3, help="levels of keys in each shape fingerprint")
+    parser.add_argument("--repeats", type=int, default=5, help="timed passes over each set, keeping the fastest")
+    args = parser.parse_args()
+
+    rule_sets = [("exact", field_names),
+                 ("normalized", FieldMatcher({field: [] for field in field_names}, normalize=True))]
+    print("%-12s %-10s %10s %10s %9s %9s" % ("preset", "fields", "walk us", "cache us", "change", "hit rate"))
+    for preset in args.presets:
+        payloads = [generate_payloads.generate_payload(args.seed, index, **generate_payloads.presets[preset])
+                    for index in range(args.count)]
+        for name, fields in rule_sets:
+            walk = time_pass(lambda: lambda payload: find_fields(fields, payload), payloads, args.repeats)
+            caches = []
+
+            def fresh_cache():
+                cache = PathCache(args.cache_size, args.cache_depth)
+                caches.append(cache)
+                return lambda payload: cache.find_fields(fields, payload)
+
+            cached = time_pass(fresh_cache, payloads, args.repeats)
+            stats = caches[-1].stats()
+            print("%-12s %-10s %10.2f %10.2f %+8.1f%% %8.1f%%" % (
+                preset, name, walk, cached, (cached / walk - 1) * 100, stats["hits"] * 100.0 / len(payloads)))
@@ -0,0 +1,90 @@
+"""
+Measures how large payloads parsed on the event loop hold up the small requests arriving alongside them, against
+large payloads handed to the process pool. Requests go straight to the app in-process, and objects are kept in memory.
+
+Small requests arrive at a fixed --rate, and a large payload of --large-keys keys arrives every --large-interval
+seconds, whether or not earlier requests have finished. Each request's latency is measured from when it was due to
+arrive, so time spent queued behind a blocked event loop is counted.
+
+> python benchmarks/bench_process_pool.py --workers 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+import main  # noqa: E402
+import storage  # noqa: E402
+
+small_payload = {"id": 1, "person": {"first_name": "Shirley", "last_name": "Anne"}, "address": {"zip_code": 12345}}
+
+
+def large_payload(keys: int):
+    """
+    :return: bytes: a payload with the fields at the end, after keys nested objects
+    """
+    rows = [{"key_%d" % i: {"values": [1, 2, {"name": "x"}]}} for i in range(keys)]
+    return json.dumps({"rows": rows, "person": small_payload["person"]}).encode("utf-8")
+
+
+async def run_load(workers: int, args, large: bytes):
+    """
+    Posts the small and large requests to the app, with the process pool set to workers processes
+
+    :return: dict: "small" and "large" -> the latency of each request in seconds, from when it was due to start
+    """
+    main.process_workers = workers
+    main.process_pool = None
+    main.backend = storage.MemoryBackend()
+    await main.start_process_pool()
+    latencies = {"small": [], "large": []}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send(due: float, kind: str):
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            if kind == "small":
+                response = await client.post("/", json=small_payload)
+            else:
+                response = await client.post("/", content=large)
+            latencies[kind].append(time.perf_counter() - due)
+            assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        sends = [send(start + i / args.rate, "small") for i in range(int(args.duration * args.rate))]
+        large_count = int(args.duration / args.large_interval)
+        sends += [send(start + i * args.large_interval, "large") for i in range(large_count)]
+        await asyncio.gather(*sends)
+    if main.process_pool:
+        main.process_pool.shutdown()
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    print("%-18s %5d requests   p50 %8.1f ms   p99 %8.1f ms" % (
+        name, len(latencies), latencies[len(latencies) // 2] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares large payloads parsed on the event loop and in the process "
+                                                 "pool")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes in the pool")
+    parser.add_argument("--duration", type=float, default=3, help="seconds of load for each mode")
+    parser.add_argument("--rate", type=float, default=200, help="small requests started each second")
+    parser.add_argument("--large-interval", type=float, default=0.5, help="seconds between large payloads")
+    parser.add_argument("--large-keys", type=int, default=40000, help="nested objects in each large payload")
+    args = parser.parse_args()
+
+    large = large_payload(args.large_keys)
+    main.process_min_bytes = min(main.process_min_bytes, len(large))
+    print("Large payloads are", len(large), "bytes")
+    for name, workers in [("inline", 0), ("process pool", args.workers)]:
+        latencies = asyncio.run(run_load(workers, args, large))
+        report(name + " small", latencies["small"])
+        report(name + " large", latencies["large"])
@@ -0,0 +1,85 @@
+"""
+Compares the per-request cost of creating a new S3 client for every request against reusing the shared client from
+clients.py. Both write to a local HTTP server that accepts PUTs, so the numbers show client setup and connection
+overhead rather than S3 itself. Against real S3 the gap is larger, since each new client also opens a new TLS
+connection.
+
+> python benchmarks/bench_s3_client.py --requests 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+from clients import get_s3_client, reset_clients  # noqa: E402
+
+
+class PutHandler(BaseHTTPRequestHandler):
+    """
+    Accepts any PUT and keeps the connection open, like S3 does
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("ETag", '"0"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def time_requests(make_client, count: int, body: bytes):
+    """
+    :param make_client: called before each request to get the client to use
+    :param count: the number of requests to time
+    :param body: the object body to write
+    :return: list: the time in seconds each request took, including getting the client
+    """
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        make_client().put_object(Bucket="bench", Key="raw_data/" + str(i) + ".json", Body=body)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(name: str, timings: list):
+    timings = sorted(timings)
+    print("%-16s mean %7.2f ms   p50 %7.2f ms   p99 %7.2f ms" % (
+        name, statistics.mean(timings) * 1000, timings[len(timings) // 2] * 1000,
+        timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times S3 writes with a new client per request and a shared client")
+    parser.add_argument("--requests", type=int, default=200, help="the number of writes to time for each mode")
+    parser.add_argument("--size", type=int, default=2048, help="the size in bytes of each object")
+    args = parser.parse_args()
+
+    # dummy credentials, so no real AWS configuration is read or needed
+    os.environ.update(AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench", AWS_DEFAULT_REGION="us-east-1")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PutHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = "http://127.0.0.1:" + str(server.server_address[1])
+    body = b"x" * args.size
+
+    def new_client():
+        return boto3.client("s3", endpoint_url=endpoint)
+
+    def shared_client():
+        return get_s3_client(endpoint_url=endpoint)
+
+    reset_clients()
+    time_requests(shared_client, 5, body)  # warm up imports and the shared client
+    summarize("client/request", time_requests(new_client, args.requests, body))
+    summarize("shared client", time_requests(shared_client, args.requests, body))
+    server.shutdown()
@@ -0,0 +1,291 @@
+"""
+Times the parser and the full request path over a range of payload shapes, and writes the results to a JSON file so
+that runs can be compared.
+
+Each case reports operations per second, latency percentiles, and the peak memory allocated by one call. The parser
+cases time find_field and parse_data while varying one thing at a time from a baseline payload: its size, nesting
+depth, width, and where the fields sit (early, late, or missing). Each payload is also searched with find_fields with
+and without a traversal budget, so that the cost of the budget checks shows as the difference between the two. The request cases run lambda_handler and the
+service's update_item end to end, writing to the memory or local storage backend instead of S3. Files written by
+test/generate_payloads.py can be timed too, with --payloads.
+
+> python benchmarks/bench_suite.py --output results.json
+> python benchmarks/bench_suite.py --output new.json --baseline results.json
+> python benchmarks/bench_suite.py --payloads test/data/generated/realistic.ndjson --filter file=
+"""
+import argparse
+import asyncio
+import atexit
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "takehome", "python"))
+sys.path.insert(0, os.path.join(root, "python"))
+sys.path.insert(0, os.path.join(root, "test"))
+import generate_payloads  # noqa: E402
+import process_json  # noqa: E402
+import storage  # noqa: E402
+from extract import find_fields  # noqa: E402
+
+# the payload every parser case starts from, before one setting is changed
+baseline = {"size": 16, "depth": 3, "width": 8, "position": "late"}
+
+
+def make_payload(size: int, depth: int, width: int, position: str):
+    """
+    Builds a payload of nested dicts, with width keys at each level and depth levels below the top
+
+    :param size: the length of each filler string value
+    :param depth: the number of nested levels
+    :param width: the number of keys at each level
+    :param position: "early" puts the fields first at the top level, "late" puts them last at the deepest level, and
+        "missing" leaves them out
+    :return: dict: the payload
+    """
+    people = {"first_name": "Shirley", "middle_name": "Rivera", "last_name": "Anne", "zip_code": 12345}
+
+    def level(remaining: int):
+        node = {}
+        for i in range(width):
+            if remaining and i == width - 1:
+                node["branch_%d" % i] = level(remaining - 1)
+            else:
+                node["filler_%d" % i] = "x" * size
+        if position == "late" and not remaining:
+            node.update(people)
+        return node
+
+    payload = level(depth)
+    if position == "early":
+        payload = dict(people, **payload)
+    return payload
+
+
+def parser_cases():
+    """
+    :return: list: (name, settings) for each parser payload, varying one setting at a time from the baseline
+    """
+    variations = [("size", [16, 256, 4096]), ("depth", [1, 3, 8, 16]), ("width", [2, 8, 64]),
+                  ("position", ["early", "late", "missing"])]
+    cases = []
+    for setting, values in variations:
+        for value in values:
+            settings = dict(baseline)
+            settings[setting] = value
+            cases.append((setting + "=" + str(value), settings))
+    return cases
+
+
+def measure(call, min_time: float):
+    """
+    Calls call repeatedly for a short warm up and then at least min_time seconds, then once more with allocation tracing on
+
+    :param call: the function to time, taking no arguments
+    :param min_time: the least time in seconds to spend timing
+    :return: dict: the number of calls, operations per second, latency percentiles in microseconds, and the peak
+        memory in bytes allocated by one call
+    """
+    # warm up caches and lazy set up outside the timing
+    warm_until = time.perf_counter() + min_time / 4
+    while time.perf_counter() < warm_until:
+        call()
+    gc.collect()
+
+    timings = []
+    started = time.perf_counter()
+    while True:
+        start = time.perf_counter()
+        call()
+        end = time.perf_counter()
+        timings.append(end - start)
+        if end - started >= min_time and len(timings) >= 10:
+            break
+
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+
+    def percentile(p):
+        return round(timings[min(len(timings) - 1, int(len(timings) * p / 100))] * 1e6, 2)
+
+    return {"calls": len(timings), "ops_per_sec": round(len(timings) / sum(timings), 1),
+            "p50_us": percentile(50), "p90_us": percentile(90), "p99_us": percentile(99),
+            "max_us": round(timings[-1] * 1e6, 2), "peak_bytes": peak}
+
+
+def run_parser_cases(min_time: float, selected):
+    results = []
+    for name, settings in parser_cases():
+        payload = make_payload(**settings)
+        encoded = len(json.dumps(payload))
+        calls = [("find_field", lambda: process_json.find_field("first_name", payload)),
+                 ("parse_data", lambda: process_json.parse_data(payload)),
+                 ("find_fields", lambda: find_fields(process_json.field_names, payload)),
+                 ("find_fields_budgeted",
+                  lambda: find_fields(process_json.field_names, payload, process_json.traversal_budget))]
+        for function, call in calls:
+            case = function + "/" + name
+            if selected(case):
+                result = {"case": case, "payload_bytes": encoded}
+                result.update(settings)
+                result.update(measure(call, min_time))
+                results.append(result)
+    return results
+
+
+def run_file_cases(min_time: float, selected, paths: list):
+    """
+    Times parse_data over the payloads in each file or directory, taking the next payload on each call. Payloads the
+    json module can't decode, such as very deep ones, are counted and left out.
+    """
+    results = []
+    for path in paths:
+        case = "parse_data/file=" + os.path.basename(os.path.normpath(path))
+        if not selected(case):
+            continue
+        payloads = []
+        skipped = 0
+        total_bytes = 0
+        for raw in generate_payloads.read_payloads(path):
+            try:
+                payloads.append(json.loads(raw))
+                total_bytes += len(raw)
+            except (ValueError, RecursionError):
+                skipped += 1
+        if not payloads:
+            print("No payloads could be decoded from " + path)
+            continue
+        turn = iter(range(sys.maxsize))
+
+        def call():
+            process_json.parse_data(payloads[next(turn) % len(payloads)])
+
+        result = {"case": case, "payloads": len(payloads), "skipped": skipped,
+                  "payload_bytes": total_bytes // len(payloads)}
+        result.update(measure(call, min_time))
+        results.append(result)
+    return results
+
+
+def open_stand_in(kind: str):
+    """
+    :param kind: "memory" or "local"
+    :return: StorageBackend: a fresh backend to stand in for S3. A local backend writes to a temp directory that is
+        removed when the process exits
+    """
+    if kind == "memory":
+        return storage.MemoryBackend()
+    directory = tempfile.mkdtemp(prefix="bench-")
+    atexit.register(shutil.rmtree, directory, True)
+    return storage.LocalBackend(directory)
+
+
+def run_request_cases(min_time: float, selected, storage_kind: str):
+    import httpx
+    import main  # the service needs fastapi, so it's only imported when its cases run
+
+    logging.disable(logging.INFO)  # the handlers log every write, which would be timed too
+
+    main.path_cache = None
+    results = []
+    for position in ["late", "missing"]:
+        settings = dict(baseline, position=position)
+        payload = make_payload(**settings)
+        body = json.dumps(payload)
+
+        case = "lambda_handler/position=" + position
+        if selected(case):
+            process_json.backend = open_stand_in(storage_kind)
+            result = {"case": case, "payload_bytes": len(body), "storage": storage_kind}
+            result.update(settings)
+            emit_metrics = process_json.emit_metrics
+            process_json.emit_metrics = False  # each invocation would print its EMF line, which would be timed too
+            try:
+                result.update(measure(lambda: process_json.lambda_handler(payload, None), min_time))
+            finally:
+                process_json.emit_metrics = emit_metrics
+            results.append(result)
+
+        case = "update_item/position=" + position
+        if selected(case):
+            main.backend = open_stand_in(storage_kind)
+            loop = asyncio.new_event_loop()
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench")
+
+            def post():
+                response = loop.run_until_complete(client.post("/", content=body))
+                assert response.status_code in (200, 400), response.text
+
+            result = {"case": case, "payload_bytes": len(body), "storage": storage_kind}
+            result.update(settings)
+            result.update(measure(post, min_time))
+            results.append(result)
+            loop.run_until_complete(client.aclose())
+            loop.close()
+    return results
+
+
+def compare(results: list, baseline_file: str):
+    """
+    Prints the change in operations per second and p99 latency against an earlier run, for the cases in both
+    """
+    with open(baseline_file) as f:
+        earlier = {result["case"]: result for result in json.load(f)["results"]}
+    print("\n%-40s %12s %12s" % ("change against " + os.path.basename(baseline_file), "ops/sec", "p99"))
+    for result in results:
+        before = earlier.get(result["case"])
+        if before:
+            print("%-40s %+11.1f%% %+11.1f%%" % (
+                result["case"], (result["ops_per_sec"] / before["ops_per_sec"] - 1) * 100,
+                (result["p99_us"] / before["p99_us"] - 1) * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the parser and the request path")
+    parser.add_argument("--output", default="benchmark_results.json", help="the file to write the results to")
+    parser.add_argument("--baseline", help="an earlier results file to compare against")
+    parser.add_argument("--min-time", type=float, default=0.5, help="the least time in seconds to time each case for")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--storage", default="memory", choices=["memory", "local"],
+                        help="the backend that stands in for S3 in the request cases")
+    parser.add_argument("--skip-requests", action="store_true", help="only run the parser cases")
+    parser.add_argument("--payloads", nargs="*", default=[],
+                        help="files or directories of generated payloads to time parse_data over")
+    args = parser.parse_args()
+
+    def selected(case):
+        return args.filter in case
+
+    # the path cache would answer every repeat of a case from its first walk, so it's left out to time the walk
+    process_json.path_cache = None
+    results = run_parser_cases(args.min_time, selected)
+    results += run_file_cases(args.min_time, selected, args.payloads)
+    if not args.skip_requests:
+        results += run_request_cases(args.min_time, selected, args.storage)
+
+    print("%-40s %12s %10s %10s %10s %12s" % ("case", "ops/sec", "p50 us", "p90 us", "p99 us", "peak bytes"))
+    for result in results:
+        print("%-40s %12.1f %10.2f %10.2f %10.2f %12d" % (
+            result["case"], result["ops_per_sec"], result["p50_us"], result["p90_us"], result["p99_us"],
+            result["peak_bytes"]))
+
+    with open(args.output, "w") as f:
+        json.dump({"run_at": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+                   "platform": platform.platform(), "min_time": args.min_time, "results": results}, f, indent=2)
+    print("\nResults written to " + args.output)
+
+    if args.baseline:
+        compare(results, args.baseline)
@@ -0,0 +1,48 @@
+"""
+Process-wide AWS clients. Creating a boto3 client resolves credentials and the endpoint, and every client keeps its own
+connection pool, so a client per request pays for both and opens a fresh TLS connection each time. Instead, the
+service creates one S3 client per process (or per Lambda container, across warm invocations) and shares it. boto3
+clients are safe to share between threads.
+"""
+import threading
+import boto3
+from botocore.config import Config
+
+_lock = threading.Lock()
+_s3_client = None
+
+
+def get_s3_client(max_pool_connections: int = 10, connect_timeout: float = 60, read_timeout: float = 60,
+                  max_attempts: int = 3, endpoint_url: str = None):
+    """
+    Returns the shared S3 client, creating it on first use. The settings only apply when the client is created
+
+    :param max_pool_connections: the number of HTTP connections kept open for reuse. This should be at least the
+        number of threads writing at once
+    :param connect_timeout: seconds to wait for a new connection
+    :param read_timeout: seconds to wait for a response
+    :param max_attempts: the total attempts for a request, including retries of throttled or failed requests
+    :param endpoint_url: an alternative S3 endpoint, such as a local stand-in. None uses AWS
+    :return: the S3 client
+    """
+    global _s3_client
+    client = _s3_client
+    if client is None:
+        with _lock:
+            if _s3_client is None:
+                config = Config(max_pool_connections=max_pool_connections,
+                                connect_timeout=connect_timeout,
+                                read_timeout=read_timeout,
+                                retries={'max_attempts': max_attempts, 'mode': 'standard'})
+                _s3_client = boto3.client('s3', config=config, endpoint_url=endpoint_url)
+            client = _s3_client
+    return client
+
+
+def reset_clients():
+    """
+    Drops the shared clients, so the next call creates new ones with the current settings
+    """
+    global _s3_client
+    with _lock:
+        _s3_client = None
@@ -0,0 +1,98 @@
+"""
+JSON encoding and decoding for the ingest service and the Lambda, behind one interface so that a faster native
+decoder can be used where it's installed.
+
+Whichever codec is chosen, the results match the json module exactly. orjson decodes several times faster, but it
+differs from the json module in a few corners: it reads integers wider than 64 bits as floats, and it rejects NaN,
+Infinity, out of range floats, lone surrogates and byte order marks, all of which the json module accepts. The orjson
+codec hands any such input to the json module instead, so decoding gives the same values, and the same errors, as
+the json module.
+
+Encoding always uses the json module, whichever codec is chosen. orjson's output is compact, doesn't escape non-ASCII
+characters and writes some floats differently, and none of its options change that, so it can't write the same bytes.
+The orjson codec therefore only speeds up decoding, and the stages that encode records take as long with either codec.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # only needed for the orjson codec
+    orjson = None
+
+# a run of digits long enough that it may be an integer wider than 64 bits, which orjson would read as a float. The
+# text is translated so that every digit reads as 0 and then searched for the run, which is several times faster than
+# a regular expression. It's translated a window at a time, so a large payload is never copied in full
+_long_number = b"0" * 19
+_digits_as_zero = bytes.maketrans(b"123456789", b"000000000")
+_scan_window = 64 * 1024
+
+
+def _has_long_number(data):
+    """
+    :param data: the JSON text, as str, bytes or bytearray
+    :return: bool: whether the text holds a run of digits as long as _long_number
+    """
+    overlap = len(_long_number) - 1  # so that a run split across two windows is still found
+    for start in range(0, max(len(data) - overlap, 1), _scan_window):
+        window = data[start:start + _scan_window + overlap]
+        if isinstance(window, str):
+            window = window.encode("utf-8", "surrogatepass")
+        if _long_number in window.translate(_digits_as_zero):
+            return True
+    return False
+
+
+class StdlibCodec:
+    """
+    Decodes and encodes with the json module
+    """
+    name = "stdlib"
+
+    def loads(self, data):
+        """
+        :param data: the JSON text, as str, bytes or bytearray
+        :return: the decoded value
+        :raises ValueError: if the text isn't valid JSON
+        """
+        return json.loads(data)
+
+    def dumps(self, value):
+        """
+        :param value: the value to encode
+        :return: str: the JSON text, exactly as json.dumps writes it
+        """
+        return json.dumps(value)
+
+
+class OrjsonCodec(StdlibCodec):
+    """
+    Decodes with orjson, falling back to the json module for anything orjson would decode differently or reject
+    """
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("The orjson codec requires the orjson package")
+
+    def loads(self, data):
+        if not _has_long_number(data):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(data)
+
+
+codecs = {"stdlib": StdlibCodec, "orjson": OrjsonCodec}
+
+
+def get_codec(name: str = "auto"):
+    """
+    :param name: "stdlib", "orjson", or "auto" to use orjson when it's installed and the json module otherwise
+    :return: the codec
+    """
+    if name == "auto":
+        name = "orjson" if orjson is not None else "stdlib"
+    if name not in codecs:
+        raise ValueError("Unknown JSON codec " + repr(name) + ", expected auto or one of " + ", ".join(codecs))
+    return codecs[name]()
@@ -0,0 +1,183 @@
+"""
+Compression for the raw JSON archive. Objects can be compressed with gzip, or with zstd when the zstandard package is
+installed, optionally with a dictionary trained on sample payloads, which gives much better ratios on small records.
+
+Compressed objects are given a .gz or .zst extension and a matching Content-Encoding, and decompress() recognises
+both formats from their first bytes, so readers don't need to know how an object was written. Plain JSON can't start
+with either format's magic bytes, so uncompressed objects are returned as they are.
+
+Dictionaries are trained from sample payloads on the command line, and the file is then given to both the writer and
+any reader through the raw_compression_dictionary setting:
+> python compression.py train ../test/data/generated/realistic.ndjson --output raw.dict
+> python compression.py cat output/raw_data/processed/2020/10/01/batch.json.zst --dictionary raw.dict
+"""
+import argparse
+import gzip
+import sys
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # only needed for zstd compression
+    zstandard = None
+
+gzip_magic = b"\x1f\x8b"
+zstd_magic = b"\x28\xb5\x2f\xfd"
+
+chunk_size = 1024 * 1024 # bytes read at a time when compressing a file object
+
+
+class GzipCompressor:
+    """
+    Compresses objects with gzip
+    """
+    encoding = "gzip"
+    extension = ".gz"
+
+    def __init__(self, level: int = 6):
+        """
+        :param level: the compression level, from 1 (fastest) to 9 (smallest)
+        """
+        self.level = level
+
+    def compressobj(self):
+        # wbits 31 writes a gzip header, with no timestamp, so the same input always gives the same bytes
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def compress(self, body):
+        """
+        :param body: the object body, as a str, bytes or binary file object. A file object is read in chunks
+        :return: bytes: the compressed body
+        """
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        compressor = self.compressobj()
+        if not hasattr(body, "read"):
+            return compressor.compress(body) + compressor.flush()
+        parts = []
+        for chunk in iter(lambda: body.read(chunk_size), b""):
+            parts.append(compressor.compress(chunk))
+        parts.append(compressor.flush())
+        return b"".join(parts)
+
+
+class ZstdCompressor(GzipCompressor):
+    """
+    Compresses objects with zstd, optionally with a trained dictionary
+    """
+    encoding = "zstd"
+    extension = ".zst"
+
+    def __init__(self, level: int = 6, dictionary: bytes = None):
+        """
+        :param level: the compression level, from 1 (fastest) to 22 (smallest)
+        :param dictionary: a dictionary trained with train_dictionary, or None to compress without one
+        """
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        super().__init__(level)
+        self.dictionary = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+
+    def compressobj(self):
+        # a ZstdCompressor can't be shared between threads, so a new one is made for each object
+        return zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary).compressobj()
+
+
+def get_compressor(name: str, level: int = 6, dictionary_path: str = None):
+    """
+    :param name: "none", "gzip" or "zstd"
+    :param level: the compression level
+    :param dictionary_path: for zstd, a dictionary file written by train_dictionary, or None
+    :return: the compressor, or None for "none"
+    """
+    if name == "none":
+        return None
+    if name == "gzip":
+        return GzipCompressor(level)
+    if name == "zstd":
+        return ZstdCompressor(level, load_dictionary(dictionary_path))
+    raise ValueError("Unknown compression " + repr(name) + ", expected none, gzip or zstd")
+
+
+def load_dictionary(path: str):
+    """
+    :param path: a dictionary file, or None
+    :return: bytes: the dictionary, or None if there's no path
+    """
+    if not path:
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def decompress(data: bytes, dictionary: bytes = None):
+    """
+    Decompresses an object written with any of the compressors, telling the format from its first bytes
+
+    :param data: the object body as stored
+    :param dictionary: the dictionary the object was compressed with, if any
+    :return: bytes: the decompressed body. Data that isn't compressed is returned unchanged
+    """
+    if data.startswith(gzip_magic):
+        return gzip.decompress(data)
+    if data.startswith(zstd_magic):
+        if zstandard is None:
+            raise RuntimeError("Reading zstd compressed objects requires the zstandard package")
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompressobj().decompress(data)
+    return data
+
+
+def train_dictionary(samples: list, size: int = 112640):
+    """
+    Trains a zstd dictionary on sample payloads. The samples should look like the records being archived, and a few
+    thousand of them give a good dictionary
+
+    :param samples: the sample payloads, as bytes
+    :param size: the largest size of the dictionary in bytes
+    :return: bytes: the dictionary
+    """
+    if zstandard is None:
+        raise RuntimeError("Training a dictionary requires the zstandard package")
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def read_samples(paths: list):
+    """
+    :param paths: .json files, .ndjson files with a payload per line, or .gz or .zst archives of either
+    :return: list: each payload as bytes
+    """
+    samples = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = decompress(f.read())
+        if ".ndjson" in path:
+            samples.extend(line for line in data.splitlines() if line.strip())
+        else:
+            samples.append(data)
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trains zstd dictionaries and reads compressed archive objects")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train = commands.add_parser("train", help="train a dictionary on sample payloads")
+    train.add_argument("samples", nargs="+", help=".json or .ndjson files of sample payloads")
+    train.add_argument("--output", required=True, help="the dictionary file to write")
+    train.add_argument("--size", type=int, default=112640, help="the largest size of the dictionary in bytes")
+    cat = commands.add_parser("cat", help="print archive objects, decompressing them")
+    cat.add_argument("files", nargs="+", help="the objects to print")
+    cat.add_argument("--dictionary", help="the dictionary the objects were compressed with")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        samples = read_samples(args.samples)
+        dictionary = train_dictionary(samples, args.size)
+        with open(args.output, "wb") as out:
+            out.write(dictionary)
+        print("Trained a", len(dictionary), "byte dictionary on", len(samples), "samples, written to", args.output)
+    else:
+        dictionary = load_dictionary(args.dictionary)
+        for name in args.files:
+            with open(name, "rb") as f:
+                sys.stdout.buffer.write(decompress(f.read(), dictionary))
@@ -3,12 +3,31 @@
 # JSON structure is unknown
 # Data needs to be partitioned for Glue/Athena
 
-import json
-import boto3
+import asyncio
+import collections
+import contextlib
+import functools
 import logging
 import datetime
+import multiprocessing
+import struct
+import tempfile
+import time
 import uuid
-from fastapi import FastAPI, Response, status
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from clients import get_s3_client
+from codec import get_codec
+from compression import get_compressor
+from dedup import Deduplicator, digest_record_id, payload_digest
+from extract import (BudgetExceeded, field_list_names, find_fields, find_records, PathCache, RuleFile,
+                     StreamingExtractor, SyntaxChecker, TraversalBudget)
+from fastapi import FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from metrics import RequestMetrics, ServiceMetrics, time_stage
+from partitions import partition_format, shard_directory, time_ordered_id
+from spool import Spool
+from storage import BatchWriter, ParquetEncoder, StorageBackend, WriteBehindQueue, open_backend
 
 
 ## ---- Configuration Variables ---- ##
@@ -17,75 +36,510 @@ output_folder = "parsed_data" # The folder where the parsed results will be save
 
 json_folder = "raw_data" # The folder where the raw JSON will get saved. All valid JSON input is stored here
 field_names = ['zip_code','first_name', 'middle_name', 'last_name'] # the fields to extract in the parsed results
+field_rules_path = None # a JSON rule set of the fields to extract, with aliases and case-insensitive matching, used in place of field_names (see extract.load_rules)
+field_rules_check_interval = 5.0 # seconds between checks for changes to the field_rules_path file, which is reloaded without a restart
+
+extract_records = False # find every record in a payload, such as each person in a list of people, and write a parsed row for each. Streamed bodies are decoded instead while it's on
+record_min_fields = 2 # with extract_records, the number of fields an object must hold directly to count as a record
+payload_id_key = 'payload_id' # with extract_records, the key in each parsed row for the ID of the payload it came from, which its raw data is stored under
+
+budget_max_depth = None # the deepest nesting of objects searched in a payload. None, the default, only stops payloads nested too deeply for the decoder (about 1000 levels for the json module), since the search itself has no depth limit of its own. A payload over any of the budgets is archived in unprocessed/ without being searched
+budget_max_nodes = 1000000 # the most object keys and list items searched in one payload
+budget_max_bytes = 16 * 1024 * 1024 # the largest payload searched, in bytes. For a batch, this applies to each NDJSON line
+
+path_cache_size = 0 # the number of payload shapes to remember field paths for. 0, the default, disables the cache, which only pays off for some payloads and rule sets (see benchmarks/bench_path_cache.py)
+path_cache_depth = 3 # the number of nested levels of keys used to recognise a payload shape
+
+partition_style = "date" # "date" writes YYYY/MM/DD paths; "hive" writes year=YYYY/month=MM/day=DD, which Glue and Athena read as partition columns
+partition_by_hour = False # add an hour level below the day in the output paths
+key_shards = 0 # spread the objects in each date partition over this many hash-sharded prefixes below it, such as parsed_data/2020/10/01/07/, to get past S3's request rate limit per prefix. 0 writes them straight under the date. The Athena table needs the shard column too (python partitions.py --shards)
+
+s3_pool_connections = 25 # HTTP connections the shared S3 client keeps open for reuse across requests
+s3_connect_timeout = 5 # seconds to wait for a new S3 connection
+s3_read_timeout = 30 # seconds to wait for an S3 response
+s3_max_attempts = 3 # attempts per S3 request, including retries
+s3_endpoint_url = None # an alternative S3 endpoint, such as a local stand-in. None uses AWS
+
+storage_backend = "s3" # where objects are stored: "s3" writes to bucket_name, "local" to a directory, and "memory" keeps them in memory for tests and benchmarks
+local_storage_path = "output" # with the local storage_backend, the directory to store objects in, laid out like the bucket
+storage_workers = 25 # threads that write to storage off the event loop, at most s3_pool_connections. 0 writes inline, blocking the loop
+
+process_workers = 0 # processes that decode and search large payloads, so that one big body doesn't hold up every other request on the event loop. 0 handles every payload on the loop
+process_min_bytes = 256 * 1024 # payloads of at least this many bytes go to the process pool; smaller ones cost less to handle inline than to send over
+process_max_pending = 64 # the most payloads queued for or being parsed in the process pool. Past that, requests wait for a slot without blocking the loop
+
+streaming_extraction = False # pull the fields out of the request body as it arrives, rather than parsing it into a dict first. The whole body is still checked for valid JSON before it's stored. Bodies are decoded instead while extract_records or deduplicate is on
+spool_memory_limit = 1024 * 1024 # bytes of a streamed request body held in memory before it is spooled to a temp file
+
+ndjson_types = ('application/x-ndjson', 'application/ndjson', 'application/jsonl') # batch content types read one record per line
+batch_in_flight = 32 # in direct write_mode, the most records of a /batch request with writes in flight at once. Results are still reported in order
+
+write_mode = "direct" # "direct" writes one object per record; "batched" packs the records for each partition into one object per flush
+batch_max_records = 500 # in batched write_mode, the number of records that triggers a flush
+batch_max_bytes = 8 * 1024 * 1024 # in batched write_mode, the buffered size in bytes that triggers a flush
+batch_max_latency = 1.0 # in batched write_mode, the longest time in seconds a record waits before its buffer is flushed. A POST to / is only answered once its record is stored, so a request that doesn't fill a buffer can take up to this long
+
+write_behind = False # answer a record with 202 as soon as it's parsed and its writes are queued, rather than once they're stored. Only with the direct write_mode and json output_format
+write_behind_max_writes = 10000 # the most writes queued at once. Past this, requests get a 429 until the queue drains
+write_behind_max_bytes = 256 * 1024 * 1024 # the most bytes of writes queued at once. Past this, requests get a 429 until the queue drains
+write_behind_max_lag = 30.0 # once the oldest queued write has waited this many seconds, storage is taken to be unavailable and requests get a 503 until it catches up
+write_behind_workers = 25 # threads that drain the queue to storage, at most s3_pool_connections
+write_behind_max_attempts = 5 # attempts per queued write, including retries, on top of the S3 client's own
+write_behind_retry_delay = 0.5 # seconds before the first retry of a queued write, doubling for each retry after it
+spool_path = None # in write-behind mode, a directory for a crash-safe spool of the queued writes. Each write is synced to disk there before the request is answered, and any not stored before a restart are made on the next start. The workers of the service can share it, as each spools to a subdirectory of its own, and a worker that starts takes over the writes left by any that have stopped. None keeps queued writes only in memory
+spool_segment_bytes = 64 * 1024 * 1024 # the size of each spool segment file, which is deleted once every write in it is stored
+spool_sync_delay = 0.002 # seconds the spool waits after a write for others to sync to disk with it
+
+output_format = "json" # "json" writes parsed records as JSON; "parquet" writes them as batched, compressed Parquet files (needs pyarrow)
+parquet_compression = "snappy" # the compression codec for Parquet output
+
+raw_compression = "none" # compress the raw JSON archive: "none", "gzip", or "zstd" (needs zstandard). Compressed objects get a .gz or .zst extension and a Content-Encoding
+raw_compression_level = 6 # the compression level: 1 to 9 for gzip, 1 to 22 for zstd
+raw_compression_dictionary = None # a zstd dictionary file trained with compression.py, for better ratios on single records. Readers need the same file
+
+deduplicate = False # store each distinct payload once: a repeat is answered with the first copy's record, and raw data is stored under the payload's hash. Payloads are hashed in their decoded form, so streaming_extraction is bypassed while it's on
+dedup_cache_size = 10000 # the number of recent payloads whose responses are kept to answer repeats with
+dedup_bloom_capacity = 10000000 # the number of payloads the Bloom filter tracks before its false positive rate rises
+dedup_false_positive_rate = 0.001 # the chance the Bloom filter takes a new payload for a repeat, which costs one storage lookup
+dedup_snapshot_path = None # a file the Bloom filter is loaded from on start and saved to on shutdown, so it survives restarts
+
+json_codec = "auto" # "stdlib", "orjson", or "auto" to use orjson when it's installed. Decoded values and encoded text always match the json module, so orjson only speeds up decoding
 
 ## -------- / Configuration ----------
 
 record_id_key = 'record_id' # identifier within the parsed results for each unique entry
 
-path_format = "%Y/%m/%d" # the dateTime format to use to create an output path to auto-partition for Athena
+path_format = partition_format(partition_style, partition_by_hour) # the dateTime format to use to create an output path to auto-partition for Athena
+
+path_cache = PathCache(path_cache_size, path_cache_depth) if path_cache_size else None # shared across requests
+
+traversal_budget = TraversalBudget(budget_max_depth, budget_max_nodes, budget_max_bytes) # the limits on searching each payload
+
+field_rules = RuleFile(field_rules_path, field_rules_check_interval) if field_rules_path else None # the compiled rule set, reloaded when its file changes
+
+codec = get_codec(json_codec) # decodes and encodes JSON for every request
+
+raw_compressor = get_compressor(raw_compression, raw_compression_level, raw_compression_dictionary) # None when the raw archive isn't compressed
+
+service_metrics = ServiceMetrics() # per-stage timings and outcome counts, served on /metrics
+
+
+
+def get_fields():
+    """
+    :return: the fields to extract: the latest compiled rule set if there's a field_rules_path, or else field_names
+    """
+    return field_rules.current() if field_rules else field_names
+
+
+def get_s3():
+    """
+    :return: the S3 client shared by every request in this process, set up with the s3_ settings above
+    """
+    return get_s3_client(s3_pool_connections, s3_connect_timeout, s3_read_timeout, s3_max_attempts, s3_endpoint_url)
+
+
+backend = None # the StorageBackend chosen by storage_backend, created on first use
+
+
+def get_backend():
+    """
+    :return: StorageBackend: the storage backend shared by every request in this process, chosen by storage_backend
+    """
+    global backend
+    if backend is None:
+        backend = open_backend(storage_backend, bucket_name, get_s3() if storage_backend == "s3" else None,
+                               local_storage_path)
+    return backend
+
+
+spool_record = struct.Struct(">BI") # the flags and key length that start each spool record, followed by the key and the body
+spool_compress = 1 # spool record flag: compress the body with raw_compressor when it's written
+spool_if_absent = 2 # spool record flag: only write the body if there's no object at the key already
+
+# these are created by start_services on first use, rather than on import, since the process pool's workers import
+# this module too
+executor = None # the ThreadPoolExecutor that writes to storage off the event loop, shared across requests
+write_queue = None # the WriteBehindQueue of the writes not yet stored in write-behind mode
+spool = None # the Spool of the queued writes, on disk
+deduplicator = None # the Deduplicator of the payloads stored so far
+
+
+def start_services():
+    """
+    Creates the storage executor, the write-behind queue and its spool, and the duplicate detector, for the settings
+    that call for them, unless they've been created already. The spool recovers the writes a previous run left in it,
+    the executor and the queue start threads, and the duplicate detector loads its snapshot, none of which a process
+    pool worker should do, so it's called as the service starts and before each request rather than on import
+    """
+    global executor, write_queue, spool, deduplicator
+    if executor is None and storage_workers:
+        executor = ThreadPoolExecutor(storage_workers, thread_name_prefix="storage-write")
+    if write_queue is None and write_behind and write_mode == "direct" and output_format == "json":
+        write_queue = WriteBehindQueue(write_behind_max_writes, write_behind_max_bytes, write_behind_workers,
+                                       write_behind_max_attempts, write_behind_retry_delay)
+    if spool is None and spool_path and write_queue:
+        spool = Spool(spool_path, spool_segment_bytes, spool_sync_delay)
+    if deduplicator is None and deduplicate:
+        deduplicator = Deduplicator(dedup_cache_size, dedup_bloom_capacity, dedup_false_positive_rate,
+                                    dedup_snapshot_path)
+
+
+process_pool = None # the ProcessPoolExecutor for large payloads, created on first use when process_workers is set
+process_slots = None # the semaphore holding the process pool's queue to process_max_pending payloads
+
+
+def get_process_pool():
+    """
+    :return: ProcessPoolExecutor: the process pool shared by every request in this process, or None if process_workers
+        is 0. The workers are spawned rather than forked, so they don't inherit the event loop or the storage threads,
+        and each imports this module with its configuration. Importing it only reads the configuration, so a worker
+        never starts the services start_services creates
+    """
+    global process_pool, process_slots
+    if process_pool is None and process_workers:
+        process_pool = ProcessPoolExecutor(process_workers, multiprocessing.get_context("spawn"))
+        process_slots = asyncio.Semaphore(process_max_pending)
+    return process_pool
+
+
+writers = {} # folder -> the BatchWriter for that folder, created on first use in batched write_mode
+
+
+def get_writer(folder: str):
+    """
+    :param folder: the folder the writer stores objects under
+    :return: BatchWriter: the shared writer for the folder
+    """
+    writer = writers.get(folder)
+    columns = field_list_names(get_fields()) + [record_id_key] + ([payload_id_key] if extract_records else [])
+    if isinstance(getattr(writer, "encoder", None), ParquetEncoder) and writer.encoder.columns != columns:
+        # the rule set was reloaded with different fields, so the old writer is closed and one made for the new columns
+        writers.pop(folder)
+        if executor:
+            executor.submit(writer.close)
+        else:
+            writer.close()
+        writer = None
+    if writer is None:
+        encoder = None
+        if folder == output_folder and output_format == "parquet":
+            encoder = ParquetEncoder(columns, parquet_compression)
+        compressor = raw_compressor if folder == json_folder else None
+        writer = writers[folder] = BatchWriter(get_backend(), folder, batch_max_records, batch_max_bytes,
+                                               batch_max_latency, encoder, compressor, key_shards, partition_style)
+    return writer
+
+
+def write_object(backend: StorageBackend, key: str, body, pending: list = None, metrics: RequestMetrics = None,
+                 stage: str = "write", compressor=None, if_absent: bool = False):
+    """
+    Writes an object to the storage backend. When there's a storage executor and a pending list, the write runs on the
+    executor so it doesn't block the event loop, and its future is appended to pending. In write-behind mode it's
+    queued on the write-behind queue instead, to be retried until it's stored. Otherwise it's written before
+    returning.
+
+    :param backend: the storage backend to write the data to
+    :param key: the key to store the object at
+    :param body: the object body, as a str, bytes or file object. A file object must stay open until the write is done
+    :param pending: the list to add the write's future to
+    :param metrics: the measurements of the request, to time the write in
+    :param stage: the name to time the write under
+    :param compressor: a compressor to compress the body with before it's written, on the executor if there is one
+    :param if_absent: only write the object if there isn't one at the key already
+    """
+    put = put_if_absent if if_absent else timed_put
+    if write_queue and pending is not None:
+        if hasattr(body, "read"):
+            # a streamed body's temp file is closed once the request is answered, and a retry needs the body again
+            body = body.read()
+        # the request is finished by the time the write is made, so it isn't timed in the request's metrics
+        write = functools.partial(put, backend, key, body, None, stage, compressor)
+        if spool:
+            # the request waits for the write to reach the spool on disk, rather than storage
+            ticket, synced = spool.append(encode_spool_record(key, body, compressor is not None, if_absent))
+            pending.append(synced)
+            queue_write(write, len(body), ticket)
+        else:
+            pending.append(queue_write(write, len(body)))
+    elif executor and pending is not None:
+        pending.append(executor.submit(put, backend, key, body, metrics, stage, compressor))
+    else:
+        put(backend, key, body, metrics, stage, compressor)
+
+
+def queue_write(write, size: int, ticket=None):
+    """
+    Queues a write on the write-behind queue, counting it in the queue depth and its lag once it's done
+
+    :param write: a function that makes the write
+    :param size: the size of the write in bytes
+    :param ticket: the spool ticket of the write, which is acknowledged once the write is stored. A write that fails is
+        left in the spool, to be made again on the next start
+    :return: Future: the queued write
+    """
+    submitted = time.perf_counter()
+    service_metrics.write_queue.inc(1)
+
+    def finished(future):
+        service_metrics.write_queue.inc(-1)
+        service_metrics.write_lag.observe(time.perf_counter() - submitted)
+        if future.exception() is not None:
+            service_metrics.write_failures.inc(1)
+        elif ticket is not None:
+            spool.ack(ticket)
+
+    future = write_queue.submit(write, size)
+    future.add_done_callback(finished)
+    return future
+
+
+def encode_spool_record(key: str, body, compress: bool, if_absent: bool):
+    """
+    :param key: the key the body is written to
+    :param body: the body, as a str or bytes
+    :param compress: whether the body is compressed with raw_compressor when it's written
+    :param if_absent: whether the body is only written if there's no object at the key already
+    :return: bytes: the write as a spool record
+    """
+    key = key.encode("utf-8")
+    flags = (spool_compress if compress else 0) | (spool_if_absent if if_absent else 0)
+    return b"".join((spool_record.pack(flags, len(key)), key, body.encode("utf-8") if isinstance(body, str) else body))
+
+
+def decode_spool_record(record: bytes):
+    """
+    :param record: a spool record from encode_spool_record
+    :return:
+        str: the key the body is written to
+        bytes: the body
+        bool: whether the body is compressed with raw_compressor when it's written
+        bool: whether the body is only written if there's no object at the key already
+    """
+    flags, key_length = spool_record.unpack_from(record)
+    body_start = spool_record.size + key_length
+    return (record[spool_record.size:body_start].decode("utf-8"), record[body_start:], bool(flags & spool_compress),
+            bool(flags & spool_if_absent))
+
+
+def write_queue_busy():
+    """
+    :return: the status code, detail and Retry-After seconds to turn work away with in write-behind mode: 503 if the
+        queue or the spool has been closed as the service shuts down, or if the oldest queued write has waited longer
+        than write_behind_max_lag, so storage is taken to be unavailable, or 429 if the queue is full. None if there's
+        room for more writes
+    """
+    if write_queue.closed() or (spool and spool.closed()):
+        return 503, "The service is shutting down, try again later", 1
+    if write_queue.lag() > write_behind_max_lag:
+        return 503, "Storage is falling behind, try again later", int(write_behind_max_lag)
+    if write_queue.full():
+        return 429, "Too many writes are queued, try again later", 1
+    return None
+
+
+def check_write_queue():
+    """
+    Applies backpressure in write-behind mode, before a request takes on any work
+
+    :raises HTTPException: 503 or 429, as write_queue_busy gives them, if the queue has no room for more writes
+    """
+    busy = write_queue_busy()
+    if busy:
+        status_code, detail, retry_after = busy
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
 
 
-def save_json(raw_data: dict, path: str, record_id: uuid.UUID, s3: boto3.client):
+def timed_put(backend: StorageBackend, key: str, body, metrics: RequestMetrics, stage: str, compressor=None):
+    if compressor:
+        with time_stage(metrics, "compress"):
+            body = compressor.compress(body)
+    with time_stage(metrics, stage):
+        backend.put(key, body, compressor.encoding if compressor else None)
+
+
+def put_if_absent(backend: StorageBackend, key: str, body, metrics: RequestMetrics, stage: str, compressor=None):
+    # only used for payloads the Bloom filter has seen, so the lookup is usually all it takes
+    with time_stage(metrics, "dedup_lookup"):
+        stored = backend.exists(key)
+    service_metrics.dedup.inc(1, "stored" if stored else "false_positive")
+    if not stored:
+        timed_put(backend, key, body, metrics, stage, compressor)
+
+
+def save_json(raw_data: dict, path: str, record_id: uuid.UUID, backend: StorageBackend, pending: list = None,
+              metrics: RequestMetrics = None, if_absent: bool = False, unchecked: bool = False):
     """
     Save the JSON data off to a file for future review
 
-    :param raw_data: a dict representing the raw JSON data
-    :param path: the path to save the data to. Data will be stored at [json_folder]/[path]/[record_id].json
+    In batched write_mode, the data is buffered as one line of a shared object instead, wrapped with its record_id so it
+    can be tied back to the parsed data. The future for the write is appended to pending, as it is for a direct write
+    made on the storage executor. Raw data that may not be valid JSON is always written as an object of its own, since
+    it could break the line it was put in.
+
+    :param raw_data: the raw request body as bytes or a file object, which is stored as it was sent, or a dict
+        representing the raw JSON data, which is encoded first
+    :param path: the path to save the data to. Data will be stored at [json_folder]/[path]/[shard]/[record_id].json,
+        with the raw_compression extension added if it's compressed. The shard level is only added with key_shards
     :param record_id: a UUID to represent this record, tied to the parsed data
-    :param s3: the S3 instance to write the data to
+    :param backend: the storage backend to write the data to
+    :param pending: the list to add the write's future to
+    :param metrics: the measurements of the request, to time the encoding and the write in
+    :param if_absent: only write the data if it isn't stored already. Batched writes are always made
+    :param unchecked: the raw data may not be valid JSON, such as a payload archived for being over the traversal budget,
+        which may not have been decoded in full
     :return the path that the data is saved to
     """
-    file_name = record_id + ".json"
-    lambda_path = json_folder + "/" + path + "/" + file_name
+    if write_mode == "batched" and not unchecked:
+        with time_stage(metrics, "serialize_raw"):
+            if isinstance(raw_data, dict):
+                raw = codec.dumps(raw_data).encode("utf-8")
+            else:
+                raw = raw_data.read() if hasattr(raw_data, "read") else raw_data
+                # raw newlines can only be whitespace in valid JSON, so they're safe to flatten onto one line
+                if b"\n" in raw or b"\r" in raw:
+                    raw = raw.replace(b"\n", b" ").replace(b"\r", b" ")
+            line = (b'{"' + record_id_key.encode("utf-8") + b'": "' + record_id.encode("utf-8") + b'", "raw": ' + raw +
+                    b'}')
+        location = get_writer(json_folder).add(path, line)
+        pending.append(location.future)
+        return location.path
+
+    file_name = record_id + ".json" + (raw_compressor.extension if raw_compressor else "")
+    lambda_path = json_folder + "/" + path + shard_directory(record_id, key_shards, partition_style) + "/" + file_name
     logging.info("Writing raw json data to " + lambda_path)
 
-    # write the json to the file
-    s3.put_object(Bucket=bucket_name,
-                  Key=lambda_path,
-                  Body=json.dumps(raw_data))
+    # write the json to the file. The raw request body is written as-is, without a copy; only a dict is encoded
+    if isinstance(raw_data, dict):
+        with time_stage(metrics, "serialize_raw"):
+            raw_data = codec.dumps(raw_data)
+    write_object(backend, lambda_path, raw_data, pending, metrics, "write_raw", raw_compressor, if_absent)
 
     return lambda_path
 
 
-def save_data(data_dict: dict, path:str, s3: boto3.client):
+def save_data(data_dict: dict, path:str, backend: StorageBackend, pending: list = None,
+              metrics: RequestMetrics = None):
     """
     Saves the provided data_dict off on S3
 
+    In batched write_mode, or with parquet output_format, the data is buffered as one record of a shared object
+    instead. Either way, the future for a buffered write or a write made on the storage executor is appended to pending.
+
     :param data_dict: a dict representing the data to save off, which must contain an entry for [record_id_key]
-    :param path: the path to save the data to. Data will be stored at [json_folder]/[path]/[record_id].json. Record ID is pulled from the data_dict
-    :param s3: the S3 instance to write the data to
+    :param path: the path to save the data to. Data will be stored at [output_folder]/[path]/[shard]/[record_id].json, where the shard level is only added with key_shards. Record ID is pulled from the data_dict
+    :param backend: the storage backend to write the data to
+    :param pending: the list to add the write's future to
+    :param metrics: the measurements of the request, to time the encoding and the write in
     :return: the path that the data is saved to
     """
+    if output_format == "parquet":
+        location = get_writer(output_folder).add(path, data_dict)
+        pending.append(location.future)
+        return location.path
+    if write_mode == "batched":
+        with time_stage(metrics, "serialize_parsed"):
+            line = codec.dumps(data_dict).encode("utf-8")
+        location = get_writer(output_folder).add(path, line)
+        pending.append(location.future)
+        return location.path
+
     file_name = data_dict[record_id_key]  + ".json"
-    full_path = output_folder + "/" + path + "/" + file_name
+    shard = shard_directory(data_dict[record_id_key], key_shards, partition_style)
+    full_path = output_folder + "/" + path + shard + "/" + file_name
     logging.info("Writing processed data to" + full_path)
     logging.debug("Writing data: " + repr(data_dict))
 
     # write the json to the file
-    s3.put_object(Bucket=bucket_name,
-                  Key=full_path,
-                  Body=json.dumps(data_dict))
+    with time_stage(metrics, "serialize_parsed"):
+        body = codec.dumps(data_dict)
+    write_object(backend, full_path, body, pending, metrics, "write_parsed")
 
     return full_path
 
 
-def parse_data(data: dict):
+def save_rows(rows: list, path: str, payload_id: str, backend: StorageBackend, pending: list = None,
+              metrics: RequestMetrics = None):
     """
-    Parses a supplied dictionary to find the fields as specified in field_names
+    Saves the parsed rows of a payload that holds many records together, so that the payload costs one write however
+    many records it holds. In batched write_mode, or with parquet output_format, the rows are buffered together so
+    they're stored in the same object. Otherwise they're written as one object of their own, with one row per line, as
+    the Lambda writes them
+
+    :param rows: the parsed rows, each of which must contain an entry for [record_id_key]
+    :param path: the path to save the rows to. In direct write_mode, they will be stored at
+        [output_folder]/[path]/[shard]/[payload_id].json, where the shard level is only added with key_shards
+    :param payload_id: the ID of the payload the rows came from
+    :param backend: the storage backend to write the data to
+    :param pending: the list to add the write futures to
+    :param metrics: the measurements of the request, to time the encoding and the writes in
+    :return: list: the path of each row, which is the object key with the row's byte offset, or its row number in a
+        Parquet file, appended as a fragment
+    """
+    if output_format == "parquet":
+        records = rows
+    else:
+        with time_stage(metrics, "serialize_parsed"):
+            records = [codec.dumps(row).encode("utf-8") for row in rows]
+    if output_format == "parquet" or write_mode == "batched":
+        locations = get_writer(output_folder).add_many(path, records)
+        pending.append(locations[0].future)
+        return [location.path for location in locations]
+
+    full_path = (output_folder + "/" + path + shard_directory(payload_id, key_shards, partition_style) + "/" +
+                 payload_id + ".json")
+    logging.info("Writing " + str(len(rows)) + " processed rows to " + full_path)
+    paths = []
+    offset = 0
+    for record in records:
+        paths.append(full_path + "#" + str(offset))
+        offset += len(record) + 1
+    write_object(backend, full_path, b"\n".join(records) + b"\n", pending, metrics, "write_parsed")
+    return paths
+
+
+def parse_data(data: dict, fields=None):
+    """
+    Parses a supplied dictionary to find the fields as specified in field_names, or in the field rule set
 
     :param data:
         the dictionary to parse
+    :param fields: the fields to search for, as a list or a compiled rule set. Defaults to get_fields()
+    :return:
+        int: a count of the number of fields found from field_names
+        dict: a dictionary containing the parsed data
+    :raises BudgetExceeded: if searching the data goes past the traversal budget
+    """
+    if fields is None:
+        fields = get_fields()
+
+    # search the data for every field in one pass, skipping the walk for payload shapes we've seen before
+    if path_cache:
+        found = path_cache.find_fields(fields, data, traversal_budget)
+    else:
+        found = find_fields(fields, data, traversal_budget)
+
+    return build_output(found, fields)
+
+
+def build_output(found: dict, fields=None):
+    """
+    Builds the parsed record from the fields found in a payload
+
+    :param found: a mapping of field name to the value found, as returned by find_fields
+    :param fields: the fields that were searched for, as a list or a compiled rule set. Defaults to get_fields()
     :return:
         int: a count of the number of fields found from field_names
         dict: a dictionary containing the parsed data
     """
+    names = field_list_names(fields if fields is not None else get_fields())
+
     # create the output data dict
-    output_dict = dict.fromkeys(field_names, "")
+    output_dict = dict.fromkeys(names, "")
     res_count = 0  # count the number of fields we find
 
-    # search the data
-    for field in field_names:
-        results = find_field(field, data)
+    for field in names:
+        results = found.get(field)
         if not results:
             results = ""
         output_dict[field] = results
@@ -93,12 +547,92 @@ def parse_data(data: dict):
             res_count += 1
 
     # generate an ID to map the raw data to
-    record_id = str(uuid.uuid4())
+    record_id = time_ordered_id()
     output_dict[record_id_key] = record_id
 
     return res_count, output_dict
 
 
+def parse_records(data: dict, fields=None):
+    """
+    Parses a supplied dictionary that may hold many records, such as a list of people, into a parsed row for each
+
+    :param data: the dictionary to parse
+    :param fields: the fields to search for, as a list or a compiled rule set. Defaults to get_fields()
+    :return:
+        int: the number of fields found across every row
+        list: the parsed rows, each with its own record ID, as build_output makes them
+    :raises BudgetExceeded: if searching the data goes past the traversal budget
+    """
+    if fields is None:
+        fields = get_fields()
+    rows = [build_output(found, fields) for found in find_records(fields, data, record_min_fields, traversal_budget)]
+    return sum(res_count for res_count, row in rows), [row for res_count, row in rows]
+
+
+def parse_payload(raw: bytes, fields, records: bool, digest: bool):
+    """
+    Decodes, hashes and parses a payload in one call, for the process pool to run. Only the raw bytes are sent to the
+    worker, which costs far less than pickling the decoded dict, and only the small parsed results are sent back
+
+    :param raw: the payload as it was sent
+    :param fields: the fields to search for, as a list or a compiled rule set
+    :param records: find every record in the payload, as parse_records does, rather than one, as parse_data does
+    :param digest: hash the payload for duplicate detection
+    :return:
+        bytes: the payload digest, or None
+        the parsed results, as parse_data or parse_records returns them
+    :raises ValueError: if the payload isn't a JSON object, with the detail to respond with
+    :raises BudgetExceeded: if the payload is over the traversal budget
+    """
+    try:
+        data = decode_payload(raw)
+    except ValueError as e:
+        # raised again as a plain ValueError, which is always pickled back intact
+        raise ValueError("Invalid JSON body: " + str(e))
+    if not isinstance(data, dict):
+        raise ValueError("The request body must be a JSON object")
+    return (digest_payload(data) if digest else None,
+            parse_records(data, fields) if records else parse_data(data, fields))
+
+
+async def parse_in_pool(raw: bytes, fields, metrics: RequestMetrics = None):
+    """
+    Parses a large payload in the process pool with parse_payload, leaving the event loop free meanwhile. At most
+    process_max_pending payloads are queued for the pool at once, and past that the request waits for a slot
+
+    :param raw: the payload as it was sent
+    :param fields: the fields to search for, as a list or a compiled rule set
+    :param metrics: the measurements of the request, to time the wait and the parsing in
+    :return:
+        bytes: the payload digest, if duplicates are being detected, or None
+        the parsed results, as parse_data or parse_records returns them
+    :raises HTTPException: 422 if the body isn't a JSON object
+    :raises BudgetExceeded: if the payload is over the traversal budget
+    """
+    global process_pool
+    pool = get_process_pool()
+    with time_stage(metrics, "process_wait"):
+        await process_slots.acquire()
+    service_metrics.process_pool.inc(1)
+    try:
+        with time_stage(metrics, "parse_data"):
+            return await asyncio.wrap_future(pool.submit(parse_payload, raw, fields, extract_records,
+                                                         deduplicator is not None))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except BrokenProcessPool:
+        # a worker died, such as by running out of memory, which breaks the pool, so it's shut down, stopping its
+        # management thread and any workers left, and a new one is made for the next request
+        if process_pool is pool:
+            process_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        service_metrics.process_pool.inc(-1)
+        process_slots.release()
+
+
 def find_field(field_name: str, data: dict):
     """
     Recursively searches the provided data dict to find the given field name. Returns the first instance found
@@ -108,52 +642,688 @@ def find_field(field_name: str, data: dict):
     :return:
         str: the resulting value, or None if not found
     """
-    if isinstance(data, dict): # if the data supplied is iterable, iterate on it
-        for k,v in data.items():
-            if k == field_name: # if we've found our key, return the value
-                if isinstance(v, list):
-                    return v[0]
-                else:
-                    return v
-            if isinstance(v, dict): # if our value is another dict, recurse, and return the recursion results
-                result = find_field(field_name, v)
-                if result:
-                    return result
+    return find_fields([field_name], data).get(field_name)
+
+
+async def read_body(request: Request, metrics: RequestMetrics = None, offload: bool = False):
+    """
+    Reads the whole request body and decodes it
 
+    :param request: the incoming request
+    :param metrics: the measurements of the request, to time the read and the decoding in
+    :param offload: leave a body of process_min_bytes or more undecoded, for the process pool to handle
+    :return:
+        bytes: the body as it was sent, to be archived as-is
+        dict: the decoded body, the BudgetExceeded raised if it's over the traversal budget, in which case it isn't
+        decoded past that point, or None if it's left for the process pool
+    :raises HTTPException: 422 if the body isn't a JSON object
+    """
+    with time_stage(metrics, "receive"):
+        raw = await request.body()
+    if metrics:
+        metrics.payload_bytes = len(raw)
+    try:
+        traversal_budget.check_bytes(len(raw))
+        if offload and len(raw) >= process_min_bytes:
+            return raw, None
+        with time_stage(metrics, "decode"):
+            data = decode_payload(raw)
+    except BudgetExceeded as e:
+        return raw, e
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail="Invalid JSON body: " + str(e))
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=422, detail="The request body must be a JSON object")
+    return raw, data
+
+
+async def stream_body(request: Request, metrics: RequestMetrics = None, fields=None):
+    """
+    Pulls the fields in field_names out of the request body as it arrives, without building the body as a dict. The
+    body itself is spooled to a temp file once it passes spool_memory_limit, so that it can still be archived.
+
+    The extractor stops once every field is found, and skips past the values it doesn't search, so the whole body is
+    also run through a SyntaxChecker, to reject anything the json module would. Only a body over budget_max_bytes
+    isn't checked to the end, as read_body doesn't decode one either.
+
+    :param request: the incoming request
+    :param metrics: the measurements of the request, to time the read and the extraction in
+    :param fields: the fields to search for, as a list or a compiled rule set. Defaults to get_fields()
+    :return:
+        file: the raw request body, rewound to the start
+        dict: a mapping of field name to the value found, as returned by find_fields, or the BudgetExceeded raised if
+        the body is over the traversal budget. The rest of the body is still read, so that it can be archived
+    :raises HTTPException: 422 if the body isn't valid JSON, or isn't a JSON object
+    """
+    extractor = StreamingExtractor(fields if fields is not None else get_fields(), traversal_budget)
+    checker = SyntaxChecker()
+    raw_body = tempfile.SpooledTemporaryFile(max_size=spool_memory_limit)
+    found = None
+    try:
+        with time_stage(metrics, "receive_extract"):
+            async for chunk in request.stream():
+                raw_body.write(chunk)
+                if not extractor.done and found is None:
+                    try:
+                        extractor.feed(chunk)
+                    except BudgetExceeded as e:
+                        found = e
+                        if e.limit == "max_bytes":
+                            checker = None
+                if checker is not None:
+                    checker.feed(chunk)
+            if checker is not None:
+                checker.close()
+            if found is None:
+                found = extractor.close()
+    except ValueError as e:
+        raw_body.close()
+        raise HTTPException(status_code=422, detail="Invalid JSON body: " + str(e))
+    if extractor.top_level != "object" and not isinstance(found, BudgetExceeded):
+        raw_body.close()
+        raise HTTPException(status_code=422, detail="The request body must be a JSON object")
+
+    if metrics:
+        metrics.payload_bytes = raw_body.tell()
+    raw_body.seek(0)
+    return raw_body, found
+
+
+class PassThroughStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that can be generated while the request body is still being read. The stock class listens for
+    the client disconnecting while it streams, which takes the request body messages away from the generator.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def start_process_pool():
+    """
+    Starts every worker of the process pool, if there is one, before the first request, so that a large payload never
+    waits for a worker to start and import this module
+    """
+    pool = get_process_pool()
+    if pool:
+        await asyncio.gather(*[asyncio.wrap_future(pool.submit(parse_payload, b"{}", field_names, False, False))
+                               for _ in range(process_workers)])
+
+
+def replay_spool():
+    """
+    Starts the services the settings call for, and queues the writes a previous run left in the spool, which weren't
+    stored before it stopped
+    """
+    start_services()
+    if not spool:
+        return
+    backend = get_backend()
+    recovered = spool.recover()
+    for ticket, record in recovered:
+        key, body, compress, if_absent = decode_spool_record(record)
+        write = functools.partial(put_if_absent if if_absent else timed_put, backend, key, body, None, "write",
+                                  raw_compressor if compress else None)
+        queue_write(write, len(body), ticket)
+    if recovered:
+        logging.info("Queued " + str(len(recovered)) + " writes left in the spool by the previous run")
+
+
+def close_writers():
+    """
+    Writes out any records still buffered in batched write_mode, waits for any writes still queued in write-behind
+    mode or running on the storage executor, stops the process pool, and saves the duplicate detection snapshot, before
+    the process exits
+    """
+    for writer in writers.values():
+        writer.close()
+    if write_queue:
+        write_queue.close()
+    if spool:
+        spool.close()
+    if executor:
+        executor.shutdown()
+    if process_pool:
+        process_pool.shutdown()
+    if deduplicator:
+        deduplicator.save()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the process pool and the services, and replays the spool, before the service takes its first request, and
+    closes them all once it has answered its last
+    """
+    await start_process_pool()
+    replay_spool()
+    try:
+        yield
+    finally:
+        close_writers()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def wait_for_writes(pending: list):
+    """
+    Waits for the pending writes of a record to reach storage, raising the first error if any of them failed. The
+    writes run concurrently, so a record waits for its slowest write rather than the sum of them
+
+    :param pending: the futures collected by save_json and save_data
+    """
+    if pending:
+        await asyncio.gather(*[asyncio.wrap_future(future) for future in pending])
+
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Serves the service's metrics in the Prometheus text format
+    """
+    return PlainTextResponse(service_metrics.render(), media_type="text/plain; version=0.0.4")
 
-app = FastAPI()
 
 @app.post("/")
-async def update_item(data:dict, response: Response):
+async def update_item(request: Request, response: Response):
+    curr_time = datetime.datetime.now()
+    backend = get_backend()
+    start_services()
+    metrics = service_metrics.started()
+    try:
+        body = await handle_item(request, response, curr_time, backend, metrics)
+        metrics.status = response.status_code
+        return body
+    except HTTPException as e:
+        metrics.status = e.status_code
+        raise
+    finally:
+        service_metrics.finished(metrics, "/")
+        service_metrics.record(metrics, "/")
+
+
+async def handle_item(request: Request, response: Response, curr_time: datetime.datetime, backend: StorageBackend,
+                      metrics: RequestMetrics):
+    """
+    Processes a single record posted to /
+
+    :return: dict: the response body
+    """
+    if write_queue:
+        check_write_queue()
+    fields = get_fields()  # the same rule set is used throughout the request, even if it's reloaded meanwhile
+    # finding many records needs the decoded body, and so does hashing a payload the same way whatever its formatting
+    streamed = streaming_extraction and not extract_records and not deduplicate
+    if streamed:
+        data, found = await stream_body(request, metrics, fields)
+        record = None
+    else:
+        data, record = await read_body(request, metrics, get_process_pool() is not None)
+        found = None
+    over_budget = next((value for value in (record, found) if isinstance(value, BudgetExceeded)), None)
+
+    # the raw and parsed writes run together, and the loop serves other requests while they're in flight
+    pending = []
+    try:
+        digest = None
+        cached = None
+        parsed = None
+        if record is None and not streamed:
+            # a large body is decoded, hashed and searched in the process pool, so the loop serves other requests
+            try:
+                digest, parsed = await parse_in_pool(data, fields, metrics)
+            except BudgetExceeded as e:
+                over_budget = e
+            if digest is not None:
+                cached = cached_result(digest, pending)
+        elif deduplicator and over_budget is None:
+            with metrics.stage("dedup"):
+                try:
+                    digest = digest_payload(record)
+                    cached = cached_result(digest, pending)
+                except BudgetExceeded as e:
+                    over_budget = e
+
+        if parsed is None and not cached and over_budget is None:
+            # parse out the data
+            try:
+                with metrics.stage("parse_data"):
+                    if extract_records:
+                        parsed = parse_records(record, fields)
+                    elif record is None:
+                        parsed = build_output(found, fields)
+                    else:
+                        parsed = parse_data(record, fields)
+            except BudgetExceeded as e:
+                over_budget = e
+
+        if cached:
+            response.status_code, body = cached
+        elif over_budget is not None:
+            metrics.over_budget = over_budget.limit
+            response.status_code, body = save_over_budget(data, over_budget, curr_time, backend, pending, metrics)
+        else:
+            res_count, output = parsed
+            metrics.fields_found = res_count
+            if extract_records:
+                response.status_code, body = save_records(data, output, curr_time, backend, pending, metrics, digest)
+            else:
+                response.status_code, body = save_results(data, res_count, output, curr_time, backend, pending,
+                                                          metrics, digest)
+        if write_queue:
+            # the writes are queued to be retried until they're stored, and the response doesn't wait for them, only
+            # for them to reach the spool if there is one
+            if response.status_code == 200:
+                response.status_code = 202
+        if spool or not write_queue:
+            with metrics.stage("spool_sync" if spool else "storage_wait"):
+                await wait_for_writes(pending)
+    finally:
+        if streamed:
+            data.close()
+
+    return body
+
+
+@app.post("/batch")
+async def update_batch(request: Request):
+    """
+    Accepts many records in one request, either as a JSON array of objects or as NDJSON with one object per line, and
+    processes each one the same way as a single POST to /.
+
+    The response holds one result per record, in order, with the status code the record would have got on its own
+    (200, 400, or 422 if the record isn't a JSON object). If the client accepts application/x-ndjson, the results are
+    streamed back one line per record as they're processed. NDJSON request bodies are also read one line at a time,
+    so neither side of a large batch is ever held in memory in full.
+
+    In write-behind mode, stored records get 202 rather than 200, as they do on /, and the whole batch gets a 429 or
+    503 if the write queue has no room when it arrives. Records reached once the queue has filled up partway through
+    get that status of their own and aren't processed, so the client can send just those again.
+    """
     curr_time = datetime.datetime.now()
-    s3 = boto3.client('s3')
+    backend = get_backend()
+    start_services()
+    if write_queue:
+        check_write_queue()
+
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith(ndjson_types):
+        records = read_ndjson(request)
+    else:
+        records = read_json_array(await read_batch_body(request))
+
+    async def results():
+        # in batched write_mode, results are held back in windows of up to batch_max_records so that each window's
+        # records are flushed together and only reported once they're stored. In direct write_mode, up to
+        # batch_in_flight records are written at once, and the oldest is reported as soon as its writes are done
+        buffered = write_mode == "batched" or output_format == "parquet"
+        window = collections.deque()
+        index = 0
+        metrics = service_metrics.started()
+        try:
+            async for raw, record in records:
+                pending = []
+                busy = write_queue_busy() if write_queue else None
+                if busy:
+                    result = {'index': index, 'status': busy[0], 'detail': busy[1]}
+                else:
+                    result = batch_result(index, record, raw, curr_time, backend, pending)
+                if write_queue and not spool:
+                    # as on /, the result doesn't wait for queued writes, only for them to reach the spool if there
+                    # is one
+                    pending = []
+                window.append((result, pending))
+                index += 1
+                if buffered and len(window) >= batch_max_records:
+                    async for result in settle_window(window):
+                        yield result
+                    window.clear()
+                elif not buffered and len(window) >= batch_in_flight:
+                    async for result in settle_window([window.popleft()]):
+                        yield result
+            async for result in settle_window(window):
+                yield result
+        finally:
+            service_metrics.finished(metrics, "/batch")
+
+    if 'application/x-ndjson' in request.headers.get('accept', ''):
+        async def lines():
+            async for result in results():
+                yield codec.dumps(result) + "\n"
+        return PassThroughStreamingResponse(lines(), media_type='application/x-ndjson')
+
+    return {'results': [result async for result in results()]}
 
-    # parse out the data
-    res_count, output_dict = parse_data(data)
-    
+
+async def read_batch_body(request: Request):
+    """
+    Reads and decodes a batch request body, which must be a JSON array
+
+    :param request: the incoming request
+    :return: list: the decoded records
+    :raises HTTPException: 422 if the body isn't a JSON array
+    """
+    try:
+        batch = codec.loads(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail="Invalid JSON body: " + str(e))
+    except RecursionError:
+        # the records can't be told apart to archive them, so the batch is refused; NDJSON batches are read per line
+        raise HTTPException(status_code=422, detail="The batch is nested too deeply to decode")
+    if not isinstance(batch, list):
+        raise HTTPException(status_code=422, detail="The request body must be a JSON array, or NDJSON")
+    return batch
+
+
+async def read_json_array(batch: list):
+    """
+    Yields the records of an already decoded JSON array batch. There are no separate raw bytes for each record, so
+    they're yielded as (None, record)
+    """
+    for record in batch:
+        yield None, record
+
+
+async def read_ndjson(request: Request):
+    """
+    Yields (line, record) for each record of an NDJSON request body as the line arrives, so that the line can be
+    archived as it was sent. A line that isn't valid JSON is yielded with a ValueError as the record, so that it can be
+    reported against that record without failing the rest of the batch.
+    """
+    pending = bytearray()
+    async for chunk in request.stream():
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line, decode_record(line)
+    if pending.strip():
+        yield pending, decode_record(pending)
+
+
+def decode_record(line: bytes):
+    """
+    :return: the decoded record, the ValueError raised while decoding it, or the BudgetExceeded raised if it's over the
+        traversal budget
+    """
+    try:
+        traversal_budget.check_bytes(len(line))
+        return decode_payload(line)
+    except (ValueError, BudgetExceeded) as e:
+        return e
+
+
+def digest_payload(data):
+    """
+    :param data: the payload, as payload_digest takes it
+    :return: bytes: the payload digest
+    :raises BudgetExceeded: if the payload is nested too deeply to be encoded for hashing
+    """
+    try:
+        return payload_digest(data)
+    except RecursionError:
+        raise BudgetExceeded("max_depth", traversal_budget.max_depth)
+
+
+def decode_payload(raw: bytes):
+    """
+    Decodes a payload, reporting one nested too deeply for the decoder as over the max_depth budget
+
+    :raises ValueError: if the payload isn't valid JSON
+    :raises BudgetExceeded: if the payload is nested too deeply to decode
+    """
+    try:
+        return codec.loads(raw)
+    except RecursionError:
+        raise BudgetExceeded("max_depth", traversal_budget.max_depth)
+
+
+async def settle_window(window: list):
+    """
+    Flushes the batch writer buffers the window's records were added to, and yields each result in the window once its
+    writes have completed. Buffers holding only other requests' records are left to fill up
+
+    :param window: the (result, pending) pairs from batch_result, in order
+    """
+    futures = {future for result, pending in window for future in pending}
+    if futures:
+        for writer in list(writers.values()):
+            writer.flush(futures)
+    for result, pending in window:
+        try:
+            await wait_for_writes(pending)
+        except Exception:
+            logging.exception("Failed to save record " + str(result['index']))
+            result = {'index': result['index'], 'status': 500, 'detail': "Failed to save the record"}
+        service_metrics.responses.inc(1, "/batch", result['status'])
+        yield result
+
+
+def batch_result(index: int, record, raw: bytes, curr_time: datetime.datetime, backend: StorageBackend, pending: list):
+    """
+    Processes one record of a batch
+
+    :param index: the position of the record in the batch
+    :param record: the decoded record, or the ValueError raised while decoding it
+    :param raw: the record as it was sent, or None to archive the record encoded from the dict
+    :param curr_time: the time the batch was received, used to partition the output
+    :param backend: the storage backend to write the data to
+    :param pending: the list to add the record's write futures to
+    :return: dict: the result for the record, holding its index, status code, and response body
+    """
+    if isinstance(record, ValueError):
+        return {'index': index, 'status': 422, 'detail': "Invalid JSON record: " + str(record)}
+    if not isinstance(record, (dict, BudgetExceeded)):
+        return {'index': index, 'status': 422, 'detail': "The record must be a JSON object"}
+
+    over_budget = record if isinstance(record, BudgetExceeded) else None
+    digest = None
+    cached = None
+    parsed = None
+    try:
+        if deduplicator and over_budget is None:
+            digest = digest_payload(record)
+            cached = cached_result(digest, pending)
+        if not cached and over_budget is None:
+            parsed = parse_records(record) if extract_records else parse_data(record)
+    except BudgetExceeded as e:
+        over_budget = e
+
+    try:
+        if cached:
+            status_code, body = cached
+        elif over_budget is not None:
+            status_code, body = save_over_budget(record if raw is None else raw, over_budget, curr_time, backend,
+                                                 pending)
+        else:
+            res_count, output = parsed
+            service_metrics.fields_found.observe(res_count)
+            if extract_records:
+                status_code, body = save_records(record if raw is None else raw, output, curr_time, backend, pending,
+                                                 digest=digest)
+            else:
+                status_code, body = save_results(record if raw is None else raw, res_count, output, curr_time,
+                                                 backend, pending, digest=digest)
+    except Exception:
+        logging.exception("Failed to save record " + str(index))
+        return {'index': index, 'status': 500, 'detail': "Failed to save the record"}
+
+    if write_queue and status_code == 200:
+        # the writes are queued to be retried until they're stored, and the result doesn't wait for them
+        status_code = 202
+    result = {'index': index, 'status': status_code}
+    result.update(body)
+    return result
+
+
+def cached_result(digest: bytes, pending: list):
+    """
+    Looks for a payload among the payloads stored recently. A repeat waits on the first copy's writes, so that it's
+    never answered before the first copy is stored, and fails with it if they fail
+
+    :param digest: the payload digest
+    :param pending: the list to add the first copy's write futures to
+    :return: the status code and response body the first copy was given, or None if the payload isn't cached
+    """
+    entry = deduplicator.lookup(digest)
+    if entry is None:
+        return None
+    status_code, body, futures = entry
+    pending.extend(futures)
+    service_metrics.dedup.inc(1, "cached")
+    return status_code, body
+
+
+def save_results(data, res_count: int, output_dict: dict, curr_time: datetime.datetime, backend: StorageBackend,
+                 pending: list, metrics: RequestMetrics = None, digest: bytes = None):
+    """
+    Saves the parsed record and the raw data, and builds the response for the request
+
+    With a payload digest, the record ID is taken from the digest and the raw data is stored under it, in a content
+    folder rather than by date, so that every copy of a payload refers to one raw object. The raw data is only looked
+    up before it's written when the Bloom filter says it was probably stored already. The response is remembered to
+    answer repeats with.
+
+    :param data: the raw data, as the request body in bytes or a file object, or as a dict
+    :param res_count: the number of fields found
+    :param output_dict: the parsed record
+    :param curr_time: the time the request was received, used to partition the output
+    :param backend: the storage backend to write the data to
+    :param pending: the list to add the write futures to, which must complete before responding
+    :param metrics: the measurements of the request, to time the encoding and writes in
+    :param digest: the payload digest, when duplicates are being detected
+    :return:
+        int: the status code for the response
+        dict: the response body
+    """
     path = curr_time.strftime(path_format)
+    raw_path, if_absent = raw_location(path, digest)
+    if digest is not None:
+        output_dict[record_id_key] = digest_record_id(digest)
 
     # if we find no values, exit here, return 400
     if res_count == 0:
-        path = "unprocessed/" + path
-
         # as long as the JSON loads, we're going to store it for review later
-        json_path = save_json(data, path, output_dict[record_id_key], s3)
-        response.status_code = 400
-        return {
+        json_path = save_json(data, "unprocessed/" + raw_path, output_dict[record_id_key], backend, pending, metrics,
+                              if_absent)
+        status_code, body = 400, {
             'body': "No fields found. Raw data is stored at " + json_path
         }
+    else:
+        # otherwise, save off the data
+        out_path = save_data(output_dict,  path, backend, pending, metrics)
+        json_path = save_json(data, "processed/" + raw_path, output_dict[record_id_key], backend, pending, metrics,
+                              if_absent)
 
-    # otherwise, save off the data
-    out_path = save_data(output_dict,  path, s3)
-    json_path = save_json(data, "processed/" + path, output_dict[record_id_key], s3)
+        # report success
+        status_code, body = 200, {
+            'data' : output_dict,
+            'path' : out_path
+        }
+
+    if digest is not None:
+        deduplicator.remember(digest, (status_code, body, list(pending)), pending)
+    return status_code, body
+
+
+def save_records(data, rows: list, curr_time: datetime.datetime, backend: StorageBackend, pending: list,
+                 metrics: RequestMetrics = None, digest: bytes = None):
+    """
+    Saves the parsed rows of a payload that holds many records, and the raw data once, and builds the response for the
+    request. The raw data is stored under a payload ID, which every row holds as [payload_id_key], alongside its own
+    record ID. With a payload digest, both IDs are taken from the digest, as save_results does
 
-    # report success
-    response.status_code = 200
-    return {
-        'data' : output_dict,
-        'path' : out_path
+    :param data: the raw data, as the request body in bytes, or as a dict
+    :param rows: the parsed rows, from parse_records
+    :param curr_time: the time the request was received, used to partition the output
+    :param backend: the storage backend to write the data to
+    :param pending: the list to add the write futures to, which must complete before responding
+    :param metrics: the measurements of the request, to time the encoding and writes in
+    :param digest: the payload digest, when duplicates are being detected
+    :return:
+        int: the status code for the response
+        dict: the response body
+    """
+    path = curr_time.strftime(path_format)
+    raw_path, if_absent = raw_location(path, digest)
+    payload_id = time_ordered_id() if digest is None else digest_record_id(digest)
+    for index, row in enumerate(rows):
+        if digest is not None:
+            row[record_id_key] = digest_record_id(digest, index)
+        row[payload_id_key] = payload_id
+
+    # if we find no records, exit here, return 400
+    if not rows:
+        json_path = save_json(data, "unprocessed/" + raw_path, payload_id, backend, pending, metrics, if_absent)
+        status_code, body = 400, {
+            'body': "No records found. Raw data is stored at " + json_path
+        }
+    else:
+        out_paths = save_rows(rows, path, payload_id, backend, pending, metrics)
+        save_json(data, "processed/" + raw_path, payload_id, backend, pending, metrics, if_absent)
+        status_code, body = 200, {
+            'data': rows,
+            'paths': out_paths,
+            payload_id_key: payload_id
+        }
+
+    if digest is not None:
+        deduplicator.remember(digest, (status_code, body, list(pending)), pending)
+    return status_code, body
+
+
+def save_over_budget(data, error: BudgetExceeded, curr_time: datetime.datetime, backend: StorageBackend,
+                     pending: list, metrics: RequestMetrics = None):
+    """
+    Archives a payload that's over the traversal budget as unprocessed, without searching it, and builds the response
+    for the request
+
+    :param data: the raw data, as the request body in bytes or a file object, or as a dict
+    :param error: the budget the payload exceeded
+    :param curr_time: the time the request was received, used to partition the output
+    :param backend: the storage backend to write the data to
+    :param pending: the list to add the write futures to, which must complete before responding
+    :param metrics: the measurements of the request, to time the encoding and the write in
+    :return:
+        int: the status code for the response
+        dict: the response body
+    """
+    service_metrics.over_budget.inc(1, error.limit)
+    try:
+        json_path = save_json(data, "unprocessed/" + curr_time.strftime(path_format), time_ordered_id(), backend,
+                              pending, metrics, unchecked=True)
+        detail = str(error) + ", so it wasn't searched. Raw data is stored at " + json_path
+    except RecursionError:
+        # only a record of a JSON array batch has no raw bytes, and one nested this deeply can't be encoded again
+        detail = str(error) + ", so it wasn't searched, and it's nested too deeply to be archived"
+    logging.warning(detail)
+    return 400, {
+        'body': detail,
+        'reason': error.limit
     }
 
+
+def raw_location(path: str, digest: bytes = None):
+    """
+    :param path: the date path of the request
+    :param digest: the payload digest, when duplicates are being detected
+    :return:
+        str: the path to store the raw data under, below processed/ or unprocessed/. With a digest, this is a content
+        folder rather than the date, so that every copy of a payload refers to one raw object
+        bool: whether to check the raw data isn't stored already before writing it, which is only done when the Bloom
+        filter says it probably is
+    """
+    if digest is None:
+        return path, False
+    if_absent = write_mode != "batched" and deduplicator.probably_stored(digest)
+    if not if_absent:
+        service_metrics.dedup.inc(1, "new")
+    return "content", if_absent
+
+
 if __name__ == "__main__":
     print("Hello world")
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""
+Partition layouts for the S3 output, and a generator for the matching Athena table definition. The table uses
+partition projection, so Athena works out which prefixes to read from the query's date filter. New days don't need a
+crawler run or MSCK REPAIR TABLE before they can be queried.
+
+Every write for a day would otherwise land under one prefix, which S3 limits to a few thousand requests a second, so
+the objects can be spread over a number of hash-sharded prefixes below the date, such as 2020/10/01/07/. The shard is
+one more partition column, so a date filter still prunes to that date's prefixes. Objects are named with time-ordered
+IDs, which sort by when they were made, so listing a partition gives them in time order once the shards are merged.
+
+Running this file prints the table definition:
+> python partitions.py --bucket [bucket] --folder parsed_data --style hive --shards 16
+"""
+import argparse
+import datetime
+import os
+import threading
+import time
+import uuid
+import zlib
+
+# the strftime format for each partition style. "hive" names each level, so Glue and Athena read them as columns
+date_formats = {"date": "%Y/%m/%d", "hive": "year=%Y/month=%m/day=%d"}
+hour_formats = {"date": "/%H", "hive": "/hour=%H"}
+
+_id_lock = threading.Lock()
+_last_id = [0, 0]  # the millisecond and counter of the last ID made from the clock
+
+
+def partition_format(style: str = "date", hourly: bool = False):
+    """
+    :param style: "date" for YYYY/MM/DD paths, or "hive" for year=YYYY/month=MM/day=DD paths
+    :param hourly: add an hour level below the day
+    :return: str: the strftime format that builds a partition path
+    """
+    if style not in date_formats:
+        raise ValueError("Unknown partition style " + repr(style) + ", expected one of " + ", ".join(date_formats))
+    return date_formats[style] + (hour_formats[style] if hourly else "")
+
+
+def partition_columns(hourly: bool = False, shards: int = 0):
+    """
+    :param hourly: include the hour level
+    :param shards: the number of shards below the date, or 0 for none
+    :return: list: the partition column names, outermost first
+    """
+    return ["year", "month", "day"] + (["hour"] if hourly else []) + (["shard"] if shards else [])
+
+
+def shard_directory(name: str, shards: int, style: str = "date"):
+    """
+    :param name: the object's name, such as its record ID, which picks its shard
+    :param shards: the number of shards, or 0 for none
+    :param style: the partition style, "date" or "hive"
+    :return: str: the shard level to add below the date path, such as "/07", or "/shard=07" in hive style. Empty when
+        shards is 0
+    """
+    if not shards:
+        return ""
+    return _shard_level(zlib.crc32(name.encode("utf-8")) % shards, shards, style)
+
+
+def _shard_level(shard: int, shards: int, style: str):
+    # shards are zero padded to the same width, so they sort in order
+    return ("/shard=" if style == "hive" else "/") + str(shard).zfill(len(str(shards - 1)))
+
+
+def time_ordered_id(timestamp: float = None):
+    """
+    Makes a UUID in the version 7 layout: a 48 bit Unix time in milliseconds, a 12 bit counter, and 62 random bits.
+    IDs sort by the time they were made, as strings as well as numbers, and IDs made in the same millisecond by one
+    process sort in the order they were made
+
+    :param timestamp: the Unix time to make the ID for, or None for now
+    :return: str: the ID, in the usual hyphenated form
+    """
+    if timestamp is not None:
+        millis = int(timestamp * 1000)
+        counter = int.from_bytes(os.urandom(2), "big") & 0x7ff
+    else:
+        millis = int(time.time() * 1000)
+        with _id_lock:
+            last_millis, counter = _last_id
+            if millis > last_millis:
+                # the counter starts at a random point in its lower half, which leaves room to count up
+                counter = int.from_bytes(os.urandom(2), "big") & 0x7ff
+            else:
+                # the same millisecond, or the clock went back, so the last ID's time is kept and the counter moves on
+                millis, counter = last_millis, counter + 1
+                if counter > 0xfff:
+                    millis, counter = millis + 1, 0
+            _last_id[:] = millis, counter
+    random_bits = int.from_bytes(os.urandom(8), "big") >> 2
+    return str(uuid.UUID(int=(millis << 80) | (0x7 << 76) | (counter << 64) | (0b10 << 62) | random_bits))
+
+
+def id_time(record_id: str):
+    """
+    :param record_id: an ID made by time_ordered_id, with or without hyphens
+    :return: datetime: the local time the ID was made at, to the millisecond, or None if the ID isn't time-ordered
+    """
+    try:
+        value = uuid.UUID(record_id)
+    except ValueError:
+        return None
+    if value.version != 7:
+        return None
+    return datetime.datetime.fromtimestamp((value.int >> 80) / 1000)
+
+
+def partition_prefixes(folder: str, start: datetime.datetime, end: datetime.datetime, style: str = "date",
+                       hourly: bool = False, shards: int = 0):
+    """
+    :param folder: the folder the objects are written under, such as parsed_data
+    :param start: the start of the time range
+    :param end: the end of the time range, which isn't included
+    :param style: the partition style the objects were written with
+    :param hourly: whether the objects were written with an hour level
+    :param shards: the number of shards the objects were written with
+    :return: list: the key prefix of every partition and shard the time range overlaps, in time order
+    """
+    path_format = partition_format(style, hourly)
+    step = datetime.timedelta(hours=1) if hourly else datetime.timedelta(days=1)
+    current = start.replace(minute=0, second=0, microsecond=0)
+    if not hourly:
+        current = current.replace(hour=0)
+    prefixes = []
+    while current < end:
+        partition = folder + "/" + current.strftime(path_format)
+        if shards:
+            prefixes.extend(partition + _shard_level(shard, shards, style) + "/" for shard in range(shards))
+        else:
+            prefixes.append(partition + "/")
+        current += step
+    return prefixes
+
+
+def list_range(backend, folder: str, start: datetime.datetime, end: datetime.datetime, style: str = "date",
+               hourly: bool = False, shards: int = 0):
+    """
+    Lists the objects written in a time range, reading only the prefixes of the partitions the range overlaps. The
+    range is widened to whole partitions, and id_time gives each object's exact time where it's needed
+
+    :param backend: the StorageBackend holding the objects
+    :param folder: the folder the objects are written under
+    :param start: the start of the time range
+    :param end: the end of the time range, which isn't included
+    :param style: the partition style the objects were written with
+    :param hourly: whether the objects were written with an hour level
+    :param shards: the number of shards the objects were written with
+    :return: list: the object keys, partition by partition, and within each partition in the order of their names,
+        which for time-ordered IDs is the order they were made in, across every shard
+    """
+    keys = []
+    prefixes = partition_prefixes(folder, start, end, style, hourly, shards)
+    for i in range(0, len(prefixes), max(shards, 1)):
+        partition_keys = []
+        for prefix in prefixes[i:i + max(shards, 1)]:
+            partition_keys.extend(backend.keys(prefix))
+        keys.extend(sorted(partition_keys, key=lambda key: key.rsplit("/", 1)[-1]))
+    return keys
+
+
+def projection_table_ddl(database: str, table: str, location: str, columns: list, style: str = "date",
+                         hourly: bool = False, data_format: str = "json", first_year: int = 2020,
+                         last_year: int = 2099, shards: int = 0):
+    """
+    Builds the CREATE EXTERNAL TABLE statement for data written with the given partition layout, with partition
+    projection enabled
+
+    :param database: the Glue database to create the table in
+    :param table: the name of the table
+    :param location: the S3 location of the data, such as s3://bucket/parsed_data
+    :param columns: the data column names, which are all declared as strings
+    :param style: the partition style the data was written with
+    :param hourly: whether the data was written with an hour level
+    :param data_format: "json" for JSON lines, or "parquet"
+    :param first_year: the first year to project partitions for
+    :param last_year: the last year to project partitions for
+    :param shards: the number of shards the data was written with, or 0 for none
+    :return: str: the DDL statement
+    """
+    partition_format(style, hourly)  # validates the style
+    location = location.rstrip("/")
+    template = location + "/" + "/".join(
+        (column + "=${" + column + "}") if style == "hive" else ("${" + column + "}")
+        for column in partition_columns(hourly, shards))
+
+    ranges = {"year": (first_year, last_year), "month": (1, 12), "day": (1, 31), "hour": (0, 23),
+              "shard": (0, shards - 1)}
+    digits = {"month": 2, "day": 2, "hour": 2, "shard": len(str(shards - 1))}
+    properties = [("projection.enabled", "true")]
+    for column in partition_columns(hourly, shards):
+        low, high = ranges[column]
+        properties.append(("projection." + column + ".type", "integer"))
+        properties.append(("projection." + column + ".range", str(low) + "," + str(high)))
+        if column in digits:
+            properties.append(("projection." + column + ".digits", str(digits[column])))
+    properties.append(("storage.location.template", template))
+
+    if data_format == "json":
+        storage = "ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'"
+    elif data_format == "parquet":
+        storage = "STORED AS PARQUET"
+    else:
+        raise ValueError("Unknown data format " + repr(data_format) + ", expected json or parquet")
+
+    return ("CREATE EXTERNAL TABLE IF NOT EXISTS `" + database + "`.`" + table + "` (\n" +
+            ",\n".join("  `" + column + "` string" for column in columns) + "\n)\n" +
+            "PARTITIONED BY (\n" +
+            ",\n".join("  `" + column + "` string" for column in partition_columns(hourly, shards)) + "\n)\n" +
+            storage + "\n" +
+            "LOCATION '" + location + "/'\n" +
+            "TBLPROPERTIES (\n" +
+            ",\n".join("  '" + key + "'='" + value + "'" for key, value in properties) + "\n)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints the Athena table definition for the parsed output")
+    parser.add_argument("--bucket", required=True, help="the bucket the data is written to")
+    parser.add_argument("--folder", default="parsed_data", help="the folder the data is written to")
+    parser.add_argument("--database", default="kp-manifold-interview", help="the Glue database to create the table in")
+    parser.add_argument("--table", help="the table name. Defaults to the folder name")
+    parser.add_argument("--style", default="date", choices=sorted(date_formats), help="the partition style")
+    parser.add_argument("--hourly", action="store_true", help="the data is partitioned by hour")
+    parser.add_argument("--format", default="json", choices=["json", "parquet"], help="the data format")
+    parser.add_argument("--shards", type=int, default=0, help="the number of shards the data was written with")
+    parser.add_argument("--columns", default="zip_code,first_name,middle_name,last_name,record_id",
+                        help="comma separated data columns")
+    args = parser.parse_args()
+
+    print(projection_table_ddl(args.database, args.table or args.folder, "s3://" + args.bucket + "/" + args.folder,
+                               args.columns.split(","), args.style, args.hourly, args.format, shards=args.shards))
@@ -0,0 +1,361 @@
+"""
+A crash-safe local spool for writes that are made after the request is answered. Each record is appended to a
+memory-mapped segment file and synced to disk before the caller is told it's safe, so a restart never loses a record
+that was acknowledged. Once a record's write has been confirmed it's acknowledged, and a segment file is deleted once
+it's full and every record in it has been acknowledged. On start, the records left unacknowledged in any segment files
+by a previous run are handed back to be written again, so delivery is at least once.
+
+Segment files are preallocated to a fixed size and hold one record after another, each framed by its length and a
+CRC-32 of its contents. A zero length marks the end of the records, since the file starts out zeroed. A record whose
+checksum doesn't match, such as the tail of one torn by a crash mid-write, ends the segment when it's read back.
+Acknowledging a record sets a flag in its frame's length, in place, and flagged records are skipped when a segment is
+read back. The flag isn't synced, since replaying a record is always safe: a crash of the process keeps it, as the
+mapped pages are already the operating system's, and only a power failure can lose it and replay the record.
+
+Syncing is done in groups: a background thread waits sync_delay seconds after the first unsynced append, so that
+appends arriving meanwhile are all made durable by the same msync, rather than one disk flush each.
+
+Several processes can share a directory, such as the workers of one service. Each spool keeps its segments in a
+subdirectory of its own, which it holds an flock on for as long as it's open, and segment files are only ever created
+new, never opened over an existing one. A starting spool takes over the subdirectories whose lock is free, which a
+stopped or crashed spool left behind, moving their segments into its own to recover. That is done while holding a lock
+on the directory itself, so that two spools starting at once never recover the same segments. Where there's no fcntl,
+as on Windows, nothing is locked, and only one process may use a directory.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where a spool directory can't be shared by several processes
+    fcntl = None
+
+_segment_magic = b"SPL1"
+_frame = struct.Struct(">II")  # record length, CRC-32 of the record
+_length = struct.Struct(">I")  # the record length at the start of a frame, on its own
+_acked = 0x80000000  # set in a frame's record length once the record has been acknowledged
+_segment_suffix = ".spool"
+_lock_name = "spool.lock"  # the lock file, both in the spool directory and in each spool's own subdirectory
+_own_prefix = "spool-"  # the start of the name of each spool's own subdirectory
+
+
+class _Segment:
+    """
+    One segment file, mapped into memory
+    """
+
+    def __init__(self, path: str, size: int, create: bool):
+        self.path = path
+        with open(path, "x+b" if create else "r+b") as f:
+            if create:
+                f.truncate(size)
+                f.write(_segment_magic)
+                f.flush()
+                os.fsync(f.fileno())
+            else:
+                size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), size)
+        self.size = size
+        self.written = len(_segment_magic)  # the end of the last record appended
+        self.synced = self.written  # the end of the last record known to be on disk
+        self.pending = 0  # records appended and not yet acknowledged
+        self.sealed = False  # no more records will be appended
+
+    def records(self):
+        """
+        Reads back the records in a segment written by a previous run, leaving written at the end of the last good one
+
+        :return: list: (offset, record) for each record not yet acknowledged, where offset is the start of its frame
+        """
+        records = []
+        offset = len(_segment_magic)
+        while offset + _frame.size <= self.size:
+            length, crc = _frame.unpack_from(self.map, offset)
+            if length == 0:
+                break
+            acked = length & _acked
+            length &= ~_acked
+            start = offset + _frame.size
+            record = self.map[start:start + length]
+            if len(record) != length or zlib.crc32(record) != crc:
+                logging.warning("Ignoring a damaged record at byte " + str(offset) + " of " + self.path +
+                                " and everything after it")
+                break
+            if not acked:
+                records.append((offset, record))
+            offset = start + length
+        self.written = self.synced = offset
+        return records
+
+    def ack(self, offset: int):
+        """
+        Flags the record whose frame starts at offset as acknowledged, so that it isn't read back
+        """
+        length, = _length.unpack_from(self.map, offset)
+        _length.pack_into(self.map, offset, length | _acked)
+
+
+class Spool:
+    """
+    An append-only spool of records in memory-mapped segment files under a directory. append() returns a future that
+    resolves once the record is on disk, and a ticket to acknowledge the record with once it's no longer needed.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, sync_delay: float = 0.002):
+        """
+        :param directory: the directory to keep the segment files in, which is created if it doesn't exist, and can be
+            shared with spools in other processes
+        :param segment_bytes: the size of each segment file. A record larger than this gets a segment of its own
+        :param sync_delay: seconds to wait after an append for others to sync with it
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync_delay = sync_delay
+        os.makedirs(directory, exist_ok=True)
+
+        self._active = None  # the _Segment being appended to
+        self._segments = set()  # every _Segment with its file still open
+        self._unsynced = []  # futures of the records appended since the last sync
+        self._dirty = {}  # _Segment -> the offset its unsynced records start at
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+
+        with _lock_file(os.path.join(directory, _lock_name)):
+            self.own_directory = tempfile.mkdtemp(prefix=_own_prefix, dir=directory)
+            self._own_lock = _lock_file(os.path.join(self.own_directory, _lock_name))
+            self._next_number = 0
+            # segments directly under the directory were left by a spool from before each had a subdirectory
+            self._adopt(directory)
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if name.startswith(_own_prefix) and path != self.own_directory and os.path.isdir(path):
+                    lock = _lock_file(os.path.join(path, _lock_name), blocking=False)
+                    if lock is not None:
+                        with lock:
+                            self._adopt(path)
+                            _remove_directory(path)
+
+        self._recovered = []
+        for name in _segment_names(self.own_directory):
+            path = os.path.join(self.own_directory, name)
+            if os.path.getsize(path) <= len(_segment_magic):
+                os.remove(path)  # the run stopped while creating it, before any record was appended
+                continue
+            segment = _Segment(path, 0, False)
+            if segment.map[:len(_segment_magic)] != _segment_magic:
+                logging.error(path + " is not a spool segment, leaving it alone")
+                segment.map.close()
+                continue
+            self._segments.add(segment)
+            records = segment.records()
+            segment.sealed = True
+            segment.pending = len(records)
+            self._recovered.extend(((segment, offset), record) for offset, record in records)
+            self._delete_if_done(segment)
+        if self._recovered:
+            logging.info("Recovered " + str(len(self._recovered)) + " unacknowledged records from " + directory)
+
+        self._thread = threading.Thread(target=self._run, name="spool-sync", daemon=True)
+        self._thread.start()
+
+    def recover(self):
+        """
+        Hands over the records a previous run appended and never acknowledged, once. Each must be acknowledged with
+        its ticket once it's been dealt with, as a new record would be
+
+        :return: list: (ticket, record) for each record, in the order they were appended
+        """
+        with self._lock:
+            recovered, self._recovered = self._recovered, []
+        return recovered
+
+    def append(self, record: bytes):
+        """
+        Appends a record to the spool
+
+        :param record: the record, which must not be empty, and shorter than 2 GiB
+        :return:
+            the ticket to pass to ack once the record is no longer needed
+            Future: resolves to None once the record is on disk
+        """
+        frame_size = _frame.size + len(record)
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The spool is closed")
+            segment = self._active
+            if segment is None or segment.written + frame_size > segment.size:
+                if segment is not None:
+                    segment.sealed = True
+                    self._delete_if_done(segment)
+                segment = self._active = self._new_segment(max(self.segment_bytes,
+                                                               len(_segment_magic) + frame_size))
+            start = segment.written
+            segment.map[start + _frame.size:start + frame_size] = record
+            segment.map[start:start + _frame.size] = _frame.pack(len(record), zlib.crc32(record))
+            segment.written = start + frame_size
+            segment.pending += 1
+            self._dirty.setdefault(segment, start)
+            self._unsynced.append(future)
+            self._wake.notify()
+        return (segment, start), future
+
+    def ack(self, ticket):
+        """
+        Acknowledges a record, once it's no longer needed, such as once it's been written to storage. The record won't
+        be recovered by a later run, and its segment is deleted once every record in it is acknowledged
+
+        :param ticket: the ticket append or recover gave for the record
+        """
+        segment, offset = ticket
+        with self._lock:
+            if segment.map.closed:
+                return  # the spool was closed first, so the record is left for the next run to recover
+            segment.ack(offset)
+            segment.pending -= 1
+            self._delete_if_done(segment)
+
+    def closed(self):
+        """
+        :return: bool: whether the spool has been closed, after which it refuses records
+        """
+        return self._closed
+
+    def close(self):
+        """
+        Syncs any records not yet on disk and closes the segment files. Records not yet acknowledged are kept for the
+        next run to recover
+        """
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self._thread.join()
+        with self._lock:
+            if self._active is not None:
+                self._active.sealed = True
+                self._delete_if_done(self._active)
+                self._active = None
+            for segment in self._segments:
+                segment.map.close()
+            self._segments.clear()
+            if self._own_lock.closed:
+                return
+            with _lock_file(os.path.join(self.directory, _lock_name)):
+                if os.listdir(self.own_directory) == [_lock_name]:
+                    _remove_directory(self.own_directory)
+                self._own_lock.close()  # any segments left are taken over by the next spool to start
+
+    def _adopt(self, directory: str):
+        # moves the segments a stopped spool left in a directory into this spool's own, in order, to be recovered
+        names = _segment_names(directory)
+        for name in names:
+            os.rename(os.path.join(directory, name),
+                      os.path.join(self.own_directory, "%016d" % self._next_number + _segment_suffix))
+            self._next_number += 1
+        if names:
+            logging.info("Took over " + str(len(names)) + " spool segments from " + directory)
+            _fsync_directory(directory)
+            _fsync_directory(self.own_directory)
+
+    def _new_segment(self, size: int):
+        path = os.path.join(self.own_directory, "%016d" % self._next_number + _segment_suffix)
+        self._next_number += 1
+        segment = _Segment(path, size, True)
+        _fsync_directory(self.own_directory)
+        self._segments.add(segment)
+        return segment
+
+    def _delete_if_done(self, segment: _Segment):
+        # only a full segment whose records are all on disk and acknowledged is deleted
+        if segment.sealed and segment.pending == 0 and segment.synced == segment.written:
+            segment.map.close()
+            os.remove(segment.path)
+            self._segments.discard(segment)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._unsynced and not self._closed:
+                    self._wake.wait()
+                if not self._unsynced:
+                    return
+            if self.sync_delay and not self._closed:
+                time.sleep(self.sync_delay)  # let more appends join this sync
+            with self._lock:
+                futures, self._unsynced = self._unsynced, []
+                dirty, self._dirty = self._dirty, {}
+                ends = {segment: segment.written for segment in dirty}
+            try:
+                for segment, start in dirty.items():
+                    # msync needs a page aligned offset
+                    offset = start - start % mmap.ALLOCATIONGRANULARITY
+                    segment.map.flush(offset, ends[segment] - offset)
+            except Exception as e:
+                logging.exception("Failed to sync the spool")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                for segment, end in ends.items():
+                    segment.synced = max(segment.synced, end)
+                    self._delete_if_done(segment)
+            for future in futures:
+                future.set_result(None)
+
+
+def _segment_names(directory: str):
+    """
+    :return: list: the names of the segment files in a directory, in the order they were created
+    """
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith(_segment_suffix) and name[:-len(_segment_suffix)].isdigit())
+
+
+def _lock_file(path: str, blocking: bool = True):
+    """
+    Opens a lock file, creating it if need be, and takes an exclusive lock on it, which is held until it's closed
+
+    :param blocking: whether to wait for the lock if another spool holds it, rather than giving up
+    :return: the open lock file, or None if blocking is False and another spool holds the lock
+    """
+    lock = open(path, "a+b")
+    if fcntl:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock.close()
+            return None
+    return lock
+
+
+def _remove_directory(directory: str):
+    """
+    Removes a spool's own subdirectory along with its lock file, once nothing else is left in it
+    """
+    try:
+        os.remove(os.path.join(directory, _lock_name))
+        os.rmdir(directory)
+    except OSError:
+        logging.warning("Leaving " + directory + " in place, as it holds files that aren't spool segments")
+
+
+def _fsync_directory(directory: str):
+    """
+    Syncs a directory, so that a file created in it survives a crash. Not every platform can open a directory
+    """
+    try:
+        handle = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
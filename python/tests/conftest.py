@@ -0,0 +1,14 @@
+import pytest
+import main
+
+
+@pytest.fixture
+def main_settings(request, monkeypatch):
+    """
+    Gives the test case a configure method, which sets main's configuration for the test and restores it afterwards
+    """
+    def configure(**settings):
+        for name, value in settings.items():
+            monkeypatch.setattr(main, name, value)
+
+    request.instance.configure = configure
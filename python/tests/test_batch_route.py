@@ -0,0 +1,168 @@
+from unittest import TestCase
+import json
+import threading
+import time
+from fastapi.testclient import TestClient
+import main
+import pytest
+import storage
+
+
+class SlowBackend(storage.MemoryBackend):
+    """
+    A memory backend whose writes take a while, and which counts the most that were in flight at once
+    """
+
+    def __init__(self):
+        storage.MemoryBackend.__init__(self)
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.counter_lock = threading.Lock()
+
+    def put(self, key, body, content_encoding=None):
+        with self.counter_lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.02)
+        storage.MemoryBackend.put(self, key, body, content_encoding)
+        with self.counter_lock:
+            self.in_flight -= 1
+
+
+@pytest.mark.usefixtures("main_settings")
+class TestBatchRoute(TestCase):
+
+    def setUp(self):
+        self.backend = storage.MemoryBackend()
+        self.configure(backend=self.backend)
+        self.client = TestClient(main.app)
+
+    def raw_objects(self):
+        """
+        :return: dict: the key and body of each raw object stored
+        """
+        return {key: body for key, body in self.backend.objects.items() if key.startswith(main.json_folder + "/")}
+
+    def test_batch_json_array(self):
+        """
+        Tests that each record of a JSON array is parsed and stored, with a result for each in order
+        """
+        response = self.client.post("/batch", json=[{"first_name": "Shirley"}, {"person": {"last_name": "Anne"}}])
+
+        self.assertEqual(200, response.status_code)
+        results = response.json()["results"]
+        self.assertEqual([0, 1], [result["index"] for result in results])
+        self.assertEqual([200, 200], [result["status"] for result in results])
+        self.assertEqual("Shirley", results[0]["data"]["first_name"])
+        self.assertEqual("Anne", results[1]["data"]["last_name"])
+        for result in results:
+            self.assertEqual(result["data"], json.loads(self.backend.objects[result["path"]]))
+
+    def test_batch_ndjson(self):
+        """
+        Tests that an NDJSON body is read one record per line, skipping blank lines
+        """
+        body = b'{"first_name": "Shirley"}\n\n{"first_name": "Bob"}\r\n{"first_name": "Elise"}'
+        response = self.client.post("/batch", content=body, headers={"content-type": "application/x-ndjson"})
+
+        results = response.json()["results"]
+        self.assertEqual(["Shirley", "Bob", "Elise"], [result["data"]["first_name"] for result in results])
+
+    def test_batch_mixed_results(self):
+        """
+        Tests that a record with no fields gets a 400 and one that isn't a JSON object a 422, without failing the
+        records around them
+        """
+        body = b'{"first_name": "Shirley"}\n{"other": 1}\n{"first_name": \n[1, 2]\n{"first_name": "Bob"}'
+        response = self.client.post("/batch", content=body, headers={"content-type": "application/x-ndjson"})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([200, 400, 422, 422, 200], [result["status"] for result in response.json()["results"]])
+
+        response = self.client.post("/batch", json=[{"first_name": "Shirley"}, "Bob", {}])
+        self.assertEqual([200, 422, 400], [result["status"] for result in response.json()["results"]])
+
+        response = self.client.post("/batch", json={"first_name": "Shirley"})
+        self.assertEqual(422, response.status_code)
+
+    def test_batch_streamed_response(self):
+        """
+        Tests that a client accepting NDJSON gets one result per line
+        """
+        body = b'{"first_name": "Shirley"}\n{"other": 1}'
+        response = self.client.post("/batch", content=body, headers={"content-type": "application/x-ndjson",
+                                                                       "accept": "application/x-ndjson"})
+
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([(0, 200), (1, 400)], [(line["index"], line["status"]) for line in lines])
+
+    def test_batch_in_flight(self):
+        """
+        Tests that in direct write_mode the writes of several records are made at once, up to batch_in_flight
+        records, while the results stay in order
+        """
+        backend = SlowBackend()
+        self.configure(backend=backend, batch_in_flight=3)
+        response = self.client.post("/batch", json=[{"first_name": "Shirley", "id": i} for i in range(9)])
+
+        results = response.json()["results"]
+        self.assertEqual(list(range(9)), [result["index"] for result in results])
+        self.assertEqual([200] * 9, [result["status"] for result in results])
+        self.assertGreater(backend.most_in_flight, 2)
+        self.assertLessEqual(backend.most_in_flight, 6)
+
+    def test_batch_window_flush(self):
+        """
+        Tests that in batched write_mode a batch only flushes the buffers its own records were added to, leaving a
+        buffer that another request's record is waiting in to fill up
+        """
+        self.configure(write_mode="batched", batch_max_latency=60, writers={})
+        self.addCleanup(lambda: [writer.close() for writer in main.writers.values()])
+        other = main.get_writer(main.output_folder).add("2000/01/01", b'{"first_name": "Bob"}')
+
+        response = self.client.post("/batch", json=[{"first_name": "Shirley"}, {"first_name": "Elise"}])
+
+        self.assertEqual([200, 200], [result["status"] for result in response.json()["results"]])
+        self.assertFalse(other.future.done())
+        self.assertNotIn(other.key, self.backend.objects)
+
+    def test_batch_raw_records(self):
+        """
+        Tests that each NDJSON line is archived exactly as it was sent, and that a record of a JSON array, which has no
+        raw bytes of its own, is archived encoded from its decoded form
+        """
+        lines = [b'{ "first_name" : "Shirley" }', b'{"other": 1.50}']
+        self.client.post("/batch", content=b"\n".join(lines), headers={"content-type": "application/x-ndjson"})
+        self.assertEqual(sorted(lines), sorted(self.raw_objects().values()))
+
+        self.backend.objects.clear()
+        records = [{"first_name": "Shirley", "zip_code": 1.5}, {"other": [1, {"a": None}]}]
+        self.client.post("/batch", json=records)
+        self.assertEqual(sorted(main.codec.dumps(record).encode("utf-8") for record in records),
+                         sorted(self.raw_objects().values()))
+
+    def test_batch_write_behind(self):
+        """
+        Tests that in write-behind mode stored records get 202, that a batch arriving while the write queue is full
+        gets a 429, and that records reached once it fills up partway through get a 429 of their own
+        """
+        release = threading.Event()
+        backend = storage.MemoryBackend()
+        backend.put = lambda *args: release.wait(10) and storage.MemoryBackend.put(backend, *args)
+        queue = storage.WriteBehindQueue(max_writes=3, workers=1, max_attempts=1)
+        self.addCleanup(queue.close)
+        self.addCleanup(release.set)
+        self.configure(backend=backend, write_behind=True, write_queue=queue, spool=None)
+
+        # the first record queues two writes and the second, with no fields, one, which fills the queue
+        response = self.client.post("/batch", json=[{"first_name": "Shirley"}, {"other": 1}, {"first_name": "Bob"}])
+        self.assertEqual([202, 400, 429], [result["status"] for result in response.json()["results"]])
+
+        response = self.client.post("/batch", json=[{"first_name": "Elise"}])
+        self.assertEqual(429, response.status_code)
+        self.assertEqual("1", response.headers["retry-after"])
+
+        release.set()
+        queue.close()
+        self.assertEqual(3, len(backend.objects))
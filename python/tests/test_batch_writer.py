@@ -0,0 +1,158 @@
+from unittest import TestCase, skipUnless
+import io
+import storage
+from compression import GzipCompressor
+from storage import BatchWriter, MemoryBackend, ParquetEncoder
+
+
+class FlakyBackend(MemoryBackend):
+    """
+    A memory backend whose writes can be made to fail
+    """
+    fail = False
+
+    def put(self, key, body, content_encoding=None):
+        if self.fail:
+            raise IOError("Storage is unavailable")
+        MemoryBackend.put(self, key, body, content_encoding)
+
+
+class TestBatchWriter(TestCase):
+
+    def setUp(self):
+        self.backend = FlakyBackend()
+
+    def make_writer(self, **kwargs):
+        settings = dict(max_records=3, max_bytes=1024, max_latency=60)
+        settings.update(kwargs)
+        writer = BatchWriter(self.backend, "parsed_data", **settings)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_batch_writer_flush_on_count(self):
+        """
+        Tests that a partition's buffer is written as one object once it reaches max_records
+        """
+        writer = self.make_writer()
+        locations = [writer.add("2020/10/01", b'{"n": %d}' % i) for i in range(3)]
+
+        key = locations[0].future.result(timeout=5)
+        self.assertEqual(b'{"n": 0}\n{"n": 1}\n{"n": 2}\n', self.backend.objects[key])
+        self.assertTrue(key.startswith("parsed_data/2020/10/01/"))
+        for location in locations:
+            body = self.backend.objects[location.key]
+            self.assertEqual(b'{"n": %d}' % locations.index(location),
+                             body[location.offset:location.offset + location.length])
+
+    def test_batch_writer_add_many(self):
+        """
+        Tests that records added together are written to the same object, even past max_records
+        """
+        writer = self.make_writer()
+        first = writer.add("2020/10/01", b'{"n": 0}')
+        locations = writer.add_many("2020/10/01", [b'{"n": %d}' % i for i in range(1, 4)])
+
+        key = first.future.result(timeout=5)
+        self.assertEqual({key}, {location.key for location in locations})
+        self.assertEqual(b'{"n": 0}\n{"n": 1}\n{"n": 2}\n{"n": 3}\n', self.backend.objects[key])
+        self.assertEqual([9, 18, 27], [location.offset for location in locations])
+
+    def test_batch_writer_flush_on_bytes(self):
+        """
+        Tests that a buffer is written once it passes max_bytes, even below max_records
+        """
+        writer = self.make_writer(max_bytes=10)
+        location = writer.add("2020/10/01", b'{"name": "Shirley"}')
+
+        self.assertEqual(location.key, location.future.result(timeout=5))
+
+    def test_batch_writer_flush_on_latency(self):
+        """
+        Tests that a partly filled buffer is written once max_latency has passed
+        """
+        writer = self.make_writer(max_latency=0.05)
+        location = writer.add("2020/10/01", b'{"n": 0}')
+
+        self.assertEqual(location.key, location.future.result(timeout=5))
+
+    def test_batch_writer_partitions(self):
+        """
+        Tests that records for different partitions are written to different objects
+        """
+        writer = self.make_writer()
+        first = writer.add("2020/10/01", b'{"n": 0}')
+        second = writer.add("2020/10/02", b'{"n": 1}')
+        writer.flush()
+
+        self.assertNotEqual(first.future.result(timeout=5), second.future.result(timeout=5))
+        self.assertEqual(2, len(self.backend.objects))
+
+    def test_batch_writer_flush_some(self):
+        """
+        Tests that flushing by future writes only the buffers those records were added to
+        """
+        writer = self.make_writer()
+        first = writer.add("2020/10/01", b'{"n": 0}')
+        second = writer.add("2020/10/02", b'{"n": 1}')
+        writer.flush({first.future})
+
+        self.assertEqual(first.key, first.future.result(timeout=5))
+        self.assertFalse(second.future.done())
+        self.assertEqual([first.key], list(self.backend.objects))
+
+    def test_batch_writer_close(self):
+        """
+        Tests that closing the writer writes out anything still buffered, and refuses new records
+        """
+        writer = self.make_writer()
+        location = writer.add("2020/10/01", b'{"n": 0}')
+        writer.close()
+
+        self.assertTrue(location.future.done())
+        self.assertIn(location.key, self.backend.objects)
+        with self.assertRaises(RuntimeError):
+            writer.add("2020/10/01", b'{"n": 1}')
+
+    def test_batch_writer_failure(self):
+        """
+        Tests that a failed write is reported to every record in the batch
+        """
+        self.backend.fail = True
+        writer = self.make_writer()
+        locations = [writer.add("2020/10/01", b'{"n": %d}' % i) for i in range(3)]
+
+        for location in locations:
+            with self.assertRaises(IOError):
+                location.future.result(timeout=5)
+
+    @skipUnless(storage.pyarrow, "pyarrow is not installed")
+    def test_batch_writer_parquet(self):
+        """
+        Tests that a Parquet batch holds one row per record, with string columns and nulls for empty values
+        """
+        writer = self.make_writer(encoder=ParquetEncoder(["first_name", "zip_code", "record_id"]))
+        records = [{"first_name": "Shirley", "zip_code": 12345, "record_id": "a"},
+                   {"first_name": "", "zip_code": "02134", "record_id": "b"}]
+        locations = [writer.add("2020/10/01", record) for record in records]
+        writer.flush()
+
+        key = locations[0].future.result(timeout=5)
+        self.assertTrue(key.endswith(".parquet"))
+        self.assertEqual([0, 1], [location.offset for location in locations])
+        table = storage.pyarrow.parquet.read_table(io.BytesIO(self.backend.objects[key]))
+        self.assertEqual([{"first_name": "Shirley", "zip_code": "12345", "record_id": "a"},
+                          {"first_name": None, "zip_code": "02134", "record_id": "b"}], table.to_pylist())
+
+    def test_batch_writer_compressed(self):
+        """
+        Tests that a compressed batch is stored with the compressor's extension, and that record offsets point into the
+        decompressed object
+        """
+        writer = self.make_writer(compressor=GzipCompressor(6))
+        locations = [writer.add("2020/10/01", b'{"n": %d}' % i) for i in range(3)]
+
+        key = locations[0].future.result(timeout=5)
+        self.assertTrue(key.endswith(".json.gz"))
+        body = self.backend.read(key)
+        self.assertEqual(b'{"n": 0}\n{"n": 1}\n{"n": 2}\n', body)
+        self.assertEqual(b'{"n": 2}', body[locations[2].offset:locations[2].offset + locations[2].length])
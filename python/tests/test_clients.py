@@ -0,0 +1,41 @@
+from unittest import TestCase
+import os
+import threading
+import clients
+
+
+class TestClients(TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        clients.reset_clients()
+
+    def tearDown(self):
+        clients.reset_clients()
+
+    def test_get_s3_client_shared(self):
+        """
+        Tests that every caller, on any thread, gets the same client, set up with the first caller's settings
+        """
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(clients.get_s3_client(max_pool_connections=7)))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(set(map(id, results))))
+        self.assertIs(results[0], clients.get_s3_client(max_pool_connections=3))
+        self.assertEqual(7, results[0].meta.config.max_pool_connections)
+
+    def test_reset_clients(self):
+        """
+        Tests that resetting the clients makes the next call create a new client with the new settings
+        """
+        first = clients.get_s3_client(read_timeout=10)
+        clients.reset_clients()
+        second = clients.get_s3_client(read_timeout=20)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(20, second.meta.config.read_timeout)
@@ -0,0 +1,246 @@
+from unittest import TestCase
+import shutil
+import tempfile
+import threading
+from fastapi.testclient import TestClient
+import main
+import pytest
+import storage
+
+
+@pytest.mark.usefixtures("main_settings")
+class TestItemRoute(TestCase):
+
+    def setUp(self):
+        self.backend = storage.MemoryBackend()
+        self.configure(backend=self.backend)
+        self.client = TestClient(main.app)
+
+    def test_streaming_invalid_json(self):
+        """
+        Tests that in streaming mode a body that isn't valid JSON after the fields are found, or in the parts that
+        aren't searched, gets a 422 and isn't stored, as it would if it were decoded
+        """
+        self.configure(streaming_extraction=True)
+        for body in [b'{"first_name": "Shirley"} trailing', b'{"first_name": "Shirley", "other": [1, 2,]}',
+                     b'{"other": {"list": [tru]}, "first_name": "Shirley"}', b'{"first_name": "Shirley"']:
+            response = self.client.post("/", content=body)
+            self.assertEqual(422, response.status_code, body)
+        self.assertEqual({}, self.backend.objects)
+
+        response = self.client.post("/", content=b'{"first_name": "Shirley", "other": [1, {"a": null}]}\n')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("Shirley", response.json()["data"]["first_name"])
+
+    def raw_objects(self):
+        """
+        :return: dict: the key and body of each raw object stored
+        """
+        return {key: body for key, body in self.backend.objects.items() if key.startswith(main.json_folder + "/")}
+
+    def test_raw_body_archived_as_sent(self):
+        """
+        Tests that the raw object stored for a request is the request body byte for byte, whether the body was
+        decoded or streamed, and whether or not any fields were found. A leading byte order mark is accepted either way
+        """
+        for streaming in [False, True]:
+            self.configure(streaming_extraction=streaming)
+            for body, status_code in [(b'{ "first_name" : "Shirley",\n\t"zip_code": 1.50 }', 200),
+                                      (b'{"other": "\\u00e9\xc3\xa9"}  ', 400),
+                                      (b'\xef\xbb\xbf{"first_name": "Shirley"}', 200)]:
+                self.backend.objects.clear()
+                response = self.client.post("/", content=body)
+
+                self.assertEqual(status_code, response.status_code)
+                self.assertEqual([body], list(self.raw_objects().values()))
+
+    def test_metrics_route(self):
+        """
+        Tests that the metrics route serves the Prometheus text format, counting each request by its status
+        """
+        def responses(status_code):
+            text = self.client.get("/metrics").text
+            line = 'ingest_responses_total{route="/",status="' + str(status_code) + '"} '
+            return sum(float(row[len(line):]) for row in text.splitlines() if row.startswith(line))
+
+        before = responses(200), responses(422)
+        self.client.post("/", json={"first_name": "Shirley"})
+        self.client.post("/", content=b'[1, 2]')
+        response = self.client.get("/metrics")
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        self.assertIn("# TYPE ingest_request_seconds histogram", response.text)
+        self.assertIn('ingest_stage_seconds_count{stage="parse_data"}', response.text)
+        self.assertEqual((before[0] + 1, before[1] + 1), (responses(200), responses(422)))
+
+    def test_process_pool_route(self):
+        """
+        Tests that a payload parsed in the process pool gets the same response as one parsed inline, that its raw
+        body is stored as sent, and that a body that isn't a JSON object still gets a 422
+        """
+        self.configure(process_workers=1, process_min_bytes=16, process_pool=None, process_slots=None)
+        self.addCleanup(lambda: main.process_pool and main.process_pool.shutdown())
+        body = b'{"person": {"first_name": "Shirley", "last_name": "Anne"}, "zip_code": 12345}'
+        response = self.client.post("/", content=body)
+
+        self.assertIsNotNone(main.process_pool)
+        self.assertEqual(200, response.status_code)
+        data = response.json()["data"]
+        self.assertEqual(["Shirley", "Anne", 12345], [data["first_name"], data["last_name"], data["zip_code"]])
+        self.assertEqual([body], list(self.raw_objects().values()))
+
+        for bad_body in [b'{"first_name": "Shirley"} trailing', b'["Shirley", "Anne", "Bob"]']:
+            self.assertEqual(422, self.client.post("/", content=bad_body).status_code)
+
+    def test_process_pool_broken(self):
+        """
+        Tests that a pool broken by a worker dying is shut down and dropped, and a new one made for the next request
+        """
+        self.configure(process_workers=1, process_min_bytes=16, process_pool=None, process_slots=None)
+        self.addCleanup(lambda: main.process_pool and main.process_pool.shutdown())
+        body = b'{"person": {"first_name": "Shirley", "last_name": "Anne"}, "zip_code": 12345}'
+        self.assertEqual(200, self.client.post("/", content=body).status_code)
+        broken = main.process_pool
+        for process in list(broken._processes.values()):
+            process.kill()
+            process.join()
+
+        client = TestClient(main.app, raise_server_exceptions=False)
+        self.assertEqual(500, client.post("/", content=body).status_code)
+        self.assertIsNot(broken, main.process_pool)
+        self.assertTrue(broken._shutdown_thread)
+        self.assertEqual(200, client.post("/", content=body).status_code)
+
+    def test_services_start_on_first_request(self):
+        """
+        Tests that the services a setting calls for are created when a request needs them, rather than when the
+        module is imported, which a process pool worker does too
+        """
+        self.configure(deduplicate=True, dedup_bloom_capacity=1000, deduplicator=None)
+        self.assertIsNone(main.deduplicator)
+
+        response = self.client.post("/", json={"first_name": "Shirley"})
+        self.assertEqual(200, response.status_code)
+        self.assertIsNotNone(main.deduplicator)
+        self.assertEqual(response.json(), self.client.post("/", json={"first_name": "Shirley"}).json())
+
+    def test_dedup_streaming_digest(self):
+        """
+        Tests that with streaming extraction on, a payload is still hashed in its decoded form, so that copies which
+        differ only in formatting, or that come in through /batch, are stored once under the same record ID
+        """
+        self.configure(streaming_extraction=True, deduplicate=True, dedup_bloom_capacity=1000, deduplicator=None)
+        first = self.client.post("/", content=b'{"first_name": "Shirley", "zip_code": 12345}')
+        second = self.client.post("/", content=b'{ "zip_code" : 12345,\n  "first_name" : "Shirley" }')
+        batch = self.client.post("/batch", json=[{"first_name": "Shirley", "zip_code": 12345}])
+
+        record_id = first.json()["data"]["record_id"]
+        self.assertEqual(record_id, second.json()["data"]["record_id"])
+        self.assertEqual(record_id, batch.json()["results"][0]["data"]["record_id"])
+        self.assertEqual(1, len(self.raw_objects()))
+
+    def test_lifespan(self):
+        """
+        Tests that the services start as the app starts, before any request, and are closed as it shuts down
+        """
+        self.configure(storage_workers=1, executor=None, deduplicate=True, dedup_bloom_capacity=1000,
+                       deduplicator=None)
+        with TestClient(main.app) as client:
+            self.assertIsNotNone(main.executor)
+            self.assertIsNotNone(main.deduplicator)
+            self.assertEqual(200, client.post("/", json={"first_name": "Shirley"}).status_code)
+
+        with self.assertRaises(RuntimeError):
+            main.executor.submit(print)
+
+    def blocked_write_queue(self, max_writes: int = 10):
+        """
+        Puts main in write-behind mode with a write queue whose writes wait until the returned event is set
+
+        :return: threading.Event: the event that lets the writes through
+        """
+        release = threading.Event()
+        backend = storage.MemoryBackend()
+        backend.put = lambda *args: release.wait(10) and storage.MemoryBackend.put(backend, *args)
+        queue = storage.WriteBehindQueue(max_writes=max_writes, workers=1, max_attempts=1)
+        self.addCleanup(queue.close)
+        self.addCleanup(release.set)
+        self.configure(backend=backend, write_behind=True, write_queue=queue, spool=None)
+        return release
+
+    def test_write_behind(self):
+        """
+        Tests that in write-behind mode a record gets 202 as soon as its writes are queued, and that a request arriving
+        while the write queue is full gets a 429 with a Retry-After, without anything being queued for it
+        """
+        release = self.blocked_write_queue(max_writes=2)
+
+        response = self.client.post("/", json={"first_name": "Shirley"})
+        self.assertEqual(202, response.status_code)
+        self.assertEqual("Shirley", response.json()["data"]["first_name"])
+        self.assertEqual(2, main.write_queue.depth())
+
+        response = self.client.post("/", json={"first_name": "Bob"})
+        self.assertEqual(429, response.status_code)
+        self.assertEqual("1", response.headers["retry-after"])
+        self.assertEqual(2, main.write_queue.depth())
+
+        release.set()
+        main.write_queue.close()
+        self.assertEqual(2, len(main.backend.objects))
+
+    def test_write_behind_closed(self):
+        """
+        Tests that in write-behind mode a request arriving once the write queue or the spool has been closed, as the
+        service shuts down, gets a 503 rather than failing
+        """
+        self.blocked_write_queue().set()
+        main.write_queue.close()
+        response = self.client.post("/", json={"first_name": "Shirley"})
+        self.assertEqual(503, response.status_code)
+        self.assertIn("retry-after", response.headers)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spool = main.Spool(directory)
+        spool.close()
+        self.blocked_write_queue().set()
+        self.configure(spool=spool)
+        self.assertEqual(503, self.client.post("/", json={"first_name": "Shirley"}).status_code)
+        self.assertEqual({}, main.backend.objects)
+
+    def test_default_depth_budget(self):
+        """
+        Tests that by default a payload nested hundreds of levels deep is searched as usual, and only one too deep for
+        the decoder is archived unsearched, with max_depth as the reason
+        """
+        for streaming in [False, True]:
+            self.configure(streaming_extraction=streaming)
+            body = b'{"a": ' * 500 + b'{"first_name": "Shirley"}' + b'}' * 500
+            response = self.client.post("/", content=body)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual("Shirley", response.json()["data"]["first_name"])
+
+        self.configure(streaming_extraction=False, codec=main.get_codec("stdlib"))
+        response = self.client.post("/", content=b'{"a": ' * 5000 + b'1' + b'}' * 5000)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("max_depth", response.json()["reason"])
+
+    def test_records_one_object(self):
+        """
+        Tests that in direct write_mode the rows parsed from a payload that holds many records are written as one
+        object under the payload ID, with a line for each row, as the Lambda writes them
+        """
+        self.configure(extract_records=True)
+        response = self.client.post("/", json={"people": [{"first_name": "Lisa", "last_name": "Doe"},
+                                                          {"first_name": "Steve", "last_name": "Doe"}]})
+
+        self.assertEqual(200, response.status_code)
+        body = response.json()
+        parsed_keys = self.backend.keys(main.output_folder + "/")
+        self.assertEqual(1, len(parsed_keys))
+        self.assertTrue(parsed_keys[0].endswith("/" + body["payload_id"] + ".json"))
+        lines = self.backend.objects[parsed_keys[0]].splitlines(keepends=True)
+        self.assertEqual([parsed_keys[0] + "#0", parsed_keys[0] + "#" + str(len(lines[0]))], body["paths"])
+        self.assertEqual(body["data"], [main.codec.loads(line) for line in lines])
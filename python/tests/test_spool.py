@@ -0,0 +1,198 @@
+from unittest import TestCase
+import collections
+import os
+import shutil
+import tempfile
+from fastapi.testclient import TestClient
+import main
+import pytest
+import storage
+from spool import Spool
+
+
+def spool_segments(directory):
+    """
+    :return: list: the path of each segment file under a spool directory, relative to it
+    """
+    return sorted(os.path.relpath(os.path.join(parent, name), directory) for parent, _, names in os.walk(directory)
+                  for name in names if name.endswith(".spool"))
+
+
+class TestSpool(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open_spool(self, **kwargs):
+        spool = Spool(self.directory, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def segments(self):
+        return spool_segments(self.directory)
+
+    def test_spool_recover(self):
+        """
+        Tests that records that were never acknowledged are recovered in order by the next spool over the directory,
+        and that acknowledged ones are not
+        """
+        spool = self.open_spool(segment_bytes=4096)
+        tickets = []
+        for i in range(5):
+            ticket, synced = spool.append(b"record %d" % i)
+            synced.result(timeout=5)
+            tickets.append(ticket)
+        spool.ack(tickets[0])
+        spool.close()
+
+        spool = self.open_spool()
+        recovered = spool.recover()
+        self.assertEqual([b"record %d" % i for i in range(1, 5)], [record for ticket, record in recovered])
+        self.assertEqual([], spool.recover())
+        for ticket, record in recovered:
+            spool.ack(ticket)
+        self.assertEqual([], self.segments())
+
+    def test_spool_segments(self):
+        """
+        Tests that a full segment is deleted once every record in it is acknowledged, that the segment being appended
+        to is kept until the spool is closed, and that a record larger than a segment gets one of its own
+        """
+        spool = self.open_spool(segment_bytes=64)
+        appended = [spool.append(b"x" * 20) for _ in range(4)]
+        ticket, synced = spool.append(b"y" * 200)
+        synced.result(timeout=5)
+        self.assertEqual(3, len(self.segments()))
+
+        for record_ticket, record_synced in appended:
+            spool.ack(record_ticket)
+        self.assertEqual(1, len(self.segments()))
+        spool.ack(ticket)
+        self.assertEqual(1, len(self.segments()))
+        spool.close()
+        self.assertEqual([], self.segments())
+
+    def test_spool_damaged_record(self):
+        """
+        Tests that recovery stops at a record whose checksum doesn't match, such as one torn by a crash
+        """
+        spool = self.open_spool(segment_bytes=4096, sync_delay=0)
+        for i in range(3):
+            spool.append(b"record %d" % i)[1].result(timeout=5)
+        spool.close()
+
+        path = os.path.join(self.directory, self.segments()[0])
+        with open(path, "r+b") as f:
+            data = f.read()
+            f.seek(data.index(b"record 1"))
+            f.write(b"R")
+
+        recovered = self.open_spool().recover()
+        self.assertEqual([b"record 0"], [record for ticket, record in recovered])
+
+    def test_spool_stray_files(self):
+        """
+        Tests that a file in the directory with the segment suffix but not a segment number is left alone, rather than
+        stopping the spool from starting
+        """
+        with open(os.path.join(self.directory, "notes.spool"), "wb") as f:
+            f.write(b"not a segment")
+        spool = self.open_spool(sync_delay=0)
+        spool.append(b"record 0")[1].result(timeout=5)
+        spool.close()
+
+        self.assertEqual([b"record 0"], [record for ticket, record in self.open_spool().recover()])
+        self.assertIn("notes.spool", os.listdir(self.directory))
+
+    def test_spool_shared_directory(self):
+        """
+        Tests that two spools sharing a directory, as the workers of one service do, never write over each other's
+        records, that neither recovers the records of the other while it's open, and that the next spool to start
+        recovers every record the two left, once
+        """
+        first = self.open_spool(sync_delay=0)
+        second = self.open_spool(sync_delay=0)
+        first.append(b"first 0")[1].result(timeout=5)
+        second.append(b"second 0")[1].result(timeout=5)
+        first.append(b"first 1")[1].result(timeout=5)
+
+        third = self.open_spool(sync_delay=0)
+        self.assertEqual([], third.recover())
+        third.close()
+        first.close()
+        second.close()
+
+        recovered = [record for ticket, record in self.open_spool().recover()]
+        self.assertEqual([b"first 0", b"first 1", b"second 0"], sorted(recovered))
+        self.assertEqual([], self.open_spool().recover())
+
+
+class CountingBackend(storage.MemoryBackend):
+    """
+    A memory backend that counts the writes to each key, and whose writes can be made to fail
+    """
+    fail = False
+
+    def __init__(self):
+        storage.MemoryBackend.__init__(self)
+        self.puts = collections.Counter()
+
+    def put(self, key, body, content_encoding=None):
+        if self.fail:
+            raise IOError("Storage is unavailable")
+        self.puts[key] += 1
+        storage.MemoryBackend.put(self, key, body, content_encoding)
+
+
+@pytest.mark.usefixtures("main_settings")
+class TestSpoolReplay(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.backend = CountingBackend()
+        self.configure(backend=self.backend, write_behind=True)
+
+    def start(self):
+        """
+        Gives main a new write queue and a spool over the test's directory, as a restart of the service would
+        """
+        queue = storage.WriteBehindQueue(workers=1, max_attempts=1)
+        spool = Spool(self.directory, sync_delay=0)
+        self.addCleanup(spool.close)
+        self.addCleanup(queue.close)
+        self.configure(write_queue=queue, spool=spool)
+        return queue, spool
+
+    def test_spool_record_encoding(self):
+        """
+        Tests that a write is read back from its spool record as it was spooled
+        """
+        record = main.encode_spool_record("raw_data/a.json", '{"a": 1}', True, False)
+        self.assertEqual(("raw_data/a.json", b'{"a": 1}', True, False), main.decode_spool_record(record))
+
+    def test_replay_spool(self):
+        """
+        Tests that writes spooled while storage was failing are made once each by the next run's replay, and that
+        their segments are deleted once they're stored
+        """
+        queue, spool = self.start()
+        self.backend.fail = True
+        client = TestClient(main.app)
+        responses = [client.post("/", json={"first_name": name}) for name in ["Shirley", "Bob"]]
+        self.assertEqual([202, 202], [response.status_code for response in responses])
+        queue.close()
+        spool.close()
+        self.assertEqual({}, self.backend.objects)
+
+        self.backend.fail = False
+        queue, spool = self.start()
+        main.replay_spool()
+        queue.close()
+
+        self.assertEqual(4, len(self.backend.objects))
+        self.assertEqual({1}, set(self.backend.puts.values()))
+        for response in responses:
+            self.assertIn(response.json()["path"], self.backend.objects)
+        self.assertEqual([], spool_segments(self.directory))
@@ -0,0 +1,55 @@
+from unittest import TestCase
+import io
+import os
+import shutil
+import tempfile
+import storage
+
+
+class TestStorageBackends(TestCase):
+
+    def make_local(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        return storage.LocalBackend(os.path.join(root, "bucket"))
+
+    def test_backends_round_trip(self):
+        """
+        Tests that the local and memory backends store str, bytes and file bodies, list them by prefix, and report
+        which keys exist
+        """
+        for backend in [self.make_local(), storage.MemoryBackend()]:
+            backend.put("raw_data/processed/2020/10/01/a.json", '{"first_name": "Shirley"}')
+            backend.put("raw_data/unprocessed/2020/10/01/b.json", b'{"x": 1}')
+            backend.put("parsed_data/2020/10/01/a.json", io.BytesIO(b'{"first_name": "Shirley"}'))
+            backend.put("parsed_data/2020/10/01/a.json", b'{"first_name": "Morning"}')
+
+            self.assertEqual(b'{"first_name": "Shirley"}', backend.get("raw_data/processed/2020/10/01/a.json"))
+            self.assertEqual(b'{"first_name": "Morning"}', backend.get("parsed_data/2020/10/01/a.json"))
+            self.assertEqual(["raw_data/processed/2020/10/01/a.json", "raw_data/unprocessed/2020/10/01/b.json"],
+                             backend.keys("raw_data/"))
+            self.assertEqual(3, len(backend.keys()))
+            self.assertTrue(backend.exists("parsed_data/2020/10/01/a.json"))
+            self.assertFalse(backend.exists("parsed_data/2020/10/01/missing.json"))
+            with self.assertRaises(KeyError):
+                backend.get("parsed_data/2020/10/01/missing.json")
+
+    def test_local_backend_layout(self):
+        """
+        Tests that the local backend lays files out at the key's path, and refuses keys outside its directory
+        """
+        backend = self.make_local()
+        backend.put("parsed_data/2020/10/01/a.json", b"{}")
+
+        self.assertTrue(os.path.isfile(os.path.join(backend.root, "parsed_data", "2020", "10", "01", "a.json")))
+        with self.assertRaises(ValueError):
+            backend.put("../outside.json", b"{}")
+
+    def test_open_backend(self):
+        """
+        Tests that backends are chosen by name, and that an unknown name is rejected
+        """
+        self.assertIsInstance(storage.open_backend("memory"), storage.MemoryBackend)
+        self.assertIsInstance(storage.open_backend("s3", "bucket", object()), storage.S3Backend)
+        with self.assertRaises(ValueError):
+            storage.open_backend("ftp")
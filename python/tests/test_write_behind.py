@@ -0,0 +1,88 @@
+from unittest import TestCase
+import threading
+from storage import WriteBehindQueue
+
+
+class TestWriteBehindQueue(TestCase):
+
+    def make_queue(self, **kwargs):
+        settings = dict(max_writes=3, max_bytes=1024, workers=2, max_attempts=3, retry_delay=0.01)
+        settings.update(kwargs)
+        queue = WriteBehindQueue(**settings)
+        self.addCleanup(queue.close)
+        return queue
+
+    def test_write_behind_drain(self):
+        """
+        Tests that queued writes are made in the background, and that their futures resolve once they're made
+        """
+        queue = self.make_queue()
+        written = []
+        futures = [queue.submit(lambda i=i: written.append(i)) for i in range(5)]
+
+        for future in futures:
+            self.assertIsNone(future.result(timeout=5))
+        self.assertEqual([0, 1, 2, 3, 4], sorted(written))
+        self.assertEqual(0, queue.depth())
+
+    def test_write_behind_retry(self):
+        """
+        Tests that a failed write is retried until it succeeds, and that one failing on every attempt reports the
+        last error
+        """
+        queue = self.make_queue()
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise IOError("Storage is unavailable")
+
+        self.assertIsNone(queue.submit(flaky).result(timeout=5))
+        self.assertEqual(3, len(attempts))
+
+        def broken():
+            raise IOError("Storage is unavailable")
+
+        with self.assertLogs(level="ERROR"), self.assertRaises(IOError):
+            queue.submit(broken).result(timeout=5)
+
+    def test_write_behind_full(self):
+        """
+        Tests that the queue is full once the unfinished writes reach max_writes or max_bytes, and that its depth and
+        lag count writes that are still being made
+        """
+        release = threading.Event()
+        queue = self.make_queue(max_bytes=100)
+        futures = [queue.submit(release.wait, 10) for _ in range(2)]
+        self.assertFalse(queue.full())
+        self.assertEqual(2, queue.depth())
+        self.assertGreater(queue.lag(), 0)
+
+        futures.append(queue.submit(release.wait, 10))
+        self.assertTrue(queue.full())
+        release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertFalse(queue.full())
+        self.assertEqual(0, queue.lag())
+
+        release.clear()
+        futures = [queue.submit(release.wait, 100)]
+        self.assertTrue(queue.full())
+        release.set()
+        futures[0].result(timeout=5)
+
+    def test_write_behind_close(self):
+        """
+        Tests that closing the queue makes every queued write, and refuses new ones
+        """
+        queue = self.make_queue(workers=1)
+        written = []
+        for i in range(10):
+            queue.submit(lambda i=i: written.append(i))
+        queue.close()
+
+        self.assertEqual(list(range(10)), written)
+        with self.assertRaises(RuntimeError):
+            queue.submit(lambda: None)
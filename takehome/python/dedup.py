@@ -0,0 +1,238 @@
+"""
+Duplicate detection for ingested payloads. Upstream retries and replays send the same payload many times, and each
+copy would otherwise be stored again under a new record ID.
+
+Each payload is identified by the SHA-256 of its canonical JSON form (keys sorted, no whitespace), so copies that only
+differ in formatting or key order are caught too. A Deduplicator remembers the response given for the most recent
+payloads in a bounded LRU cache, and answers a repeat of one of them without storing anything. Older payloads are
+tracked by a Bloom filter, which can say a payload is new for certain, but can only say it was probably stored before.
+A payload the filter has seen is checked against storage before its raw data is skipped, so a false positive costs
+one extra lookup, never a lost record. The filter can be saved to a file and loaded again, so it survives restarts.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where snapshots are saved without a lock
+    fcntl = None
+
+_snapshot_header = struct.Struct(">4sQI")  # magic, size in bits, number of hashes
+_snapshot_magic = b"BLM1"
+
+
+def payload_digest(data):
+    """
+    :param data: the decoded payload. Raw bytes aren't taken, since the same payload would get a different digest
+        depending on its formatting, and be stored once for each
+    :return: bytes: the SHA-256 digest of the payload's canonical form
+    """
+    data = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8", "surrogatepass")
+    return hashlib.sha256(data).digest()
+
+
+def digest_record_id(digest: bytes, index: int = None):
+    """
+    :param digest: a payload digest from payload_digest
+    :param index: for a payload that holds many records, the position of the record, so each gets its own ID
+    :return: str: the record ID for the payload, made from the first 128 bits of its digest, so every copy of a
+        payload gets the same ID
+    """
+    if index is not None:
+        digest = hashlib.sha256(digest + index.to_bytes(4, "big")).digest()
+    return str(uuid.UUID(bytes=digest[:16]))
+
+
+class BloomFilter:
+    """
+    A fixed size Bloom filter over payload digests. The bit positions are taken from the digest itself, which is
+    already uniformly distributed, so no further hashing is needed
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        """
+        :param capacity: the number of digests the filter is sized for
+        :param false_positive_rate: the chance, once capacity digests have been added, that a new digest is reported
+            as seen
+        """
+        size = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self._setup(size, max(1, int(round(size / capacity * math.log(2)))))
+
+    def _setup(self, size: int, hashes: int):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray((size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, digest: bytes):
+        first = int.from_bytes(digest[:8], "big")
+        step = int.from_bytes(digest[8:16], "big") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, digest: bytes):
+        with self._lock:
+            for position in self._positions(digest):
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest: bytes):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+    def save(self, path: str):
+        """
+        Writes the filter to a file, merged with the snapshot already there, so that processes sharing a snapshot, such
+        as the workers of one service, each add their payloads to it rather than replacing the others'. The merge and
+        the replace are made while holding a lock on [path].lock, and the filter is written through a temp file of its
+        own, so that a crash never leaves a partial snapshot
+        """
+        directory = os.path.dirname(path) or "."
+        with open(path + ".lock", "a+b") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                try:
+                    self.merge(BloomFilter.load(path))
+                except (OSError, ValueError, struct.error):
+                    logging.exception("Failed to merge the Bloom filter snapshot " + path + ", replacing it")
+            handle, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+            try:
+                with self._lock, os.fdopen(handle, "wb") as out:
+                    out.write(_snapshot_header.pack(_snapshot_magic, self.size, self.hashes))
+                    out.write(self.bits)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+    def merge(self, other):
+        """
+        Adds every digest in another filter of the same size to this one
+
+        :raises ValueError: if the other filter has a different size or number of hashes
+        """
+        if (other.size, other.hashes) != (self.size, self.hashes):
+            raise ValueError("Can't merge a Bloom filter of a different size")
+        with self._lock:
+            merged = int.from_bytes(self.bits, "little") | int.from_bytes(other.bits, "little")
+            self.bits[:] = merged.to_bytes(len(self.bits), "little")
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        :param path: a file written by save
+        :return: BloomFilter: the filter, with the size it was saved with
+        """
+        with open(path, "rb") as f:
+            magic, size, hashes = _snapshot_header.unpack(f.read(_snapshot_header.size))
+            if magic != _snapshot_magic:
+                raise ValueError(path + " is not a Bloom filter snapshot")
+            bloom = cls.__new__(cls)
+            bloom._setup(size, hashes)
+            bloom.bits[:] = f.read()
+        if len(bloom.bits) != (size + 7) // 8:
+            raise ValueError(path + " is truncated")
+        return bloom
+
+
+class Deduplicator:
+    """
+    Remembers the payloads that have been stored: the most recent in an LRU cache, along with whatever the caller
+    wants to answer a repeat with, and all of them in a Bloom filter
+    """
+
+    def __init__(self, cache_size: int, bloom_capacity: int, false_positive_rate: float, snapshot_path: str = None):
+        """
+        :param cache_size: the number of recent payloads to keep in the cache
+        :param bloom_capacity: the number of payloads the Bloom filter is sized for
+        :param false_positive_rate: the Bloom filter's false positive rate at capacity
+        :param snapshot_path: a file to load the Bloom filter from if it exists, and to save it to
+        """
+        self.cache_size = cache_size
+        self.snapshot_path = snapshot_path
+        self._cache = OrderedDict()  # digest -> the entry to answer a repeat with, least recently used first
+        self._lock = threading.Lock()
+        self.bloom = None
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                self.bloom = BloomFilter.load(snapshot_path)
+            except (OSError, ValueError, struct.error):
+                logging.exception("Failed to load the Bloom filter snapshot " + snapshot_path + ", starting empty")
+        if self.bloom is None:
+            self.bloom = BloomFilter(bloom_capacity, false_positive_rate)
+
+    def lookup(self, digest: bytes):
+        """
+        :param digest: the payload digest
+        :return: the entry remembered for the payload, or None if it isn't in the cache
+        """
+        with self._lock:
+            entry = self._cache.get(digest)
+            if entry is not None:
+                self._cache.move_to_end(digest)
+            return entry
+
+    def probably_stored(self, digest: bytes):
+        """
+        :return: bool: False if the payload has certainly never been stored, True if it probably has
+        """
+        return digest in self.bloom
+
+    def remember(self, digest: bytes, entry, pending: list = ()):
+        """
+        Caches the entry for the payload straight away, so that a repeat sent while the payload is still being stored
+        can wait on the same writes. The payload is only added to the Bloom filter once every pending write has
+        succeeded, and is forgotten if any of them fails.
+
+        :param digest: the payload digest
+        :param entry: what to answer a repeat of the payload with
+        :param pending: the futures of the payload's writes, if they haven't finished
+        """
+        with self._lock:
+            self._cache[digest] = entry
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        remaining = [len(pending)]
+        if not remaining[0]:
+            self.bloom.add(digest)
+            return
+
+        def finished(future):
+            if future.cancelled() or future.exception() is not None:
+                self.forget(digest, entry)
+                return
+            with self._lock:
+                remaining[0] -= 1
+                stored = remaining[0] == 0
+            if stored:
+                self.bloom.add(digest)
+
+        for future in pending:
+            future.add_done_callback(finished)
+
+    def forget(self, digest: bytes, entry=None):
+        """
+        Drops a payload from the cache, such as after its writes failed. It can't be removed from the Bloom filter,
+        which only holds payloads that were stored
+
+        :param digest: the payload digest
+        :param entry: only drop the payload if this is still the entry cached for it
+        """
+        with self._lock:
+            if entry is None or self._cache.get(digest) is entry:
+                self._cache.pop(digest, None)
+
+    def save(self):
+        """
+        Saves the Bloom filter to the snapshot file, if there is one
+        """
+        if self.snapshot_path:
+            self.bloom.save(self.snapshot_path)
@@ -0,0 +1,1246 @@
+"""
+Field extraction for the JSON ingest service. Walks an arbitrary JSON structure and pulls out the requested fields,
+following the "first instance wins" rules that find_field has always used. find_records instead finds every record in
+a payload that holds many, such as each person in a list of people.
+
+Fields are given either as a list of key names, which are matched exactly, or as a FieldMatcher compiled from a rule
+set, which matches each field by any of its aliases and can ignore case and separators. Either way, each dict key costs
+one hash lookup however many fields there are.
+"""
+import codecs
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import compress, repeat
+
+
+def field_value(value):
+    """
+    Normalizes a matched value the same way find_field always has, where a list resolves to its first element
+
+    :param value: the value stored under a matching key
+    :return: the value, or the first element if the value is a list (None for an empty list)
+    """
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+# characters left out of keys when matching ignores separators
+_separators = str.maketrans("", "", "_- .")
+
+_unseen = object()
+
+
+def normalize_key(key: str):
+    """
+    :return: str: the key in lower case, without underscores, hyphens, spaces or dots, so that zip_code, zipCode and
+        ZIP-CODE all normalize to zipcode
+    """
+    return key.lower().translate(_separators)
+
+
+class FieldMatcher:
+    """
+    A rule set compiled into one lookup table, from each alias of each field to the field it stands for.
+
+    With normalize off, keys must match a field name or alias exactly, and matching a key is a single dict lookup.
+    With normalize on, keys are compared after normalize_key. Each distinct key is normalized once and remembered,
+    up to memo_size keys, so matching a key that has been seen before is still a single dict lookup.
+    """
+
+    def __init__(self, rules: dict, normalize: bool = False, memo_size: int = 100000):
+        """
+        :param rules: field name -> a list of aliases for it. The field name always matches itself
+        :param normalize: match keys without regard to case or separators
+        :param memo_size: with normalize on, the number of distinct keys to remember the match for
+        :raises ValueError: if two fields share an alias
+        """
+        self.fields = list(rules)
+        self.normalize = normalize
+        self.memo_size = memo_size
+        self._table = {}  # alias (normalized if normalize is on) -> field
+        for field, aliases in rules.items():
+            for alias in [field] + list(aliases or []):
+                name = normalize_key(alias) if normalize else alias
+                if self._table.get(name, field) != field:
+                    raise ValueError("The alias " + repr(alias) + " is given for both " + repr(self._table[name]) +
+                                     " and " + repr(field))
+                self._table[name] = field
+        self._memo = {}  # key as sent -> field, or None for keys that match no field
+        self.match = self._match_normalized if normalize else self._table.get
+
+    @classmethod
+    def exact(cls, field_list):
+        """
+        :param field_list: the keys to search for
+        :return: FieldMatcher: a matcher for exactly those keys, with no aliases
+        """
+        return cls({field: [] for field in field_list})
+
+    def __getstate__(self):
+        # the memo and the bound match method are left out when a matcher is sent to a worker process
+        state = dict(self.__dict__, _memo={})
+        del state["match"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.match = self._match_normalized if self.normalize else self._table.get
+
+    def _match_normalized(self, key):
+        field = self._memo.get(key, _unseen)
+        if field is _unseen:
+            field = self._table.get(normalize_key(key)) if isinstance(key, str) else None
+            if len(self._memo) >= self.memo_size:
+                self._memo.clear()
+            self._memo[key] = field
+        return field
+
+
+def load_rules(path: str):
+    """
+    Compiles a rule set file. The file is JSON, holding the fields to extract in order, each with its aliases, and
+    whether matching ignores case and separators:
+        {"normalize": true, "fields": {"zip_code": ["zip", "postal_code"], "first_name": ["given_name"]}}
+
+    :param path: the rule set file
+    :return: FieldMatcher: the compiled rule set
+    :raises ValueError: if the file isn't a valid rule set
+    """
+    with open(path) as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict) or not isinstance(rules.get("fields"), dict) or not rules["fields"]:
+        raise ValueError(path + " must hold a JSON object with a non-empty \"fields\" object")
+    return FieldMatcher(rules["fields"], bool(rules.get("normalize", False)))
+
+
+class RuleFile:
+    """
+    A rule set file that's reloaded when it changes. The file's modification time is checked at most every
+    check_interval seconds, so the check costs nothing on most calls. A file that fails to load is logged and the
+    previous rule set is kept.
+    """
+
+    def __init__(self, path: str, check_interval: float = 5.0):
+        """
+        :param path: the rule set file, as read by load_rules
+        :param check_interval: the least time in seconds between checks for changes
+        :raises ValueError: if the file can't be loaded the first time
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._mtime = os.stat(path).st_mtime_ns
+        self.matcher = load_rules(path)
+        self._next_check = time.monotonic() + check_interval
+        self._lock = threading.Lock()
+
+    def current(self):
+        """
+        :return: FieldMatcher: the latest rule set, reloading it first if the file has changed
+        """
+        if time.monotonic() >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self._next_check = time.monotonic() + self.check_interval
+                self.reload()
+            finally:
+                self._lock.release()
+        return self.matcher
+
+    def reload(self, force: bool = False):
+        """
+        Reloads the rule set if the file has changed since it was last loaded
+
+        :param force: reload even if the file looks unchanged
+        :return: bool: whether a new rule set was loaded
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime and not force:
+                return False
+            self.matcher = load_rules(self.path)
+            self._mtime = mtime
+        except (OSError, ValueError):
+            logging.exception("Failed to reload the field rules from " + self.path + ", keeping the previous rules")
+            return False
+        logging.info("Reloaded the field rules from " + self.path + ": " + ", ".join(self.matcher.fields))
+        return True
+
+
+def _fields_and_match(field_list):
+    """
+    :return:
+        list: the field names
+        the function mapping a dict key to its field, or None to match keys to field names exactly
+    """
+    if isinstance(field_list, FieldMatcher):
+        return field_list.fields, field_list.match
+    return field_list, None
+
+
+def field_list_names(field_list):
+    """
+    :param field_list: a list of keys, or a FieldMatcher
+    :return: list: the names of the fields, in order
+    """
+    return _fields_and_match(field_list)[0]
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when searching a payload would cost more than its TraversalBudget allows
+    """
+
+    def __init__(self, limit: str, value: int):
+        """
+        :param limit: the budget that was exceeded: "max_depth", "max_nodes" or "max_bytes"
+        :param value: the budget's value, or None for a payload nested too deeply to decode or encode, with no
+            max_depth set
+        """
+        if value is None:
+            super().__init__("The payload is nested too deeply for the decoder")
+        else:
+            super().__init__("The payload exceeds the " + limit + " budget of " + str(value))
+        self.limit = limit
+        self.value = value
+
+    def __reduce__(self):
+        # so that it can be raised in a worker process and pickled back to the caller
+        return BudgetExceeded, (self.limit, self.value)
+
+
+class TraversalBudget:
+    """
+    Limits on the work searching one payload may cost, so that a hostile payload can't tie up a worker. Each search
+    raises BudgetExceeded as soon as it would go past a limit, rather than running on.
+
+    max_depth is the deepest level of nesting entered, counting the payload itself as level 1. max_nodes is the number
+    of dict keys and list items a search may visit. They're counted a whole dict or list at a time, as it's entered, so
+    the check costs one addition per container rather than per key. max_bytes is the size of the encoded payload, which
+    callers check with check_bytes before decoding it; the streaming extractor counts it as the bytes arrive.
+    """
+
+    def __init__(self, max_depth: int = None, max_nodes: int = None, max_bytes: int = None):
+        """
+        :param max_depth: the deepest level of nesting to enter, or None for no limit
+        :param max_nodes: the most keys and items to visit, or None for no limit
+        :param max_bytes: the largest payload in bytes, or None for no limit
+        """
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        # the limits as plain numbers, so that the checks in the walks never need to test for None
+        self.depth_limit = sys.maxsize if max_depth is None else max_depth
+        self.node_limit = sys.maxsize if max_nodes is None else max_nodes
+        self.byte_limit = sys.maxsize if max_bytes is None else max_bytes
+
+    def check_bytes(self, size: int):
+        """
+        :param size: the size of the payload in bytes
+        :raises BudgetExceeded: if it's over max_bytes
+        """
+        if size > self.byte_limit:
+            raise BudgetExceeded("max_bytes", self.max_bytes)
+
+
+unlimited = TraversalBudget()  # the budget used when none is given
+
+
+def find_fields(field_list, data: dict, budget: TraversalBudget = None):
+    """
+    Searches the provided data dict for every field in field_list in a single pass. Each node is visited at most once,
+    and the walk stops as soon as every field has been found.
+
+    Each field resolves to the first instance found in a depth-first walk of the nested dicts. An empty value inside a
+    nested dict is passed over in favour of a later instance, while an empty value at the top level is returned as-is,
+    matching find_field.
+
+    :param field_list: the keys to search for, or a FieldMatcher
+    :param data: the dictionary of data to search
+    :param budget: the limits on the search, or None for no limits
+    :return:
+        dict: a mapping of field name to the value found. Fields that were not found are left out
+    :raises BudgetExceeded: if the search goes past the budget
+    """
+    found = {}
+    fields, match = _fields_and_match(field_list)
+    if isinstance(data, dict) and fields:
+        _collect_fields(data, set(fields), found, True, match=match, budget=budget)
+    return found
+
+
+def _collect_fields(data: dict, wanted: set, found: dict, top: bool, path: tuple = (), trace: dict = None,
+                    match=None, budget: TraversalBudget = None):
+    """
+    Walks a dict for the wanted fields, descending into nested dicts. Results are written into found. The walk keeps
+    its own stack of the dicts it's in, rather than recursing, so deep nesting is bounded by the budget and not by
+    Python's recursion limit.
+
+    A match closes that field for the rest of its dict whether or not it has a value, which is what find_field's early
+    return does. Only a non-empty match (or any match at the top level) resolves the field for the whole walk. Once a
+    nested dict is done, the dict it's in carries on with the fields still open, and stops too if there are none.
+
+    When a trace dict is supplied, the key path of every match is appended to trace[field] in the order visited, and
+    trace[_depth_key] holds the deepest dict level entered. PathCache uses this to replay the walk later.
+
+    With a match function, each key is mapped to the field it stands for first, such as an alias to its field.
+    """
+    if match is not None:
+        return _collect_matched(data, wanted, found, top, path, trace, match, budget)
+    budget = budget or unlimited
+    depth_limit = budget.depth_limit
+    node_limit = budget.node_limit
+    nodes = len(data)
+    if nodes > node_limit:
+        raise BudgetExceeded("max_nodes", budget.max_nodes)
+    if trace is not None:
+        trace[_depth_key] = max(trace[_depth_key], len(path))
+
+    # the dict being walked is held in locals, and the stack holds the state of each dict it's nested in
+    stack = []
+    items = iter(data.items())
+    open_fields = set(wanted)
+    while True:
+        for k, v in items:
+            if k in open_fields:
+                open_fields.discard(k)
+                value = field_value(v)
+                if value or top:
+                    found[k] = value
+                if trace is not None:
+                    trace[k].append(path + (k,))
+                if not open_fields:
+                    break
+            if isinstance(v, dict):
+                if len(stack) + 1 >= depth_limit:
+                    raise BudgetExceeded("max_depth", budget.max_depth)
+                nodes += len(v)
+                if nodes > node_limit:
+                    raise BudgetExceeded("max_nodes", budget.max_nodes)
+                stack.append((items, open_fields, top, path))
+                items = iter(v.items())
+                open_fields = set(open_fields)
+                top = False
+                if trace is not None:
+                    path = path + (k,)
+                    trace[_depth_key] = max(trace[_depth_key], len(path))
+                break
+        else:
+            open_fields = None
+        if open_fields:  # descending into a nested dict
+            continue
+        # the dict is done, so the one it's in carries on with the fields still open, and stops too if there are none
+        while True:
+            if not stack:
+                return
+            items, open_fields, top, path = stack.pop()
+            open_fields.difference_update(found)
+            if open_fields:
+                break
+
+
+def _collect_matched(data: dict, wanted: set, found: dict, top: bool, path: tuple, trace: dict, match,
+                     budget: TraversalBudget):
+    """
+    The same walk as _collect_fields, mapping each key to its field with match. It's kept separate so that the
+    exact match walk doesn't pay for the extra step on every key
+    """
+    budget = budget or unlimited
+    depth_limit = budget.depth_limit
+    node_limit = budget.node_limit
+    nodes = len(data)
+    if nodes > node_limit:
+        raise BudgetExceeded("max_nodes", budget.max_nodes)
+    if trace is not None:
+        trace[_depth_key] = max(trace[_depth_key], len(path))
+
+    stack = []
+    items = iter(data.items())
+    open_fields = set(wanted)
+    while True:
+        for k, v in items:
+            field = match(k)
+            if field in open_fields:
+                open_fields.discard(field)
+                value = field_value(v)
+                if value or top:
+                    found[field] = value
+                if trace is not None:
+                    trace[field].append(path + (k,))
+                if not open_fields:
+                    break
+            if isinstance(v, dict):
+                if len(stack) + 1 >= depth_limit:
+                    raise BudgetExceeded("max_depth", budget.max_depth)
+                nodes += len(v)
+                if nodes > node_limit:
+                    raise BudgetExceeded("max_nodes", budget.max_nodes)
+                stack.append((items, open_fields, top, path))
+                items = iter(v.items())
+                open_fields = set(open_fields)
+                top = False
+                if trace is not None:
+                    path = path + (k,)
+                    trace[_depth_key] = max(trace[_depth_key], len(path))
+                break
+        else:
+            open_fields = None
+        if open_fields:
+            continue
+        while True:
+            if not stack:
+                return
+            items, open_fields, top, path = stack.pop()
+            open_fields.difference_update(found)
+            if open_fields:
+                break
+
+
+def find_records(field_list, data, min_fields: int = 2, budget: TraversalBudget = None):
+    """
+    Finds every record in a payload that holds many, such as each person in a list of people, in a single walk. Unlike
+    find_fields, the walk descends into lists as well as dicts.
+
+    A record is a dict that holds at least min_fields of the fields directly. Its fields resolve to its own keys first,
+    and then to the first non-empty instance in the dicts and lists nested in it, depth-first, where a nested dict that
+    is a record itself is left to its own record. A field still missing is taken from the nearest enclosing dict that
+    holds it directly, so the members of a household share its zip code, and a child its parent's last name.
+
+    If no dict holds enough fields, the whole payload is taken as one record, resolved as find_fields would, so a
+    payload with a single sparse person still gives a record.
+
+    :param field_list: the keys to search for, or a FieldMatcher
+    :param data: the payload to search, as a dict or a list
+    :param min_fields: the number of fields a dict must hold directly to be a record
+    :param budget: the limits on the search, or None for no limits
+    :return:
+        list: a mapping of field name to the value found for each record, in the order they appear in the payload.
+        Records that hold no non-empty field of their own are left out
+    :raises BudgetExceeded: if the search goes past the budget
+    """
+    fields, match = _fields_and_match(field_list)
+    if not fields or not isinstance(data, (dict, list)):
+        return []
+    records = []
+    _collect_records(data, set(fields), match, min_fields, records, budget or unlimited)
+    if not records:
+        found = find_fields(field_list, data, budget)
+        return [found] if any(found.values()) else []
+    results = []
+    for found, context in records:
+        if found:
+            for field, value in context.items():
+                found.setdefault(field, value)
+            results.append(found)
+    return results
+
+
+def _collect_records(data, wanted: set, match, min_fields: int, records: list, budget: TraversalBudget):
+    """
+    Walks a dict or list for records, as described for find_records, keeping its own stack of the containers it's in.
+    Each record found is appended to records as (found, context), and its inherited fields are filled in from the
+    context once the walk is done.
+
+    Each stack entry holds the containers still to visit below a node, the fields found so far for the record the node
+    lies within (None outside of any record), and the context: the non-empty fields held directly by the dicts
+    enclosing those containers, the nearest winning.
+    """
+    stack = []
+    nodes = 0
+    node, record, context = data, None, {}
+    while True:
+        if len(stack) >= budget.depth_limit:
+            raise BudgetExceeded("max_depth", budget.max_depth)
+        nodes += len(node)
+        if nodes > budget.node_limit:
+            raise BudgetExceeded("max_nodes", budget.max_nodes)
+
+        if isinstance(node, list):
+            stack.append((iter(node), record, context))
+        else:
+            direct = {}
+            children = []
+            for k, v in node.items():
+                field = match(k) if match is not None else k
+                if field in wanted and field not in direct:
+                    direct[field] = field_value(v)
+                if isinstance(v, (dict, list)):
+                    children.append(v)
+
+            if len(direct) >= min_fields:
+                record = {}
+                records.append((record, context))
+            values = {field: value for field, value in direct.items() if value}
+            if values:
+                if record is not None:
+                    for field, value in values.items():
+                        record.setdefault(field, value)
+                context = dict(context)
+                context.update(values)
+            stack.append((iter(children), record, context))
+
+        # move on to the next dict or list, climbing back up the stack as each container is finished
+        node = None
+        while stack:
+            children, record, context = stack[-1]
+            for child in children:
+                if isinstance(child, (dict, list)):
+                    node = child
+                    break
+            if node is not None:
+                break
+            stack.pop()
+        if node is None:
+            return
+
+
+_depth_key = object()  # trace entry holding the deepest dict level a traced walk entered
+
+
+def shape_fingerprint(data: dict, depth: int, budget: TraversalBudget = None):
+    """
+    Builds a hashable fingerprint of a dict's key structure: for each dict in the first depth levels, breadth first,
+    its keys in order and which of its values are dicts. Those are the dicts described next, and dicts below the last
+    level are only marked as dicts. The keys and marks of each dict are gathered by C calls rather than a Python loop
+    over its items, so a fingerprint costs less than a walk over the same keys.
+
+    :param data: the dictionary to fingerprint
+    :param depth: the number of dict levels to describe
+    :param budget: the limits on the dicts described, which count towards max_nodes and max_depth as a walk's do
+    :return: tuple: the fingerprint
+    :raises BudgetExceeded: if the levels described go past the budget
+    """
+    budget = budget or unlimited
+    fingerprint = []
+    nodes = 0
+    level = [data]
+    for number in range(1, depth + 1):
+        if number > budget.depth_limit:
+            raise BudgetExceeded("max_depth", budget.max_depth)
+        nested = []
+        for node in level:
+            nodes += len(node)
+            if nodes > budget.node_limit:
+                raise BudgetExceeded("max_nodes", budget.max_nodes)
+            values = node.values()
+            is_dict = tuple(map(isinstance, values, repeat(dict)))
+            fingerprint.append(tuple(node))
+            fingerprint.append(is_dict)
+            if number < depth and True in is_dict:
+                nested.extend(compress(values, is_dict))
+        if not nested:
+            break
+        level = nested
+    return tuple(fingerprint)
+
+
+class PathCache:
+    """
+    A bounded LRU cache that maps a payload's shape fingerprint to the key paths where each field was found in it.
+    Payloads with a known shape are resolved by direct lookups, and only unseen shapes fall back to the full walk.
+
+    Fingerprinting a payload costs about as much as walking it for the exact field names, so the cache only pays off
+    where the walk costs more per key, such as with a rule set that ignores case and separators, and where shapes
+    repeat. benchmarks/bench_path_cache.py measures both, and on the generated presets the cache is slower than a plain
+    walk for every rule set, which is why the services leave it off unless path_cache_size is set. Each entry is keyed
+    by the fields and the whole fingerprint, so two shapes are only treated as the same if their keys are identical.
+
+    A shape is only cached if the walk never entered a dict below the fingerprinted levels, so the fingerprint covers
+    every key the walk could have matched. Every match along the way is stored, not just the winner, because an empty
+    value is passed over at one point and a later instance used. On a hit, each stored path is looked up in turn and the
+    same rules are applied. If a stored path has disappeared, or the old winner is now empty, the walk is rerun.
+    """
+
+    def __init__(self, max_size: int = 256, depth: int = 3):
+        """
+        :param max_size: the number of shapes to keep before evicting the least recently used
+        :param depth: the number of dict levels to include in each shape fingerprint
+        """
+        self.max_size = max_size
+        self.depth = depth
+        self.hits = 0  # lookups answered from a cached shape
+        self.misses = 0  # lookups that needed a full walk
+        self.evictions = 0  # shapes dropped to stay within max_size
+        self.stale = 0  # cached shapes whose paths no longer resolved, and were walked instead
+        self._entries = OrderedDict()  # (the fields, the shape fingerprint) -> their paths, or None
+        self._lock = threading.Lock()
+
+    def find_fields(self, field_list, data: dict, budget: TraversalBudget = None):
+        """
+        Equivalent to find_fields, using a cached key path lookup when the payload's shape has been seen before. The
+        budget applies to the fingerprint and to walks, while a cached lookup only follows the stored paths
+
+        :param field_list: the keys to search for, or a FieldMatcher
+        :param data: the dictionary of data to search
+        :param budget: the limits on fingerprinting and walking the payload, or None for no limits
+        :return:
+            dict: a mapping of field name to the value found. Fields that were not found are left out
+        :raises BudgetExceeded: if the fingerprint or a walk goes past the budget
+        """
+        fields, match = _fields_and_match(field_list)
+        if not isinstance(data, dict) or not fields:
+            return find_fields(field_list, data, budget)
+
+        # a reloaded rule set is a new matcher, so shapes cached under the old rules are never used with the new ones.
+        # The matcher is kept with the entry, so that its id can't be reused by another while the entry is cached
+        searched = field_list if match else tuple(fields)
+        key = (searched, shape_fingerprint(data, self.depth, budget))
+        with self._lock:
+            entry = self._entries.get(key, _missing)
+            if entry is not _missing:
+                self._entries.move_to_end(key)
+
+        if entry is not _missing:
+            if entry is None:  # seen before, but too deep to cache
+                with self._lock:
+                    self.misses += 1
+                return find_fields(field_list, data, budget)
+            found = _replay_paths(data, entry)
+            if found is not None:
+                with self._lock:
+                    self.hits += 1
+                return found
+            with self._lock:
+                self.stale += 1
+
+        # walk the payload, recording the path of every match
+        found = {}
+        trace = {field: [] for field in fields}
+        trace[_depth_key] = 0
+        _collect_fields(data, set(fields), found, True, (), trace, match, budget)
+        if trace.pop(_depth_key) < self.depth:
+            entry = {field: (tuple(paths), field in found) for field, paths in trace.items()}
+        else:
+            entry = None
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return found
+
+    def stats(self):
+        """
+        :return: dict: the cache counters and current size
+        """
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "stale": self.stale}
+
+    def clear(self):
+        """
+        Drops every cached shape, leaving the counters in place
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+_missing = object()
+
+
+def _replay_paths(data: dict, entry: dict):
+    """
+    Resolves each field from the key paths recorded by a traced walk of a payload with the same shape
+
+    :return: dict: the fields found, or None if the paths no longer give the same answer as a walk would
+    """
+    found = {}
+    for field, (paths, resolved) in entry.items():
+        for path in paths:
+            node = data
+            for k in path:
+                if not isinstance(node, dict) or k not in node:
+                    return None
+                node = node[k]
+            value = field_value(node)
+            if value or len(path) == 1:
+                found[field] = value
+                break
+        else:
+            if resolved:  # the old winner is now empty, so a walk would carry on past it
+                return None
+    return found
+
+
+# byte patterns used by the streaming extractor
+_whitespace = re.compile(rb'[ \t\n\r]*')
+_string_special = re.compile(rb'["\\]')
+_structural = re.compile(rb'["\[\]{}]')
+_scalar_end = re.compile(rb'[ \t\n\r,\]}:]')
+
+_QUOTE, _BACKSLASH, _LBRACE, _RBRACE, _LBRACKET, _RBRACKET, _COLON, _COMMA = b'"\\{}[]:,'
+
+
+def _leading_bom(buf: bytearray, eof: bool):
+    """
+    :return: the length of the UTF-8 byte order mark at the start of buf, which json.loads skips in bytes, 0 if there
+        isn't one, or None if buf is too short to tell yet
+    """
+    if buf.startswith(codecs.BOM_UTF8):
+        return len(codecs.BOM_UTF8)
+    if not eof and codecs.BOM_UTF8.startswith(bytes(buf)):
+        return None
+    return 0
+
+_OPEN = (_LBRACE, _LBRACKET)
+_NOT_A_VALUE = (_RBRACE, _RBRACKET, _COLON, _COMMA)
+
+# states of an object being searched by the streaming extractor
+_KEY_OR_END, _KEY, _COLON_NEXT, _VALUE, _COMMA_OR_END = range(5)
+
+
+class _SearchFrame:
+    """
+    An object the streaming extractor is currently searching, and the fields still open within it
+    """
+    __slots__ = ("open_fields", "top", "state", "key")
+
+    def __init__(self, open_fields: set, top: bool):
+        self.open_fields = open_fields
+        self.top = top
+        self.state = _KEY_OR_END
+        self.key = None
+
+
+class StreamingExtractor:
+    """
+    Pulls fields out of a JSON document as its raw bytes arrive, without building the document in memory. The result
+    is the same as running find_fields on the parsed document, and tokenizing stops as soon as every field is found.
+
+    Only the chain of objects currently being searched is held, along with the bytes of the current token and of any
+    matched value. Memory therefore depends on nesting depth rather than payload size. Values that can't contain a
+    match, such as lists and objects with no open fields, are skipped without decoding, and only the parts that are
+    actually searched are checked for valid syntax. A SyntaxChecker fed the same bytes checks the whole document.
+
+    One case can't match a parsed dict exactly: when a key repeats within the same object, json.loads keeps the last
+    value, but the extractor takes the first value without reading ahead.
+
+    With a budget, the bytes fed in count towards max_bytes, every key read in an object being searched counts towards
+    max_nodes, and the nesting of skipped values counts towards max_depth as well as that of the objects searched.
+
+    Usage:
+        extractor = StreamingExtractor(field_names)
+        for chunk in chunks:
+            if extractor.feed(chunk):
+                break
+        found = extractor.close()
+    """
+
+    def __init__(self, field_list, budget: TraversalBudget = None):
+        """
+        :param field_list: the keys to search for, or a FieldMatcher
+        :param budget: the limits on the search, or None for no limits
+        """
+        self.found = {}  # the fields resolved so far, as find_fields would return them
+        self.top_level = None  # "object", "array" or "scalar", once the first value in the document has been read
+        self.done = False  # set once every field is found or the document ends
+        fields, self._match = _fields_and_match(field_list)
+        self._wanted = set(fields)
+        self._buf = bytearray()
+        self._pos = 0
+        self._eof = False
+        self._frames = []
+        self._budget = budget or unlimited
+        self._bytes = 0
+        self._nodes = 0
+
+        # state of the value currently being skipped or captured
+        self._skipping = False
+        self._skip_frame = None
+        self._skip_rest = False  # skipping the remainder of an object with no open fields, rather than one value
+        self._skip_depth = 0
+        self._skip_started = False
+        self._in_string = False
+        self._capture_key = None  # set when the value is a match and needs to be decoded
+        self._capture_start = 0
+        self._bom_checked = False
+
+    def feed(self, chunk: bytes):
+        """
+        Tokenizes the next chunk of the document
+
+        :param chunk: the next bytes of the document
+        :return: bool: True once no more input is needed
+        :raises BudgetExceeded: if the document goes past the budget
+        """
+        if self.done or not chunk:
+            return self.done
+        self._bytes += len(chunk)
+        if self._bytes > self._budget.byte_limit:
+            raise BudgetExceeded("max_bytes", self._budget.max_bytes)
+        self._buf += chunk
+        self._run()
+        self._compact()
+        return self.done
+
+    def close(self):
+        """
+        Marks the end of the input, and returns the fields found
+
+        :return:
+            dict: a mapping of field name to the value found. Fields that were not found are left out
+        :raises ValueError: if the input ended before the document was complete, or isn't valid JSON
+        """
+        if not self.done:
+            self._eof = True
+            self._run()
+            if not self.done:
+                raise ValueError("Unexpected end of JSON input")
+        self._buf = bytearray()
+        return self.found
+
+    def _run(self):
+        if not self._bom_checked:
+            skip = _leading_bom(self._buf, self._eof)
+            if skip is None:
+                return
+            del self._buf[:skip]
+            self._bom_checked = True
+        while not self.done:
+            if self._skipping:
+                if not self._skip():
+                    return
+                self._end_skip()
+            elif not self._step():
+                return
+
+    def _step(self):
+        """
+        Consumes the next token of the object being searched. Returns False if more input is needed
+        """
+        buf = self._buf
+        pos = _whitespace.match(buf, self._pos).end()
+        self._pos = pos
+        if pos >= len(buf):
+            if self._eof and self.top_level is None:
+                raise ValueError("Expecting value")
+            return False
+        c = buf[pos]
+
+        if not self._frames:  # the start of the document
+            if c == _LBRACE:
+                self.top_level = "object"
+                self._pos = pos + 1
+                self._frames.append(_SearchFrame(set(self._wanted), True))
+                self.done = not self._wanted
+            else:
+                self.top_level = "array" if c == _LBRACKET else "scalar"
+                self.done = True
+            return True
+
+        frame = self._frames[-1]
+        state = frame.state
+        if state == _VALUE:
+            key = frame.key if self._match is None else self._match(frame.key)
+            frame.state = _COMMA_OR_END
+            if key in frame.open_fields:
+                self._start_skip(frame, key)
+            elif c == _LBRACE and frame.open_fields:
+                if len(self._frames) >= self._budget.depth_limit:
+                    raise BudgetExceeded("max_depth", self._budget.max_depth)
+                self._pos = pos + 1
+                self._frames.append(_SearchFrame(set(frame.open_fields), False))
+            else:
+                self._start_skip(frame, None)
+        elif state == _KEY_OR_END or state == _KEY:
+            if c == _QUOTE:
+                key = self._read_string(pos)
+                if key is None:
+                    return False
+                self._nodes += 1
+                if self._nodes > self._budget.node_limit:
+                    raise BudgetExceeded("max_nodes", self._budget.max_nodes)
+                frame.key = key
+                frame.state = _COLON_NEXT
+            elif c == _RBRACE and state == _KEY_OR_END:
+                self._pos = pos + 1
+                self._close_frame()
+            else:
+                raise ValueError("Expecting property name enclosed in double quotes")
+        elif state == _COLON_NEXT:
+            if c != _COLON:
+                raise ValueError("Expecting ':' delimiter")
+            self._pos = pos + 1
+            frame.state = _VALUE
+        else:
+            self._pos = pos + 1
+            if c == _COMMA:
+                frame.state = _KEY
+            elif c == _RBRACE:
+                self._close_frame()
+            else:
+                raise ValueError("Expecting ',' delimiter")
+        return True
+
+    def _read_string(self, pos: int):
+        """
+        Decodes the string starting at pos, or returns None if it isn't complete yet
+        """
+        buf = self._buf
+        i = pos + 1
+        escaped = False
+        while True:
+            m = _string_special.search(buf, i)
+            if m is None:
+                return None
+            if buf[m.start()] == _BACKSLASH:
+                escaped = True
+                i = m.end() + 1
+                continue
+            end = m.end()
+            break
+        self._pos = end
+        raw = bytes(buf[pos:end])
+        return json.loads(raw) if escaped else raw[1:-1].decode("utf-8")
+
+    def _start_skip(self, frame: _SearchFrame, capture_key):
+        self._skipping = True
+        self._skip_frame = frame
+        self._skip_rest = False
+        self._skip_depth = 0
+        self._skip_started = False
+        self._in_string = False
+        self._capture_key = capture_key
+        self._capture_start = self._pos
+
+    def _skip(self):
+        """
+        Advances past the value (or the rest of the object) being skipped. Returns False if more input is needed
+        """
+        buf = self._buf
+        n = len(buf)
+        pos = self._pos
+        depth = self._skip_depth
+        depth_limit = self._budget.depth_limit - len(self._frames)
+        while True:
+            if self._in_string:
+                m = _string_special.search(buf, pos)
+                if m is None:
+                    pos = n
+                    break
+                if buf[m.start()] == _BACKSLASH:
+                    if m.end() >= n:  # wait for the escaped character
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                    continue
+                pos = m.end()
+                self._in_string = False
+                if depth == 0:
+                    self._pos = pos
+                    return True
+            elif not self._skip_started:
+                if pos >= n:
+                    break
+                c = buf[pos]
+                if c == _QUOTE:
+                    self._in_string = True
+                    pos += 1
+                elif c in _OPEN:
+                    depth = 1
+                    if depth > depth_limit:
+                        raise BudgetExceeded("max_depth", self._budget.max_depth)
+                    pos += 1
+                elif c in _NOT_A_VALUE:
+                    raise ValueError("Expecting value")
+                else:
+                    m = _scalar_end.search(buf, pos)
+                    if m is None and not self._eof:  # the scalar may continue in the next chunk
+                        break
+                    self._pos = n if m is None else m.start()
+                    return True
+                self._skip_started = True
+            else:
+                m = _structural.search(buf, pos)
+                if m is None:
+                    pos = n
+                    break
+                pos = m.end()
+                c = buf[m.start()]
+                if c == _QUOTE:
+                    self._in_string = True
+                elif c in _OPEN:
+                    depth += 1
+                    if depth > depth_limit:
+                        raise BudgetExceeded("max_depth", self._budget.max_depth)
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        self._skip_depth = 0
+                        self._pos = pos
+                        return True
+        self._pos = pos
+        self._skip_depth = depth
+        return False
+
+    def _end_skip(self):
+        self._skipping = False
+        frame = self._skip_frame
+        self._skip_frame = None
+        if self._skip_rest:
+            self._close_frame()
+        elif self._capture_key is not None:
+            key = self._capture_key
+            self._capture_key = None
+            self._matched(frame, key, json.loads(bytes(self._buf[self._capture_start:self._pos])))
+
+    def _matched(self, frame: _SearchFrame, key: str, value):
+        """
+        Applies a matched value with the same rules as _collect_fields, searching it in memory if it's a dict
+        """
+        frame.open_fields.discard(key)
+        result = field_value(value)
+        if result or frame.top:
+            self.found[key] = result
+        if isinstance(value, dict) and frame.open_fields:
+            _collect_fields(value, frame.open_fields, self.found, False, match=self._match, budget=self._budget)
+            frame.open_fields.difference_update(self.found)
+        self._check(frame)
+
+    def _close_frame(self):
+        self._frames.pop()
+        if not self._frames:
+            self.done = True
+            return
+        parent = self._frames[-1]
+        parent.open_fields.difference_update(self.found)
+        self._check(parent)
+
+    def _check(self, frame: _SearchFrame):
+        """
+        Stops once every field is found, or skips the rest of the frame if it has no open fields left
+        """
+        if len(self.found) >= len(self._wanted):
+            self.done = True
+        elif not frame.open_fields:
+            self._start_skip(frame, None)
+            self._skip_rest = True
+            self._skip_started = True
+            self._skip_depth = 1
+
+    def _compact(self):
+        """
+        Drops the bytes that have been consumed, keeping any value still being captured
+        """
+        keep = self._capture_start if self._skipping and self._capture_key is not None else self._pos
+        if keep:
+            del self._buf[:keep]
+            self._pos -= keep
+            if self._skipping:
+                self._capture_start -= keep
+
+
+# byte patterns used by the syntax checker. The runs match many members of an object, or items of a list, whose values
+# are strings, numbers or literals in one call, and only containers and chunk boundaries are handled a token at a time
+_json_space = rb'[ \t\n\r]*'
+_json_string = rb'"[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*"'
+_json_number = rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?'
+_json_scalar = rb'(?:' + _json_string + rb'|' + _json_number + rb'|true|false|null|NaN|-?Infinity)'
+_first_member = re.compile(_json_space + _json_string + _json_space + rb':' + _json_space + _json_scalar +
+                           rb'(?=' + _json_space + rb'[,}])')
+_member_run = re.compile(rb'(?:' + _json_space + rb',' + _json_space + _json_string + _json_space + rb':' +
+                         _json_space + _json_scalar + rb'(?=' + _json_space + rb'[,}]))*')
+_first_item = re.compile(_json_space + _json_scalar + rb'(?=' + _json_space + rb'[,\]])')
+_item_run = re.compile(rb'(?:' + _json_space + rb',' + _json_space + _json_scalar + rb'(?=' + _json_space + rb'[,\]]))*')
+_string_body = re.compile(rb'[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*')
+_number = re.compile(_json_number)
+_number_chars = re.compile(rb'[-+.eE0-9]*')
+_literals = (b"true", b"false", b"null", b"NaN", b"Infinity", b"-Infinity")  # the json module accepts the last three
+
+# what the syntax checker expects next
+_EXPECT_VALUE, _EXPECT_VALUE_OR_CLOSE, _EXPECT_KEY, _EXPECT_KEY_OR_CLOSE, _EXPECT_COLON, _EXPECT_COMMA_OR_CLOSE, \
+    _EXPECT_END = range(7)
+
+
+class SyntaxChecker:
+    """
+    Checks that a JSON document is well formed as its raw bytes arrive, without decoding it, so that a body that was
+    only partly searched, such as by a StreamingExtractor that stopped once every field was found, is still rejected
+    if the json module would reject it. Tokens are matched with regular expressions and nothing but the kind of each
+    open container is kept, so memory depends on nesting depth rather than document size.
+
+    Usage:
+        checker = SyntaxChecker()
+        for chunk in chunks:
+            checker.feed(chunk)
+        checker.close()
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        self._offset = 0  # bytes dropped from the front of the buffer
+        self._eof = False
+        self._containers = bytearray()  # the brace or bracket of each open container
+        self._expect = _EXPECT_VALUE
+        self._in_string = False
+        self._utf8 = codecs.getincrementaldecoder("utf-8")("surrogatepass")
+        self._bom_checked = False
+
+    def feed(self, chunk: bytes):
+        """
+        Checks the next chunk of the document
+
+        :param chunk: the next bytes of the document
+        :raises ValueError: if the document isn't valid JSON
+        """
+        self._utf8.decode(chunk)
+        self._buf += chunk
+        self._run()
+        if self._pos:
+            del self._buf[:self._pos]
+            self._offset += self._pos
+            self._pos = 0
+
+    def close(self):
+        """
+        Marks the end of the input
+
+        :raises ValueError: if the input ended before the document was complete, or isn't valid JSON
+        """
+        self._utf8.decode(b"", True)
+        self._eof = True
+        self._run()
+        if self._expect != _EXPECT_END:
+            raise ValueError("Unexpected end of JSON input")
+        self._buf = bytearray()
+
+    def _error(self, message: str):
+        return ValueError(message + " at byte " + str(self._offset + self._pos))
+
+    def _run(self):
+        if not self._bom_checked:
+            skip = _leading_bom(self._buf, self._eof)
+            if skip is None:
+                return
+            del self._buf[:skip]
+            self._offset += skip
+            self._bom_checked = True
+        buf = self._buf
+        n = len(buf)
+        pos = self._pos
+        while True:
+            if self._in_string:
+                pos = _string_body.match(buf, pos).end()
+                if pos >= n or (buf[pos] == _BACKSLASH and n - pos < 6 and not self._eof):
+                    break  # the string or an escape in it continues in the next chunk
+                self._pos = pos
+                if buf[pos] != _QUOTE:
+                    raise self._error("Invalid control character or escape in string")
+                pos += 1
+                self._in_string = False
+                self._end_value(self._expect in (_EXPECT_KEY, _EXPECT_KEY_OR_CLOSE))
+                continue
+
+            expect = self._expect
+            if expect == _EXPECT_COMMA_OR_CLOSE:
+                pos = (_member_run if self._containers[-1] == _LBRACE else _item_run).match(buf, pos).end()
+            elif expect == _EXPECT_KEY_OR_CLOSE or expect == _EXPECT_VALUE_OR_CLOSE:
+                m = (_first_member if expect == _EXPECT_KEY_OR_CLOSE else _first_item).match(buf, pos)
+                if m:
+                    pos = m.end()
+                    self._expect = _EXPECT_COMMA_OR_CLOSE
+                    continue
+
+            pos = _whitespace.match(buf, pos).end()
+            if pos >= n:
+                break
+            self._pos = pos
+            c = buf[pos]
+            if expect == _EXPECT_END:
+                raise self._error("Extra data")
+            if c == _QUOTE:
+                if expect in (_EXPECT_COLON, _EXPECT_COMMA_OR_CLOSE):
+                    raise self._error("Expecting ':' delimiter" if expect == _EXPECT_COLON else
+                                      "Expecting ',' delimiter")
+                self._in_string = True
+                pos += 1
+            elif expect == _EXPECT_KEY or expect == _EXPECT_KEY_OR_CLOSE:
+                if c != _RBRACE or expect == _EXPECT_KEY:
+                    raise self._error("Expecting property name enclosed in double quotes")
+                pos += 1
+                self._close(_LBRACE)
+            elif expect == _EXPECT_COLON:
+                if c != _COLON:
+                    raise self._error("Expecting ':' delimiter")
+                pos += 1
+                self._expect = _EXPECT_VALUE
+            elif expect == _EXPECT_COMMA_OR_CLOSE:
+                pos += 1
+                if c == _COMMA:
+                    self._expect = _EXPECT_KEY if self._containers[-1] == _LBRACE else _EXPECT_VALUE
+                elif c == _RBRACE or c == _RBRACKET:
+                    self._close(_LBRACE if c == _RBRACE else _LBRACKET)
+                else:
+                    raise self._error("Expecting ',' delimiter")
+            elif c == _LBRACE or c == _LBRACKET:
+                pos += 1
+                self._containers.append(c)
+                self._expect = _EXPECT_KEY_OR_CLOSE if c == _LBRACE else _EXPECT_VALUE_OR_CLOSE
+            elif c == _RBRACKET and expect == _EXPECT_VALUE_OR_CLOSE:
+                pos += 1
+                self._close(_LBRACKET)
+            else:
+                end = self._scalar_end(buf, pos, n)
+                if end is None:
+                    break
+                pos = end
+                self._end_value(False)
+        self._pos = pos
+
+    def _scalar_end(self, buf: bytearray, pos: int, n: int):
+        """
+        :return: the end of the number or literal starting at pos, or None if it may continue in the next chunk
+        :raises ValueError: if it isn't a number or a literal
+        """
+        for literal in _literals:
+            if buf.startswith(literal, pos):
+                return pos + len(literal)
+            if not self._eof and n - pos < len(literal) and literal.startswith(buf[pos:]):
+                return None
+        if not self._eof and _number_chars.match(buf, pos).end() >= n:
+            return None
+        m = _number.match(buf, pos)
+        if m is None:
+            raise self._error("Expecting value")
+        return m.end()
+
+    def _close(self, opener: int):
+        if self._containers.pop() != opener:
+            raise self._error("Mismatched closing bracket")
+        self._end_value(False)
+
+    def _end_value(self, key: bool):
+        if key:
+            self._expect = _EXPECT_COLON
+        elif self._containers:
+            self._expect = _EXPECT_COMMA_OR_CLOSE
+        else:
+            self._expect = _EXPECT_END
+
+
+def stream_fields(field_list, chunks, budget: TraversalBudget = None):
+    """
+    Runs a StreamingExtractor over an iterable of byte chunks, stopping once every field is found
+
+    :param field_list: the keys to search for, or a FieldMatcher
+    :param chunks: an iterable of bytes making up a JSON document
+    :param budget: the limits on the search, or None for no limits
+    :return:
+        dict: a mapping of field name to the value found. Fields that were not found are left out
+    :raises ValueError: if the document is incomplete or isn't valid JSON
+    :raises BudgetExceeded: if the document goes past the budget
+    """
+    extractor = StreamingExtractor(field_list, budget)
+    for chunk in chunks:
+        if extractor.feed(chunk):
+            break
+    return extractor.close()
@@ -0,0 +1,260 @@
+"""
+Lightweight request metrics. Each request collects its measurements in a RequestMetrics: how long each stage took,
+the payload size, how many fields were found, and the status it ended with. The service adds them to the histograms
+and counters of a ServiceMetrics, which renders them in the Prometheus text format for its /metrics route. The Lambda
+has no route to scrape, so it prints each invocation's measurements as a CloudWatch embedded metric format (EMF) log
+line instead, which CloudWatch turns into metrics as the logs arrive.
+
+Recording a stage costs two perf_counter calls and a dict store, and adding a finished request to the histograms
+takes one short lock per metric, so the hot path stays cheap.
+"""
+import bisect
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+# histogram bucket upper bounds
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class _StageTimer:
+    __slots__ = ("stages", "name", "start")
+
+    def __init__(self, stages: dict, name: str):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.stages[self.name] = self.stages.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class RequestMetrics:
+    """
+    The measurements of one request. Stages can be timed from any thread, such as the storage executor's
+    """
+    __slots__ = ("stages", "payload_bytes", "fields_found", "status", "dedup", "over_budget", "started")
+
+    def __init__(self):
+        self.stages = {}  # stage name -> seconds spent in it
+        self.payload_bytes = None
+        self.fields_found = None
+        self.status = None
+        self.dedup = None  # what duplicate detection found: new, cached, stored or false_positive
+        self.over_budget = None  # the traversal budget the payload exceeded, if it was archived without being searched
+        self.started = time.perf_counter()
+
+    def stage(self, name: str):
+        """
+        :param name: the name of the stage, such as parse_data or write_raw
+        :return: a context manager that adds the time spent inside it to the stage
+        """
+        return _StageTimer(self.stages, name)
+
+    def total(self):
+        """
+        :return: float: the seconds since the request started
+        """
+        return time.perf_counter() - self.started
+
+
+class Histogram:
+    """
+    A Prometheus histogram, with a series for each set of label values
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.label_names = label_names
+        self._series = {}  # label values -> [bucket counts..., sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            cumulative = 0
+            for edge, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(self.name + "_bucket" + _labels(self.label_names + ("le",), labels + (_number(edge),)) +
+                             " " + str(cumulative))
+            lines.append(self.name + "_sum" + _labels(self.label_names, labels) + " " + _number(values[-1]))
+            lines.append(self.name + "_count" + _labels(self.label_names, labels) + " " + str(cumulative))
+        return lines
+
+
+class Counter:
+    """
+    A Prometheus counter, or a gauge if kind is "gauge", with a series for each set of label values
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), kind: str = "counter"):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.kind = kind
+        self._series = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        return [self.name + _labels(self.label_names, labels) + " " + _number(value) for labels, value in series]
+
+
+def _labels(names: tuple, values: tuple):
+    if not names:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for name, value in zip(names, values)) + "}"
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class ServiceMetrics:
+    """
+    The service's metrics, built up from the RequestMetrics of every request
+    """
+
+    def __init__(self, prefix: str = "ingest"):
+        """
+        :param prefix: the prefix for every metric name
+        """
+        self.stage_seconds = Histogram(prefix + "_stage_seconds", "Time spent in each stage of a request",
+                                       latency_buckets, ("stage",))
+        self.request_seconds = Histogram(prefix + "_request_seconds", "Time taken by each request, by route",
+                                         latency_buckets, ("route",))
+        self.payload_bytes = Histogram(prefix + "_payload_bytes", "Size of each request payload", size_buckets)
+        self.fields_found = Histogram(prefix + "_fields_found", "Number of fields found in each payload",
+                                      (0, 1, 2, 3, 4, 6, 8))
+        self.responses = Counter(prefix + "_responses_total", "Records handled, by route and status",
+                                 ("route", "status"))
+        self.in_flight = Counter(prefix + "_requests_in_flight", "Requests being handled right now", kind="gauge")
+        # new, cached (a repeat answered from the cache), stored (a repeat found in storage) or false_positive (a
+        # new payload the Bloom filter mistook for a repeat)
+        self.dedup = Counter(prefix + "_dedup_total", "Payloads checked for duplicates, by result", ("result",))
+        self.over_budget = Counter(prefix + "_over_budget_total",
+                                   "Payloads archived without being searched, by the budget they exceeded", ("limit",))
+        self.process_pool = Counter(prefix + "_process_pool_pending",
+                                    "Payloads queued for or being parsed in the process pool", kind="gauge")
+        self.write_queue = Counter(prefix + "_write_queue_depth", "Writes queued or being made in write-behind mode",
+                                   kind="gauge")
+        self.write_lag = Histogram(prefix + "_write_lag_seconds",
+                                   "Time from a write being queued in write-behind mode to it being stored, or failing",
+                                   latency_buckets + (10.0, 30.0, 60.0))
+        self.write_failures = Counter(prefix + "_write_failures_total",
+                                      "Queued writes that failed on every attempt in write-behind mode")
+        self.metrics = [self.stage_seconds, self.request_seconds, self.payload_bytes, self.fields_found,
+                        self.responses, self.in_flight, self.dedup, self.over_budget, self.process_pool,
+                        self.write_queue, self.write_lag, self.write_failures]
+
+    def started(self):
+        """
+        Counts a request as in flight, and returns the RequestMetrics to collect its measurements in
+        """
+        self.in_flight.inc(1)
+        return RequestMetrics()
+
+    def finished(self, request: RequestMetrics, route: str):
+        """
+        Adds a finished request's time and stage times to the metrics, and counts it as no longer in flight. The
+        record it held is added separately, with record
+        """
+        self.in_flight.inc(-1)
+        self.request_seconds.observe(request.total(), route)
+        for stage, seconds in list(request.stages.items()):
+            self.stage_seconds.observe(seconds, stage)
+
+    def record(self, request: RequestMetrics, route: str):
+        """
+        Adds the payload size, fields found and status of one record, such as a record of a batch
+        """
+        if request.payload_bytes is not None:
+            self.payload_bytes.observe(request.payload_bytes)
+        if request.fields_found is not None:
+            self.fields_found.observe(request.fields_found)
+        self.responses.inc(1, route, request.status or 500)
+
+    def render(self):
+        """
+        :return: str: every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.description)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def emf_line(request: RequestMetrics, namespace: str, dimensions: dict):
+    """
+    Formats one request's measurements as a CloudWatch embedded metric format log line. Stage times are reported in
+    milliseconds, and the status is kept as a property so that log queries can filter on it.
+
+    :param request: the measurements of the request
+    :param namespace: the CloudWatch namespace to put the metrics in
+    :param dimensions: dimension name -> value, such as the function name
+    :return: str: the JSON log line
+    """
+    values = {}
+    units = []
+    for stage, seconds in list(request.stages.items()):
+        values[stage] = round(seconds * 1000, 3)
+        units.append({"Name": stage, "Unit": "Milliseconds"})
+    values["total"] = round(request.total() * 1000, 3)
+    units.append({"Name": "total", "Unit": "Milliseconds"})
+    if request.payload_bytes is not None:
+        values["payload_bytes"] = request.payload_bytes
+        units.append({"Name": "payload_bytes", "Unit": "Bytes"})
+    if request.fields_found is not None:
+        values["fields_found"] = request.fields_found
+        units.append({"Name": "fields_found", "Unit": "Count"})
+
+    record = {"_aws": {"Timestamp": int(time.time() * 1000),
+                       "CloudWatchMetrics": [{"Namespace": namespace, "Dimensions": [sorted(dimensions)],
+                                              "Metrics": units}]},
+              "status": request.status}
+    if request.dedup is not None:
+        record["dedup"] = request.dedup
+    if request.over_budget is not None:
+        record["over_budget"] = request.over_budget
+    record.update(dimensions)
+    record.update(values)
+    return json.dumps(record)
+
+
+def time_stage(request: RequestMetrics, name: str):
+    """
+    :param request: the measurements to add the stage to, or None to not time it
+    :param name: the name of the stage
+    :return: a context manager that times the stage
+    """
+    return request.stage(name) if request is not None else nullcontext()
@@ -3,11 +3,17 @@
 # JSON structure is unknown
 # Data needs to be partitioned for Glue/Athena
 
-import json
-import boto3
 import logging
 import datetime
 import uuid
+from clients import get_s3_client
+from codec import get_codec
+from compression import get_compressor
+from dedup import Deduplicator, digest_record_id, payload_digest
+from extract import BudgetExceeded, field_list_names, find_fields, find_records, PathCache, RuleFile, TraversalBudget
+from metrics import RequestMetrics, emf_line, time_stage
+from partitions import partition_format, shard_directory, time_ordered_id
+from storage import StorageBackend, open_backend
 
 ## ---- Configuration Variables ---- ##
 bucket_name = "kp-manifold-working-bucket" # The AWS bucket to store the data in
@@ -15,75 +21,214 @@ output_folder = "parsed_data" # The folder where the parsed results will be save
 
 json_folder = "raw_data" # The folder where the raw JSON will get saved. All valid JSON input is stored here
 field_names = ['zip_code','first_name', 'middle_name', 'last_name'] # the fields to extract in the parsed results
+field_rules_path = None # a JSON rule set of the fields to extract, with aliases and case-insensitive matching, used in place of field_names (see extract.load_rules)
+field_rules_check_interval = 5.0 # seconds between checks for changes to the field_rules_path file, which a warm container reloads
+
+extract_records = False # find every record in a payload, such as each person in a list of people, and write a parsed row for each
+record_min_fields = 2 # with extract_records, the number of fields an object must hold directly to count as a record
+payload_id_key = 'payload_id' # with extract_records, the key in each parsed row for the ID of the payload it came from, which its raw data is stored under
+
+budget_max_depth = None # the deepest nesting of objects searched in a payload. None, the default, only stops payloads nested too deeply for the decoder (about 1000 levels for the json module), since the search itself has no depth limit of its own. A payload over either budget is archived in unprocessed/ without being searched
+budget_max_nodes = 1000000 # the most object keys and list items searched in one payload. API Gateway already limits the payload size
+
+path_cache_size = 0 # the number of payload shapes to remember field paths for. 0, the default, disables the cache, which only pays off for some payloads and rule sets (see benchmarks/bench_path_cache.py)
+path_cache_depth = 3 # the number of nested levels of keys used to recognise a payload shape
+
+partition_style = "date" # "date" writes YYYY/MM/DD paths; "hive" writes year=YYYY/month=MM/day=DD, which Glue and Athena read as partition columns
+partition_by_hour = False # add an hour level below the day in the output paths
+key_shards = 0 # spread the objects in each date partition over this many hash-sharded prefixes below it, such as parsed_data/2020/10/01/07/, to get past S3's request rate limit per prefix. 0 writes them straight under the date. The Athena table needs the shard column too (python partitions.py --shards)
+
+s3_pool_connections = 10 # HTTP connections the shared S3 client keeps open for reuse across requests
+s3_connect_timeout = 5 # seconds to wait for a new S3 connection
+s3_read_timeout = 30 # seconds to wait for an S3 response
+s3_max_attempts = 3 # attempts per S3 request, including retries
+s3_endpoint_url = None # an alternative S3 endpoint, such as a local stand-in. None uses AWS
+
+storage_backend = "s3" # where objects are stored: "s3" writes to bucket_name, "local" to a directory, and "memory" keeps them in memory for tests and benchmarks
+local_storage_path = "output" # with the local storage_backend, the directory to store objects in, laid out like the bucket
+
+emit_metrics = True # print each invocation's stage timings as a CloudWatch embedded metric format log line
+metrics_namespace = "JsonIngest" # the CloudWatch namespace for those metrics
+
+raw_compression = "none" # compress the raw JSON archive: "none", "gzip", or "zstd" (needs zstandard). Compressed objects get a .gz or .zst extension and a Content-Encoding
+raw_compression_level = 6 # the compression level: 1 to 9 for gzip, 1 to 22 for zstd
+raw_compression_dictionary = None # a zstd dictionary file trained with compression.py, for better ratios on single records. Readers need the same file
+
+deduplicate = False # store each distinct payload once: a repeat is answered with the first copy's record, and raw data is stored under the payload's hash
+dedup_cache_size = 10000 # the number of recent payloads whose responses a warm container keeps to answer repeats with
+dedup_bloom_capacity = 1000000 # the number of payloads the Bloom filter tracks before its false positive rate rises
+dedup_false_positive_rate = 0.001 # the chance the Bloom filter takes a new payload for a repeat, which costs one storage lookup
+dedup_snapshot_path = None # a Bloom filter snapshot saved by the service, loaded when the container starts
+
+json_codec = "auto" # "stdlib", "orjson", or "auto" to use orjson when it's installed. Decoded values and encoded text always match the json module, so orjson only speeds up decoding
 
 ## -------- / Configuration ----------
 
 record_id_key = 'record_id' # identifier within the parsed results for each unique entry
 
-path_format = "%Y/%m/%d" # the dateTime format to use to create an output path to auto-partition for Athena
+path_format = partition_format(partition_style, partition_by_hour) # the dateTime format to use to create an output path to auto-partition for Athena
+
+path_cache = PathCache(path_cache_size, path_cache_depth) if path_cache_size else None # shared across requests
+
+traversal_budget = TraversalBudget(budget_max_depth, budget_max_nodes) # the limits on searching each payload
+
+field_rules = RuleFile(field_rules_path, field_rules_check_interval) if field_rules_path else None # the compiled rule set, reloaded when its file changes
+
+codec = get_codec(json_codec) # decodes and encodes JSON for every request
+
+raw_compressor = get_compressor(raw_compression, raw_compression_level, raw_compression_dictionary) # None when the raw archive isn't compressed
+
+deduplicator = Deduplicator(dedup_cache_size, dedup_bloom_capacity, dedup_false_positive_rate, dedup_snapshot_path) if deduplicate else None # the payloads this container has stored
+
+
+def get_fields():
+    """
+    :return: the fields to extract: the latest compiled rule set if there's a field_rules_path, or else field_names
+    """
+    return field_rules.current() if field_rules else field_names
+
+
+def get_s3():
+    """
+    :return: the S3 client shared by every request in this process, set up with the s3_ settings above
+    """
+    return get_s3_client(s3_pool_connections, s3_connect_timeout, s3_read_timeout, s3_max_attempts, s3_endpoint_url)
+
+
+backend = None # the StorageBackend chosen by storage_backend, created on first use
 
 
-def save_json(raw_data: dict, path: str, record_id: uuid.UUID, s3: boto3.client):
+def get_backend():
+    """
+    :return: StorageBackend: the storage backend shared by every request in this process, chosen by storage_backend
+    """
+    global backend
+    if backend is None:
+        backend = open_backend(storage_backend, bucket_name, get_s3() if storage_backend == "s3" else None,
+                               local_storage_path)
+    return backend
+
+
+def save_json(raw_data: dict, path: str, record_id: uuid.UUID, backend: StorageBackend, metrics: RequestMetrics = None,
+              if_absent: bool = False):
     """
     Save the JSON data off to a file for future review
 
     :param raw_data: a dict representing the raw JSON data
-    :param path: the path to save the data to. Data will be stored at [json_folder]/[path]/[record_id].json
+    :param path: the path to save the data to. Data will be stored at [json_folder]/[path]/[shard]/[record_id].json,
+        with the raw_compression extension added if it's compressed. The shard level is only added with key_shards
     :param record_id: a UUID to represent this record, tied to the parsed data
-    :param s3: the S3 instance to write the data to
+    :param backend: the storage backend to write the data to
+    :param metrics: the measurements of the invocation, to time the encoding and the write in
+    :param if_absent: only write the data if it isn't stored already
     :return the path that the data is saved to
     """
-    file_name = record_id + ".json"
-    lambda_path = json_folder + "/" + path + "/" + file_name
+    file_name = record_id + ".json" + (raw_compressor.extension if raw_compressor else "")
+    lambda_path = json_folder + "/" + path + shard_directory(record_id, key_shards, partition_style) + "/" + file_name
+    if if_absent:
+        with time_stage(metrics, "dedup_lookup"):
+            stored = backend.exists(lambda_path)
+        if metrics:
+            metrics.dedup = "stored" if stored else "false_positive"
+        if stored:
+            return lambda_path
     logging.info("Writing raw json data to " + lambda_path)
 
     # write the json to the file
-    s3.put_object(Bucket=bucket_name,
-                  Key=lambda_path,
-                  Body=json.dumps(raw_data))
+    with time_stage(metrics, "serialize_raw"):
+        body = codec.dumps(raw_data)
+    if metrics:
+        metrics.payload_bytes = len(body)
+    if raw_compressor:
+        with time_stage(metrics, "compress"):
+            body = raw_compressor.compress(body)
+    with time_stage(metrics, "write_raw"):
+        backend.put(lambda_path, body, raw_compressor.encoding if raw_compressor else None)
 
     return lambda_path
 
 
-def save_data(data_dict: dict, path:str, s3: boto3.client):
+def save_data(data_dict: dict, path:str, backend: StorageBackend, metrics: RequestMetrics = None):
     """
     Saves the provided data_dict off on S3
 
     :param data_dict: a dict representing the data to save off, which must contain an entry for [record_id_key]
-    :param path: the path to save the data to. Data will be stored at [json_folder]/[path]/[record_id].json. Record ID is pulled from the data_dict
-    :param s3: the S3 instance to write the data to
+    :param path: the path to save the data to. Data will be stored at [output_folder]/[path]/[shard]/[record_id].json, where the shard level is only added with key_shards. Record ID is pulled from the data_dict
+    :param backend: the storage backend to write the data to
+    :param metrics: the measurements of the invocation, to time the encoding and the write in
     :return: the path that the data is saved to
     """
     file_name = data_dict[record_id_key]  + ".json"
-    full_path = output_folder + "/" + path + "/" + file_name
+    shard = shard_directory(data_dict[record_id_key], key_shards, partition_style)
+    full_path = output_folder + "/" + path + shard + "/" + file_name
     logging.info("Writing processed data to" + full_path)
     logging.debug("Writing data: " + repr(data_dict))
 
     # write the json to the file
-    s3.put_object(Bucket=bucket_name,
-                  Key=full_path,
-                  Body=json.dumps(data_dict))
+    with time_stage(metrics, "serialize_parsed"):
+        body = codec.dumps(data_dict)
+    with time_stage(metrics, "write_parsed"):
+        backend.put(full_path, body)
 
     return full_path
 
 
+def save_rows(rows: list, path: str, payload_id: str, backend: StorageBackend, metrics: RequestMetrics = None):
+    """
+    Saves the parsed rows of a payload that holds many records as one object, with one row per line, so that the
+    payload costs one write however many records it holds
+
+    :param rows: the parsed rows, each of which must contain an entry for [record_id_key]
+    :param path: the path to save the rows to. They will be stored at [output_folder]/[path]/[shard]/[payload_id].json,
+        where the shard level is only added with key_shards
+    :param payload_id: the ID of the payload the rows came from
+    :param backend: the storage backend to write the data to
+    :param metrics: the measurements of the invocation, to time the encoding and the write in
+    :return: list: the path of each row, which is the object key with the byte offset of the row's line appended as a
+        fragment, as the service gives for rows it writes in batches
+    """
+    full_path = (output_folder + "/" + path + shard_directory(payload_id, key_shards, partition_style) + "/" +
+                 payload_id + ".json")
+    logging.info("Writing " + str(len(rows)) + " processed rows to " + full_path)
+
+    with time_stage(metrics, "serialize_parsed"):
+        lines = [codec.dumps(row).encode("utf-8") for row in rows]
+    paths = []
+    offset = 0
+    for line in lines:
+        paths.append(full_path + "#" + str(offset))
+        offset += len(line) + 1
+    with time_stage(metrics, "write_parsed"):
+        backend.put(full_path, b"\n".join(lines) + b"\n")
+
+    return paths
+
+
 def parse_data(data: dict):
     """
-    Parses a supplied dictionary to find the fields as specified in field_names
+    Parses a supplied dictionary to find the fields as specified in field_names, or in the field rule set
 
     :param data:
         the dictionary to parse
     :return:
         int: a count of the number of fields found from field_names
         dict: a dictionary containing the parsed data
+    :raises BudgetExceeded: if searching the data goes past the traversal budget
     """
+    fields = get_fields()
+    names = field_list_names(fields)
+
     # create the output data dict
-    output_dict = dict.fromkeys(field_names, "")
+    output_dict = dict.fromkeys(names, "")
     res_count = 0  # count the number of fields we find
 
-    # search the data
-    for field in field_names:
-        results = find_field(field, data)
+    # search the data for every field in one pass, skipping the walk for payload shapes we've seen before
+    if path_cache:
+        found = path_cache.find_fields(fields, data, traversal_budget)
+    else:
+        found = find_fields(fields, data, traversal_budget)
+    for field in names:
+        results = found.get(field)
         if not results:
             results = ""
         output_dict[field] = results
@@ -91,12 +236,34 @@ def parse_data(data: dict):
             res_count += 1
 
     # generate an ID to map the raw data to
-    record_id = str(uuid.uuid4())
+    record_id = time_ordered_id()
     output_dict[record_id_key] = record_id
 
     return res_count, output_dict
 
 
+def parse_records(data: dict):
+    """
+    Parses a supplied dictionary that may hold many records, such as a list of people, into a parsed row for each
+
+    :param data: the dictionary to parse
+    :return:
+        int: the number of fields found across every row
+        list: the parsed rows, each with its own record ID
+    :raises BudgetExceeded: if searching the data goes past the traversal budget
+    """
+    fields = get_fields()
+    names = field_list_names(fields)
+    res_count = 0
+    rows = []
+    for found in find_records(fields, data, record_min_fields, traversal_budget):
+        row = {field: found.get(field) or "" for field in names}
+        res_count += sum(1 for field in names if row[field])
+        row[record_id_key] = time_ordered_id()
+        rows.append(row)
+    return res_count, rows
+
+
 def find_field(field_name: str, data: dict):
     """
     Recursively searches the provided data dict to find the given field name. Returns the first instance found
@@ -106,17 +273,7 @@ def find_field(field_name: str, data: dict):
     :return:
         str: the resulting value, or None if not found
     """
-    if isinstance(data, dict): # if the data supplied is iterable, iterate on it
-        for k,v in data.items():
-            if k == field_name: # if we've found our key, return the value
-                if isinstance(v, list):
-                    return v[0]
-                else:
-                    return v
-            if isinstance(v, dict): # if our value is another dict, recurse, and return the recursion results
-                result = find_field(field_name, v)
-                if result:
-                    return result
+    return find_fields([field_name], data).get(field_name)
 
 
 def lambda_handler(event, context):
@@ -127,39 +284,172 @@ def lambda_handler(event, context):
     through the input to find the first_name, middle_name, last_name, and zip_code keys, which it then saves off to S3,
     along with the raw data for future analysis. If it finds even one of the fields, it will return a code 200, and the
     data that it found. If it does not find any of the fields, it returns a code 400.
+
+    With emit_metrics on, the time each stage took, the payload size, and the number of fields found are printed as an
+    embedded metric format line, which CloudWatch Logs turns into metrics.
+    """
+    metrics = RequestMetrics()
+    try:
+        response = handle_event(event, metrics)
+        metrics.status = response['statusCode']
+        return response
+    finally:
+        if emit_metrics:
+            function_name = getattr(context, "function_name", None) or "local"
+            print(emf_line(metrics, metrics_namespace, {"function": function_name}))
+
+
+def handle_event(event, metrics: RequestMetrics):
+    """
+    Parses an event and saves the results, as described for lambda_handler
+
+    :param event: the event the function was invoked with
+    :param metrics: the measurements of the invocation
+    :return: dict: the response
     """
     #data = event['data']
     data = event
 
     curr_time = datetime.datetime.now()
-    s3 = boto3.client('s3')
+    backend = get_backend()
+
+    digest = None
+    try:
+        # a repeat of a payload this container stored recently is answered the same way, without storing it again
+        if deduplicator:
+            with metrics.stage("dedup"):
+                try:
+                    digest = payload_digest(data)
+                except RecursionError:
+                    raise BudgetExceeded("max_depth", traversal_budget.max_depth)
+                cached = deduplicator.lookup(digest)
+            if cached is not None:
+                metrics.dedup = "cached"
+                return cached
+
+        if extract_records:
+            response = save_records(data, curr_time, backend, metrics, digest)
+            if digest is not None:
+                deduplicator.remember(digest, response)
+            return response
+
+        # parse out the data
+        with metrics.stage("parse_data"):
+            res_count, output_dict = parse_data(data)
+    except BudgetExceeded as e:
+        return save_over_budget(data, e, curr_time, backend, metrics)
+    metrics.fields_found = res_count
 
-    # parse out the data
-    res_count, output_dict = parse_data(data)
-    
     path = curr_time.strftime(path_format)
 
+    # with duplicate detection, the record ID comes from the payload and the raw data is stored under it, once
+    raw_path = path
+    if_absent = False
+    if digest is not None:
+        output_dict[record_id_key] = digest_record_id(digest)
+        raw_path = "content"
+        if_absent = deduplicator.probably_stored(digest)
+        metrics.dedup = "new"
+
     # if we find no values, exit here, return 400
     if res_count == 0:
-        path = "unprocessed/" + path
-
         # as long as the JSON loads, we're going to store it for review later
-        json_path = save_json(data, path, output_dict[record_id_key], s3)
+        json_path = save_json(data, "unprocessed/" + raw_path, output_dict[record_id_key], backend, metrics,
+                              if_absent)
 
-        return {
+        response = {
             'statusCode': 400,
-            'body': json.dumps("No fields found. Raw data is stored at " + json_path)
+            'body': codec.dumps("No fields found. Raw data is stored at " + json_path)
+        }
+    else:
+        # otherwise, save off the data
+        out_path = save_data(output_dict,  path, backend, metrics)
+        json_path = save_json(data, "processed/" + raw_path, output_dict[record_id_key], backend, metrics, if_absent)
+
+        # report success
+        response = {
+            'statusCode': 200,
+            'body': codec.dumps({"data":output_dict, "path": out_path})
         }
 
-    # otherwise, save off the data
-    out_path = save_data(output_dict,  path, s3)
-    json_path = save_json(data, "processed/" + path, output_dict[record_id_key], s3)
+    if digest is not None:
+        deduplicator.remember(digest, response)
+    return response
 
-    # report success
+
+def save_over_budget(data: dict, error: BudgetExceeded, curr_time: datetime.datetime, backend: StorageBackend,
+                     metrics: RequestMetrics):
+    """
+    Archives a payload that's over the traversal budget as unprocessed, without searching it
+
+    :param data: the payload
+    :param error: the budget the payload exceeded
+    :param curr_time: the time of the invocation, used to partition the output
+    :param backend: the storage backend to write the data to
+    :param metrics: the measurements of the invocation
+    :return: dict: the response
+    """
+    metrics.over_budget = error.limit
+    try:
+        json_path = save_json(data, "unprocessed/" + curr_time.strftime(path_format), time_ordered_id(), backend,
+                              metrics)
+        detail = str(error) + ", so it wasn't searched. Raw data is stored at " + json_path
+    except RecursionError:
+        # the event arrives decoded, and one nested this deeply can't be encoded again to archive it
+        detail = str(error) + ", so it wasn't searched, and it's nested too deeply to be archived"
+    logging.warning(detail)
+    return {
+        'statusCode': 400,
+        'body': codec.dumps({"body": detail, "reason": error.limit})
+    }
+
+
+def save_records(data: dict, curr_time: datetime.datetime, backend: StorageBackend, metrics: RequestMetrics,
+                 digest: bytes = None):
+    """
+    Parses a payload that holds many records into a row for each, and saves the rows and the raw data. The raw data is
+    stored once, under a payload ID that every row holds as [payload_id_key] alongside its own record ID
+
+    :param data: the payload
+    :param curr_time: the time of the invocation, used to partition the output
+    :param backend: the storage backend to write the data to
+    :param metrics: the measurements of the invocation
+    :param digest: the payload digest, when duplicates are being detected, which both IDs are then taken from
+    :return: dict: the response
+    """
+    with metrics.stage("parse_data"):
+        res_count, rows = parse_records(data)
+    metrics.fields_found = res_count
+
+    path = curr_time.strftime(path_format)
+    raw_path = path
+    if_absent = False
+    payload_id = time_ordered_id()
+    if digest is not None:
+        payload_id = digest_record_id(digest)
+        raw_path = "content"
+        if_absent = deduplicator.probably_stored(digest)
+        metrics.dedup = "new"
+    for index, row in enumerate(rows):
+        if digest is not None:
+            row[record_id_key] = digest_record_id(digest, index)
+        row[payload_id_key] = payload_id
+
+    # if we find no records, exit here, return 400
+    if not rows:
+        json_path = save_json(data, "unprocessed/" + raw_path, payload_id, backend, metrics, if_absent)
+        return {
+            'statusCode': 400,
+            'body': codec.dumps("No records found. Raw data is stored at " + json_path)
+        }
+
+    out_paths = save_rows(rows, path, payload_id, backend, metrics)
+    save_json(data, "processed/" + raw_path, payload_id, backend, metrics, if_absent)
     return {
         'statusCode': 200,
-        'body': json.dumps({"data":output_dict, "path": out_path})
+        'body': codec.dumps({"data": rows, "paths": out_paths, payload_id_key: payload_id})
     }
 
+
 if __name__ == "__main__":
     print("Hello world")
\ No newline at end of file
@@ -0,0 +1,583 @@
+"""
+Storage helpers for the JSON ingest service
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from compression import decompress
+from partitions import shard_directory, time_ordered_id
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # only needed for Parquet output
+    pyarrow = None
+
+
+class StorageBackend:
+    """
+    Somewhere to store objects by key. Keys use the S3 layout, such as raw_data/processed/2020/10/01/[record_id].json,
+    whichever backend holds them, so output written offline lines up with what the service writes to S3.
+    """
+
+    def put(self, key: str, body, content_encoding: str = None):
+        """
+        Stores an object, replacing any object already at the key
+
+        :param key: the key to store the object at
+        :param body: the object body, as a str, bytes or binary file object
+        :param content_encoding: the compression the body was written with, such as gzip or zstd, kept as the object's
+            Content-Encoding where the backend has metadata
+        """
+        raise NotImplementedError
+
+    def get(self, key: str):
+        """
+        :param key: the key of the object
+        :return: bytes: the object body
+        :raises KeyError: if there's no object at the key
+        """
+        raise NotImplementedError
+
+    def read(self, key: str, dictionary: bytes = None):
+        """
+        :param key: the key of the object
+        :param dictionary: the zstd dictionary the object may have been compressed with
+        :return: bytes: the object body, decompressed if it was stored compressed
+        :raises KeyError: if there's no object at the key
+        """
+        return decompress(self.get(key), dictionary)
+
+    def exists(self, key: str):
+        """
+        :param key: the key of the object
+        :return: bool: whether there's an object at the key
+        """
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+    def keys(self, prefix: str = ""):
+        """
+        :param prefix: only list keys that start with this
+        :return: list: the keys stored, in sorted order
+        """
+        raise NotImplementedError
+
+
+class S3Backend(StorageBackend):
+    """
+    Stores objects in an S3 bucket
+    """
+
+    def __init__(self, s3, bucket: str):
+        """
+        :param s3: the S3 client to write with
+        :param bucket: the bucket to store the objects in
+        """
+        self.s3 = s3
+        self.bucket = bucket
+
+    def put(self, key: str, body, content_encoding: str = None):
+        if content_encoding:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentEncoding=content_encoding)
+        else:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def get(self, key: str):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except self.s3.exceptions.NoSuchKey:
+            raise KeyError(key)
+
+    def exists(self, key: str):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.s3.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def keys(self, prefix: str = ""):
+        keys = []
+        for page in self.s3.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(item["Key"] for item in page.get("Contents", []))
+        return sorted(keys)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Stores objects as files under a local directory, at the same relative paths as their keys. Each file is written to a
+    temp file first and then moved into place, so readers never see a partly written object.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: the directory to store the objects in. It is created if it doesn't exist
+        """
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key: str):
+        path = os.path.abspath(os.path.join(self.root, *key.split("/")))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError("Key " + repr(key) + " is outside the storage directory")
+        return path
+
+    def put(self, key: str, body, content_encoding: str = None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(handle, "wb") as out:
+                if hasattr(body, "read"):
+                    shutil.copyfileobj(body, out)
+                else:
+                    out.write(body.encode("utf-8") if isinstance(body, str) else body)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def exists(self, key: str):
+        return os.path.isfile(self._path(key))
+
+    def keys(self, prefix: str = ""):
+        keys = []
+        for directory, dirs, files in os.walk(self.root):
+            relative = os.path.relpath(directory, self.root).replace(os.sep, "/")
+            for name in files:
+                if not name.startswith(".tmp-"):
+                    key = name if relative == "." else relative + "/" + name
+                    if key.startswith(prefix):
+                        keys.append(key)
+        return sorted(keys)
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Keeps objects in a dict in memory, for tests and benchmarks. Everything is lost when the process exits.
+    """
+
+    def __init__(self):
+        self.objects = {}  # key -> the object body as bytes
+        self._lock = threading.Lock()
+
+    def put(self, key: str, body, content_encoding: str = None):
+        if hasattr(body, "read"):
+            body = body.read()
+        data = body.encode("utf-8") if isinstance(body, str) else bytes(body)
+        with self._lock:
+            self.objects[key] = data
+
+    def get(self, key: str):
+        with self._lock:
+            return self.objects[key]
+
+    def exists(self, key: str):
+        with self._lock:
+            return key in self.objects
+
+    def keys(self, prefix: str = ""):
+        with self._lock:
+            return sorted(key for key in self.objects if key.startswith(prefix))
+
+
+def open_backend(kind: str, bucket: str = None, s3=None, path: str = None):
+    """
+    :param kind: "s3", "local" or "memory"
+    :param bucket: for s3, the bucket to store objects in
+    :param s3: for s3, the S3 client to write with
+    :param path: for local, the directory to store objects in
+    :return: StorageBackend: the backend
+    """
+    if kind == "s3":
+        return S3Backend(s3, bucket)
+    if kind == "local":
+        return LocalBackend(path)
+    if kind == "memory":
+        return MemoryBackend()
+    raise ValueError("Unknown storage backend " + repr(kind) + ", expected s3, local or memory")
+
+
+class JsonLinesEncoder:
+    """
+    Writes a batch as newline-delimited JSON. Records are passed to the writer already encoded, as one line of bytes
+    """
+    extension = ".json"
+    byte_offsets = True  # record locations are byte offsets into the object
+
+    def size(self, record: bytes):
+        return len(record) + 1
+
+    def encode(self, records: list):
+        return b"\n".join(records) + b"\n"
+
+
+class ParquetEncoder:
+    """
+    Writes a batch as one compressed Parquet file with a string column per field, so that queries only read the
+    columns they use. Records are passed to the writer as dicts. Empty values are stored as nulls, and values that
+    aren't strings (such as numeric zip codes) are stored as their JSON text.
+    """
+    extension = ".parquet"
+    byte_offsets = False  # record locations are row numbers within the file
+
+    def __init__(self, columns: list, compression: str = "snappy"):
+        """
+        :param columns: the keys of each record to write, in column order
+        :param compression: the Parquet compression codec, such as snappy, gzip or zstd
+        """
+        if pyarrow is None:
+            raise RuntimeError("Parquet output requires the pyarrow package")
+        self.columns = list(columns)
+        self.compression = compression
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in self.columns])
+
+    def size(self, record: dict):
+        return sum(len(value) for value in map(_column_value, record.values()) if value) + len(record)
+
+    def encode(self, records: list):
+        table = pyarrow.Table.from_pydict(
+            {column: [_column_value(record.get(column)) for record in records] for column in self.columns},
+            schema=self.schema)
+        sink = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(table, sink, compression=self.compression)
+        return sink.getvalue().to_pybytes()
+
+
+def _column_value(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+class BatchLocation:
+    """
+    Where a buffered record will be stored: the object key, and the byte offset and length of its line in that object.
+    For columnar formats the offset is the record's row number, and the length is None. The future resolves to the key
+    once the object has been written, or to the exception that stopped it.
+    """
+    __slots__ = ("key", "offset", "length", "future")
+
+    def __init__(self, key: str, offset: int, length: int, future: Future):
+        self.key = key
+        self.offset = offset
+        self.length = length
+        self.future = future
+
+    @property
+    def path(self):
+        """
+        :return: str: the object key, with the offset of the record appended as a fragment
+        """
+        return self.key + "#" + str(self.offset)
+
+
+class _Buffer:
+    """
+    The records collected for one partition, and the object they'll be written to
+    """
+    __slots__ = ("key", "records", "size", "opened", "future")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.records = []
+        self.size = 0
+        self.opened = time.monotonic()
+        self.future = Future()
+
+
+class BatchWriter:
+    """
+    Collects records into one buffer per partition, and writes each buffer to storage as a single object, by default
+    with one JSON record per line. A buffer is flushed once it holds max_records records or max_bytes bytes, or once
+    max_latency seconds have passed since its first record was added, whichever comes first.
+
+    Writes happen on a background thread. add() returns the record's location straight away, and callers that need
+    the record to be durable wait on location.future. close() flushes whatever is still buffered, and must be called
+    on shutdown.
+
+    With a compressor, each batch is compressed as a whole, which compresses far better than small records on their
+    own. Record offsets are then into the decompressed object.
+    """
+
+    def __init__(self, backend: StorageBackend, folder: str, max_records: int = 500,
+                 max_bytes: int = 8 * 1024 * 1024, max_latency: float = 1.0, encoder=None, compressor=None,
+                 shards: int = 0, partition_style: str = "date"):
+        """
+        :param backend: the storage backend to write the data to
+        :param folder: the folder to write objects under. Objects are stored at
+            [folder]/[partition]/[shard]/[batch id][extension], where the batch ID is time-ordered
+        :param max_records: the number of records that triggers a flush
+        :param max_bytes: the buffered size in bytes that triggers a flush
+        :param max_latency: the longest time in seconds a record is held before its buffer is flushed
+        :param encoder: the format to write each batch in. Defaults to a JsonLinesEncoder
+        :param compressor: a compressor from compression.py to compress each batch with, or None to store it as encoded.
+            Its extension is added to the object keys
+        :param shards: the number of hash-sharded prefixes to spread each partition's objects over, or 0 for none
+        :param partition_style: the partition style, which names the shard level
+        """
+        self.backend = backend
+        self.folder = folder
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.encoder = encoder or JsonLinesEncoder()
+        self.compressor = compressor
+        self.extension = self.encoder.extension + (compressor.extension if compressor else "")
+        self.shards = shards
+        self.partition_style = partition_style
+
+        self._open = {}  # partition -> the _Buffer collecting records for it
+        self._sealed = deque()  # buffers waiting to be written
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name="batch-writer-" + folder, daemon=True)
+        self._thread.start()
+
+    def add(self, partition: str, record):
+        """
+        Buffers a record for the given partition
+
+        :param partition: the path under folder that the record belongs in, such as the date path
+        :param record: the record, in the form the encoder takes. For JSON lines this is the encoded record, which must
+            not contain a newline
+        :return: BatchLocation: where the record will be stored
+        """
+        return self.add_many(partition, [record])[0]
+
+    def add_many(self, partition: str, records: list):
+        """
+        Buffers several records for the given partition as one unit, such as the rows parsed from one payload, so that
+        they're always written to the same object. The buffer is only checked for a flush once all of them are added,
+        so it may go over max_records or max_bytes
+
+        :param partition: the path under folder that the records belong in
+        :param records: the records, in the form the encoder takes
+        :return: list: a BatchLocation for each record
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchWriter for " + self.folder + " is closed")
+            buf = self._open.get(partition)
+            if buf is None:
+                batch_id = time_ordered_id().replace("-", "")
+                buf = self._open[partition] = _Buffer(self.folder + "/" + partition +
+                                                      shard_directory(batch_id, self.shards, self.partition_style) +
+                                                      "/" + batch_id + self.extension)
+                self._wake.notify()  # start the latency timer for the new buffer
+
+            locations = []
+            for record in records:
+                if self.encoder.byte_offsets:
+                    locations.append(BatchLocation(buf.key, buf.size, len(record), buf.future))
+                else:
+                    locations.append(BatchLocation(buf.key, len(buf.records), None, buf.future))
+                buf.records.append(record)
+                buf.size += self.encoder.size(record)
+            if len(buf.records) >= self.max_records or buf.size >= self.max_bytes:
+                self._seal(partition)
+        return locations
+
+    def flush(self, futures=None):
+        """
+        Hands open buffers to the background thread to be written, without waiting for the writes
+
+        :param futures: only flush the buffers whose future is among these, such as the ones a batch of records was
+            added to, leaving the rest to fill up. None flushes every open buffer
+        """
+        with self._lock:
+            for partition, buf in list(self._open.items()):
+                if futures is None or buf.future in futures:
+                    self._seal(partition)
+
+    def close(self):
+        """
+        Writes everything still buffered and stops the background thread
+        """
+        with self._lock:
+            for partition in list(self._open):
+                self._seal(partition)
+            self._closed = True
+            self._wake.notify()
+        self._thread.join()
+
+    def _seal(self, partition: str):
+        self._sealed.append(self._open.pop(partition))
+        self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._sealed:
+                    if self._closed:
+                        return
+                    timeout = None
+                    if self._open:
+                        now = time.monotonic()
+                        for partition, buf in list(self._open.items()):
+                            if now - buf.opened >= self.max_latency:
+                                self._seal(partition)
+                        if self._sealed:
+                            break
+                        timeout = min(buf.opened for buf in self._open.values()) + self.max_latency - now
+                    self._wake.wait(timeout)
+                buf = self._sealed.popleft()
+            self._write(buf)
+
+    def _write(self, buf: _Buffer):
+        logging.info("Writing batch of " + str(len(buf.records)) + " records to " + buf.key)
+        try:
+            body = self.encoder.encode(buf.records)
+            if self.compressor:
+                body = self.compressor.compress(body)
+            self.backend.put(buf.key, body, self.compressor.encoding if self.compressor else None)
+        except Exception as e:
+            logging.exception("Failed to write batch to " + buf.key)
+            buf.future.set_exception(e)
+        else:
+            buf.future.set_result(buf.key)
+
+
+class WriteBehindQueue:
+    """
+    Makes writes in the background, after the requests they came from have been answered. Writes wait in a queue and
+    are made by a pool of worker threads, in the order they were submitted, each retried with a doubling delay until it
+    succeeds or max_attempts is used up.
+
+    The queue never refuses a write itself. Callers check full() before taking on new work, so that a request's writes
+    are queued together or not at all, and the limits can be passed by the writes of requests already accepted.
+    close() waits for every queued write, and must be called on shutdown.
+    """
+
+    def __init__(self, max_writes: int = 10000, max_bytes: int = 256 * 1024 * 1024, workers: int = 4,
+                 max_attempts: int = 5, retry_delay: float = 0.5):
+        """
+        :param max_writes: the number of queued writes at which the queue is full
+        :param max_bytes: the queued size in bytes at which the queue is full
+        :param workers: the number of threads making the writes
+        :param max_attempts: attempts per write, including retries
+        :param retry_delay: seconds to wait before the first retry of a write, doubling for each retry after it
+        """
+        self.max_writes = max_writes
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._queue = deque()  # (future, write, size) for the writes no worker has taken yet
+        self._unfinished = {}  # future -> the time its write was submitted, for every write not yet finished
+        self._bytes = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._threads = [threading.Thread(target=self._run, name="write-behind-" + str(i), daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, write, size: int = 0):
+        """
+        Queues a write
+
+        :param write: a function that makes the write, and raises if it fails. It may be called more than once
+        :param size: the size of the write in bytes, counted against max_bytes until it's finished
+        :return: Future: resolves to None once the write has succeeded, or to the exception from its last attempt
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The write-behind queue is closed")
+            self._queue.append((future, write, size))
+            self._unfinished[future] = time.monotonic()
+            self._bytes += size
+            self._wake.notify()
+        return future
+
+    def full(self):
+        """
+        :return: bool: whether the unfinished writes have reached max_writes or max_bytes
+        """
+        return len(self._unfinished) >= self.max_writes or self._bytes >= self.max_bytes
+
+    def closed(self):
+        """
+        :return: bool: whether the queue has been closed, after which it refuses writes
+        """
+        return self._closed
+
+    def depth(self):
+        """
+        :return: int: the number of writes queued or being made
+        """
+        return len(self._unfinished)
+
+    def lag(self):
+        """
+        :return: float: the seconds the oldest unfinished write has waited since it was submitted, or 0 if there are
+            none
+        """
+        with self._lock:
+            oldest = next(iter(self._unfinished.values()), None)
+        return 0.0 if oldest is None else time.monotonic() - oldest
+
+    def close(self):
+        """
+        Makes every queued write, retries included, and stops the worker threads
+        """
+        with self._lock:
+            self._closed = True
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    if self._closed:
+                        return
+                    self._wake.wait()
+                future, write, size = self._queue.popleft()
+            error = self._attempt(write)
+            with self._lock:
+                self._bytes -= size
+                del self._unfinished[future]
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _attempt(self, write):
+        """
+        :return: None once the write has succeeded, or the exception from its last attempt
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                write()
+                return None
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logging.exception("Giving up on a queued write after " + str(attempt) + " attempts")
+                    return e
+                logging.warning("Queued write failed, retrying: " + repr(e))
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
@@ -2,65 +2,83 @@
 A test driver class that can take in a directory of sample data in CSV and JSON data and use it to send commands
 to the remote server. It does minimal error checking, assuming that the data is in the format matching the extension,
 and that the user has provided a valid input for the file and the remote URL
+
+By default each record is sent one at a time and its response printed. With --concurrency or --rate, the script
+generates load instead: records are sent from several threads, each reusing a keep-alive connection, and a summary of
+throughput, errors, and latency is printed at the end.
 """
+import argparse
 import json
 import csv
 import requests
 import logging
 import sys
+import threading
 import time
 import os
 
 def send_request(data_list, url):
     """
-    Sends a JSON request to the provided URL. 
+    Sends a JSON request to the provided URL.
     """
+    session = requests.Session()
     for li in data_list:
         print("Sending", li, "to", url)
-        out = requests.post(url, li)
+        out = session.post(url, li)
         print(out.json())
         print('\n')
         time.sleep(1)
 
-def parse_input(filename, url):
+def parse_input(filename):
     """
-    Parse through the provided file. Can handle directories and sub-directories, CSV, and JSON data.
+    Parse through the provided file. Can handle directories and sub-directories, CSV, JSON, and NDJSON data.
+    Yields the body of each request in turn, reading the files as it goes.
     """
     print("Processing", filename, "\n")
     try:
         if os.path.isdir(filename): # if it's a directory
-            files = os.listdir(filename)
+            files = sorted(os.listdir(filename))
             for file in files:
                 new_path = os.path.join(filename,file)
-                parse_input(new_path, url)
+                yield from parse_input(new_path)
             return
 
         # check for known file extensions
         file, ext = os.path.splitext(filename)
-        if ext == ".json": 
-            parse_json(filename, url)
+        if ext == ".json":
+            yield from parse_json(filename)
+
+        elif ext == ".ndjson":
+            yield from parse_ndjson(filename)
 
         elif ext == ".csv":
-            parse_csv(filename, url)
+            yield from parse_csv(filename)
 
         else: # otherwise, log and move on
             print("Not a supported file: " +filename+ "\n")
-    except:
+    except (OSError, ValueError):
         print("Unexpected error:", sys.exc_info()[0])
 
-def parse_json(json_file, url):
+def parse_json(json_file):
     """
-    Reads in a JSON file and sends the contents directly to the remote server
+    Reads in a JSON file and yields the contents to send directly to the remote server
     """
     with open(json_file) as file:
-        data = file.read()
-        send_request([data], url)
+        yield file.read()
+
+def parse_ndjson(ndjson_file):
+    """
+    Reads in an NDJSON file, such as one written by generate_payloads.py, and yields each line as its own request
+    """
+    with open(ndjson_file) as file:
+        for line in file:
+            if line.strip():
+                yield line.strip()
 
-def parse_csv(csv_file, url):
+def parse_csv(csv_file):
     """
-    Parses a CSV file, and pulls out all of the relevant fields, then passes it to the remote server
+    Parses a CSV file, and pulls out all of the relevant fields, then yields each row to pass to the remote server
     """
-    rows = []
     with open(csv_file) as file:
         reader = csv.DictReader(file)
         for row in reader:
@@ -68,18 +86,128 @@ def parse_csv(csv_file, url):
             for k, v in row.items():
                 parsed_row[k.strip()] = v.strip()
             data = {"data":parsed_row}
-            data_str = json.dumps(data)
+            yield json.dumps(data)
+
+
+class LoadStats:
+    """
+    Collects the outcome of each request sent during a load run. Connection failures and 5xx responses count as
+    errors; 4xx responses are the service's answer to the record, so they're only counted by status.
+    """
+
+    # the upper edge of each histogram bucket, in milliseconds
+    buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf")]
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency, status):
+        """
+        :param latency: the time in seconds the request took
+        :param status: the response status code, or None if the request failed
+        """
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status is None or status >= 500:
+                self.errors += 1
+
+    def report(self, elapsed):
+        """
+        Prints the throughput, error rate, status counts, latency percentiles and a latency histogram
+
+        :param elapsed: the length of the run in seconds
+        """
+        count = len(self.latencies)
+        if not count:
+            print("No requests were sent")
+            return
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(count - 1, int(count * p / 100))] * 1000
+
+        print("Requests:    ", count, "in %.2f s" % elapsed)
+        print("Throughput:   %.1f requests/s" % (count / elapsed))
+        print("Error rate:   %.2f%%" % (self.errors * 100.0 / count))
+        print("Statuses:    ", ", ".join("%s: %d" % (status if status else "failed", number)
+                                         for status, number in sorted(self.statuses.items(), key=str)))
+        print("Latency:      p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+            percentile(50), percentile(90), percentile(99), latencies[-1] * 1000))
+
+        counts = [0] * len(self.buckets)
+        for latency in latencies:
+            counts[next(i for i, edge in enumerate(self.buckets) if latency * 1000 <= edge)] += 1
+        lower = 0
+        for edge, number in zip(self.buckets, counts):
+            if number:
+                label = ("%g-%g ms" % (lower, edge)) if edge != float("inf") else ("> %g ms" % lower)
+                print("  %-14s %7d %s" % (label, number, "#" * max(1, number * 50 // count)))
+            lower = edge
+
+
+def run_load(bodies, url, concurrency=8, rate=None, timeout=30.0):
+    """
+    Sends every body to the URL from concurrency threads, each with its own keep-alive session
+
+    Without a rate, each thread sends its next request as soon as the last one finishes, to find the most the service
+    can take. With a rate, requests are due at fixed intervals whether or not earlier ones have finished (an open
+    loop), and latency is measured from when each was due, so time spent waiting for a free thread is counted.
+
+    :param bodies: an iterable of request bodies, read as they're needed
+    :param url: the URL to post to
+    :param concurrency: the number of requests that can be in flight at once
+    :param rate: the requests to start per second, or None to send as fast as possible
+    :param timeout: seconds to wait for each response
+    :return: LoadStats: the outcome of every request
+    """
+    stats = LoadStats()
+    source = iter(bodies)
+    lock = threading.Lock()
+    sent = [0]
+    start = time.perf_counter()
 
-            rows.append(data_str)
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                body = next(source, None)
+                due = start + sent[0] / rate if rate else None
+                sent[0] += 1
+            if body is None:
+                return
+            if due is not None:
+                time.sleep(max(0.0, due - time.perf_counter()))
+            began = due if due is not None else time.perf_counter()
+            try:
+                status = session.post(url, data=body, timeout=timeout).status_code
+            except requests.RequestException as e:
+                logging.debug("Request failed: " + str(e))
+                status = None
+            stats.record(time.perf_counter() - began, status)
 
-    # send a set of requests
-    send_request(rows, url)
+    threads = [threading.Thread(target=worker, daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.report(time.perf_counter() - start)
+    return stats
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: test_driver.py <filename> <url>")
-        exit(-1)
+    parser = argparse.ArgumentParser(description="Sends sample data to the remote server")
+    parser.add_argument("filename", help="a CSV, JSON or NDJSON file, or a directory of them")
+    parser.add_argument("url", help="the URL to send the data to")
+    parser.add_argument("--concurrency", type=int, help="generate load with this many requests in flight at once")
+    parser.add_argument("--rate", type=float, help="generate load at this many requests per second")
+    parser.add_argument("--repeat", type=int, default=1, help="in load mode, send the input this many times")
+    args = parser.parse_args()
 
-    file = sys.argv[1]
-    url = sys.argv[2]
-    parse_input(file,url)
\ No newline at end of file
+    if args.concurrency or args.rate:
+        bodies = (body for i in range(args.repeat) for body in parse_input(args.filename))
+        run_load(bodies, args.url, args.concurrency or 8, args.rate)
+    else:
+        send_request(parse_input(args.filename), args.url)
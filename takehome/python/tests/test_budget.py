@@ -0,0 +1,96 @@
+from unittest import TestCase
+import json
+import pickle
+import process_json
+import storage
+from extract import BudgetExceeded, FieldMatcher, StreamingExtractor, TraversalBudget, find_fields, find_records
+
+
+def nested(levels: int, leaf: dict):
+    """
+    :return: dict: the leaf nested levels deep under "a" keys, built without recursion
+    """
+    data = leaf
+    for _ in range(levels):
+        data = {"a": data}
+    return data
+
+
+class TestBudget(TestCase):
+
+    def test_deep_payload_without_budget(self):
+        """
+        Tests that payloads nested far past the recursion limit are searched without a RecursionError
+        """
+        data = nested(100000, {"first_name": "Shirley"})
+
+        self.assertEqual({"first_name": "Shirley"}, find_fields(["first_name"], data))
+        self.assertEqual([{"first_name": "Shirley"}], find_records(["first_name"], nested(100000, {"b": [data]}), 1))
+
+    def test_depth_and_node_budgets(self):
+        """
+        Tests that a search stops with BudgetExceeded as soon as it goes past max_depth or max_nodes, and that a
+        search within them is unaffected
+        """
+        budget = TraversalBudget(max_depth=10, max_nodes=50)
+        self.assertEqual({"first_name": "Shirley"}, find_fields(["first_name"], nested(9, {"first_name": "Shirley"}),
+                                                                budget))
+
+        with self.assertRaises(BudgetExceeded) as raised:
+            find_fields(["first_name"], nested(10, {"first_name": "Shirley"}), budget)
+        self.assertEqual("max_depth", raised.exception.limit)
+        with self.assertRaises(BudgetExceeded) as raised:
+            find_records(["first_name", "last_name"], {"people": [{"n": i} for i in range(60)]}, 2, budget)
+        self.assertEqual("max_nodes", raised.exception.limit)
+        with self.assertRaises(BudgetExceeded) as raised:
+            budget = TraversalBudget(max_bytes=10)
+            budget.check_bytes(11)
+        self.assertEqual("max_bytes", raised.exception.limit)
+
+    def test_pickling(self):
+        """
+        Tests that BudgetExceeded and a compiled rule set survive being pickled, as they are when sent to or from a
+        worker process, and that a rule set leaves its memo behind
+        """
+        error = pickle.loads(pickle.dumps(BudgetExceeded("max_nodes", 50)))
+        self.assertEqual(("max_nodes", 50, "The payload exceeds the max_nodes budget of 50"),
+                         (error.limit, error.value, str(error)))
+
+        matcher = FieldMatcher({"zip_code": ["postal_code"]}, normalize=True)
+        matcher.match("ZipCode")
+        copy = pickle.loads(pickle.dumps(matcher))
+        self.assertEqual({}, copy._memo)
+        self.assertEqual({"zip_code": "12345"}, find_fields(copy, {"Postal-Code": "12345"}))
+
+    def test_streaming_budgets(self):
+        """
+        Tests that the streaming extractor counts the bytes fed to it, and the nesting of values it skips
+        """
+        extractor = StreamingExtractor(["first_name"], TraversalBudget(max_bytes=20))
+        extractor.feed(b'{"last_name": ')
+        with self.assertRaises(BudgetExceeded):
+            extractor.feed(b'"Anne", "first_name": "Shirley"}')
+
+        body = b'{"skipped": ' + b'[' * 50 + b']' * 50 + b', "first_name": "Shirley"}'
+        with self.assertRaises(BudgetExceeded):
+            StreamingExtractor(["first_name"], TraversalBudget(max_depth=20)).feed(body)
+        extractor = StreamingExtractor(["first_name"], TraversalBudget(max_depth=60))
+        extractor.feed(body)
+        self.assertEqual({"first_name": "Shirley"}, extractor.close())
+
+    def test_lambda_handler_over_budget(self):
+        """
+        Tests that a payload over the budget is archived as unprocessed with the reason, without being searched
+        """
+        backend = storage.MemoryBackend()
+        original = process_json.backend, process_json.traversal_budget
+        process_json.backend, process_json.traversal_budget = backend, TraversalBudget(max_depth=128)
+        self.addCleanup(setattr, process_json, "backend", original[0])
+        self.addCleanup(setattr, process_json, "traversal_budget", original[1])
+
+        res = process_json.lambda_handler(nested(200, {"first_name": "Shirley"}), None)
+
+        self.assertEqual(400, res['statusCode'])
+        self.assertEqual("max_depth", json.loads(res['body'])['reason'])
+        self.assertEqual([], backend.keys("parsed_data/"))
+        self.assertEqual(1, len(backend.keys("raw_data/unprocessed/")))
@@ -0,0 +1,63 @@
+from unittest import TestCase, skipUnless
+import json
+import codec
+
+
+def outcome(loads, text):
+    """
+    :return: the repr of the decoded value, or the type and message of the error raised
+    """
+    try:
+        return repr(loads(text))
+    except ValueError as e:
+        return type(e).__name__ + ": " + str(e)
+
+
+class TestCodec(TestCase):
+
+    # inputs where orjson on its own would give a different value or error to the json module
+    corner_cases = [b'{"id": 123456789012345678901234567890}', b'[-9223372036854775809, 18446744073709551616]',
+                    b'[1e400, -1e400]', b'[NaN, Infinity]', b'"\\ud800"', '"\ud800"', b'\xef\xbb\xbf{"a": 1}',
+                    b'{"a": 1, "a": 2}', b'{"a": 0.1, "b": 1.0, "c": 1e5}', b'"\xff"', b'{"a": 1}x', b'[1,]', b'']
+
+    def test_stdlib_codec(self):
+        """
+        Tests that the stdlib codec decodes and encodes exactly as the json module does
+        """
+        stdlib = codec.get_codec("stdlib")
+        for text in self.corner_cases:
+            self.assertEqual(outcome(json.loads, text), outcome(stdlib.loads, text))
+        value = {"name": "Zoë", "zip_code": 12345, "nested": [1.5, None, True]}
+        self.assertEqual(json.dumps(value), stdlib.dumps(value))
+
+    @skipUnless(codec.orjson, "orjson isn't installed")
+    def test_orjson_codec_matches_json(self):
+        """
+        Tests that the orjson codec gives the same values, types and errors as the json module, including for the
+        inputs orjson handles differently on its own
+        """
+        fast = codec.get_codec("orjson")
+        for text in self.corner_cases:
+            self.assertEqual(outcome(json.loads, text), outcome(fast.loads, text))
+        value = {"name": "Zoë", "zip_code": 12345, "nested": [1.5, None, True]}
+        self.assertEqual(json.dumps(value), fast.dumps(value))
+
+    @skipUnless(codec.orjson, "orjson isn't installed")
+    def test_orjson_codec_long_number_windows(self):
+        """
+        Tests that an integer wider than 64 bits is handed to the json module wherever it falls in a large payload,
+        including across the edge of a scanned window
+        """
+        fast = codec.get_codec("orjson")
+        for padding in range(codec._scan_window - 30, codec._scan_window + 5, 7):
+            text = '{"pad": "' + "x" * padding + '", "id": 123456789012345678901234567890}'
+            self.assertEqual(json.loads(text), fast.loads(text))
+            self.assertEqual(json.loads(text), fast.loads(text.encode("utf-8")))
+
+    def test_get_codec(self):
+        """
+        Tests that auto picks orjson when it's installed, and that an unknown codec is rejected
+        """
+        self.assertEqual("orjson" if codec.orjson else "stdlib", codec.get_codec().name)
+        with self.assertRaises(ValueError):
+            codec.get_codec("simdjson")
@@ -0,0 +1,52 @@
+from unittest import TestCase, skipUnless
+import json
+import compression
+import process_json
+import storage
+
+
+class TestCompression(TestCase):
+
+    payload = b'{"person": {"first_name": "Shirley", "last_name": "Anne"}, "zip_code": 12345}'
+
+    def test_gzip_round_trip(self):
+        """
+        Tests that gzip output is recognised and decompressed without being told the format, and that plain JSON is
+        passed through unchanged
+        """
+        compressed = compression.GzipCompressor(9).compress(self.payload.decode("utf-8"))
+
+        self.assertTrue(compressed.startswith(compression.gzip_magic))
+        self.assertEqual(self.payload, compression.decompress(compressed))
+        self.assertEqual(self.payload, compression.decompress(self.payload))
+
+    @skipUnless(compression.zstandard, "zstandard is not installed")
+    def test_zstd_dictionary_round_trip(self):
+        """
+        Tests that zstd output made with a trained dictionary decompresses with the same dictionary
+        """
+        samples = [json.dumps({"id": i, "person": {"first_name": "Shirley", "last_name": "Anne", "age": i % 90},
+                               "zip_code": 10000 + i}).encode("utf-8") for i in range(1000)]
+        dictionary = compression.train_dictionary(samples, 4096)
+        compressed = compression.ZstdCompressor(3, dictionary).compress(self.payload)
+
+        self.assertTrue(compressed.startswith(compression.zstd_magic))
+        self.assertEqual(self.payload, compression.decompress(compressed, dictionary))
+
+    def test_lambda_handler_compressed(self):
+        """
+        Tests that the Lambda archives the raw data compressed, with a .gz extension, and that it reads back as sent
+        """
+        backend = storage.MemoryBackend()
+        original = process_json.backend, process_json.raw_compressor
+        process_json.backend, process_json.raw_compressor = backend, compression.get_compressor("gzip")
+        try:
+            event = {"person": {"first_name": "Shirley"}}
+            process_json.lambda_handler(event, None)
+        finally:
+            process_json.backend, process_json.raw_compressor = original
+
+        raw_keys = backend.keys("raw_data/")
+        self.assertEqual(1, len(raw_keys))
+        self.assertTrue(raw_keys[0].endswith(".json.gz"))
+        self.assertEqual(event, json.loads(backend.read(raw_keys[0])))
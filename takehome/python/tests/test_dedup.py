@@ -0,0 +1,88 @@
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+import dedup
+import process_json
+import storage
+
+
+class TestDedup(TestCase):
+
+    def test_payload_digest(self):
+        """
+        Tests that payloads differing only in key order or whitespace get the same digest and record ID
+        """
+        first = dedup.payload_digest(json.loads('{"a": 1, "b": {"c": [1, 2], "d": "x"}}'))
+        second = dedup.payload_digest(json.loads('{ "b": {"d": "x", "c": [1,2]}, "a": 1 }'))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, dedup.payload_digest({"a": 2, "b": {"c": [1, 2], "d": "x"}}))
+        self.assertEqual(dedup.digest_record_id(first), dedup.digest_record_id(second))
+
+    def test_bloom_filter(self):
+        """
+        Tests that the Bloom filter never misses a digest it holds, keeps close to its false positive rate, and reads
+        back the same from a snapshot
+        """
+        bloom = dedup.BloomFilter(2000, 0.01)
+        added = [dedup.payload_digest(i) for i in range(2000)]
+        for digest in added:
+            bloom.add(digest)
+
+        self.assertTrue(all(digest in bloom for digest in added))
+        false_positives = sum(dedup.payload_digest(-i - 1) in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        bloom.save(os.path.join(directory, "bloom.snapshot"))
+        loaded = dedup.BloomFilter.load(os.path.join(directory, "bloom.snapshot"))
+        self.assertEqual(bloom.bits, loaded.bits)
+        self.assertTrue(all(digest in loaded for digest in added))
+
+    def test_bloom_filter_snapshot_merged(self):
+        """
+        Tests that filters saved to the same snapshot, as each worker of a service saves its own, are merged into it
+        rather than replacing each other, and that no temp files are left behind
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "bloom.snapshot")
+        digests = [dedup.payload_digest(i) for i in range(200)]
+        for worker_digests in [digests[:100], digests[100:]]:
+            bloom = dedup.BloomFilter(1000, 0.01)
+            for digest in worker_digests:
+                bloom.add(digest)
+            bloom.save(path)
+
+        loaded = dedup.BloomFilter.load(path)
+        self.assertTrue(all(digest in loaded for digest in digests))
+        self.assertEqual(["bloom.snapshot", "bloom.snapshot.lock"], sorted(os.listdir(directory)))
+
+    def test_lambda_handler_repeats(self):
+        """
+        Tests that a repeated payload is answered from the cache without storing anything, and that once it has left
+        the cache only a new parsed record is written, referring to the raw data already stored
+        """
+        backend = storage.MemoryBackend()
+        original = process_json.backend, process_json.deduplicator
+        process_json.backend = backend
+        process_json.deduplicator = dedup.Deduplicator(10, 1000, 0.01)
+        try:
+            first = process_json.lambda_handler({"person": {"first_name": "Shirley"}, "zip_code": 12345}, None)
+            repeat = process_json.lambda_handler({"zip_code": 12345, "person": {"first_name": "Shirley"}}, None)
+            self.assertEqual(first, repeat)
+            self.assertEqual(2, len(backend.keys()))
+
+            process_json.deduplicator.forget(process_json.payload_digest({"zip_code": 12345,
+                                                                          "person": {"first_name": "Shirley"}}))
+            later = process_json.lambda_handler({"person": {"first_name": "Shirley"}, "zip_code": 12345}, None)
+        finally:
+            process_json.backend, process_json.deduplicator = original
+
+        record_id = json.loads(first['body'])['data']['record_id']
+        self.assertEqual(record_id, json.loads(later['body'])['data']['record_id'])
+        self.assertEqual(["raw_data/processed/content/" + record_id + ".json"], backend.keys("raw_data/"))
+        self.assertEqual(1, len(backend.keys("parsed_data/")))
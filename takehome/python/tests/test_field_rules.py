@@ -0,0 +1,85 @@
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+import extract
+import process_json
+from extract import FieldMatcher, PathCache, RuleFile, find_fields, stream_fields
+
+
+class TestFieldRules(TestCase):
+
+    payload = {"ZipCode": "12345", "person": {"Given-Name": "Shirley", "surname": "Temple"},
+               "other": {"first_name": "Not Shirley"}}
+
+    def test_aliases_and_normalization(self):
+        """
+        Tests that keys are matched through their aliases, and without regard to case or separators when normalize
+        is on
+        """
+        rules = {"zip_code": ["postal_code"], "first_name": ["given_name"], "last_name": ["surname"]}
+        exact = FieldMatcher(rules)
+        normalized = FieldMatcher(rules, normalize=True)
+
+        self.assertEqual({"last_name": "Temple", "first_name": "Not Shirley"}, find_fields(exact, self.payload))
+        self.assertEqual({"zip_code": "12345", "first_name": "Shirley", "last_name": "Temple"},
+                         find_fields(normalized, self.payload))
+        self.assertEqual(find_fields(["zip_code", "last_name"], self.payload),
+                         find_fields(FieldMatcher.exact(["zip_code", "last_name"]), self.payload))
+
+    def test_alias_conflict(self):
+        """
+        Tests that a rule set giving the same alias to two fields is rejected, including when the aliases only
+        collide once normalized
+        """
+        with self.assertRaises(ValueError):
+            FieldMatcher({"first_name": ["name"], "last_name": ["name"]})
+        FieldMatcher({"first_name": ["Name"], "last_name": ["name"]})
+        with self.assertRaises(ValueError):
+            FieldMatcher({"first_name": ["Name"], "last_name": ["name"]}, normalize=True)
+
+    def test_streaming_and_path_cache(self):
+        """
+        Tests that the streaming extractor and the path cache find the same fields as find_fields with a rule set
+        """
+        matcher = FieldMatcher({"zip_code": [], "first_name": ["given_name"], "last_name": ["surname"]}, True)
+        expected = find_fields(matcher, self.payload)
+        body = json.dumps(self.payload).encode("utf-8")
+        cache = PathCache()
+
+        self.assertEqual(expected, stream_fields(matcher, [body[i:i + 7] for i in range(0, len(body), 7)]))
+        self.assertEqual(expected, cache.find_fields(matcher, self.payload))
+        self.assertEqual(expected, cache.find_fields(matcher, self.payload))
+        self.assertEqual(1, cache.stats()["hits"])
+
+    def test_rule_file_reload(self):
+        """
+        Tests that a rule set file is reloaded once it changes, that a broken file keeps the previous rules, and that
+        parse_data uses the latest rules
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "rules.json")
+        with open(path, "w") as f:
+            json.dump({"fields": {"zip_code": ["ZipCode"]}}, f)
+        rules = RuleFile(path, check_interval=0)
+
+        original = process_json.field_rules
+        process_json.field_rules = rules
+        self.addCleanup(setattr, process_json, "field_rules", original)
+        res_count, output = process_json.parse_data(self.payload)
+        self.assertEqual((1, "12345"), (res_count, output["zip_code"]))
+
+        with open(path, "w") as f:
+            json.dump({"normalize": True, "fields": {"zip_code": [], "last_name": ["surname"]}}, f)
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        res_count, output = process_json.parse_data(self.payload)
+        self.assertEqual((2, "12345", "Temple"), (res_count, output["zip_code"], output["last_name"]))
+
+        with open(path, "w") as f:
+            f.write("{not json")
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 2 * 10 ** 9))
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(rules.reload())
+        self.assertEqual(["zip_code", "last_name"], extract.field_list_names(rules.current()))
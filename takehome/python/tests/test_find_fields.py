@@ -0,0 +1,99 @@
+from unittest import TestCase
+import json
+import extract
+import process_json
+
+
+def run_find_fields_on_string(data:str):
+    """
+    Runs extract.find_fields on the supplied data string, searching for all of the fields in process_json.field_names
+
+    :param data: a JSON formatted string to be searched
+    :return: the results of running find_fields for process_json.field_names
+    """
+    data_dict = json.loads(data)
+    results = extract.find_fields(process_json.field_names, data_dict)
+    return results
+
+
+class TestFindFields(TestCase):
+
+    def test_find_fields_bad_input(self):
+        """
+        Tests the case where we pass find_fields something other than a dict
+        """
+        for bad_input in [None, "", ["Shirley", "Bob"], {}]:
+            self.assertEqual({}, extract.find_fields(process_json.field_names, bad_input))
+
+    def test_find_fields(self):
+        """
+        Tests the case where all fields are spread over different levels of the structure
+        """
+        input_data = """
+        {
+            "first_name": "Shirley",
+            "data":
+            {
+                "middle_name": ["Rivera", "Elise"],
+                "address": {"zip_code": 12345}
+            },
+            "last_name": "Anne"
+        }
+        """
+        parsed_res = run_find_fields_on_string(input_data)
+        self.assertEqual({"first_name": "Shirley", "middle_name": "Rivera", "zip_code": 12345, "last_name": "Anne"},
+                         parsed_res)
+
+    def test_find_fields_first_instance_wins(self):
+        """
+        Tests that each field resolves to its first instance, even when a later dict holds every field
+        """
+        input_data = """
+        {
+            "data1": {"first_name": "Shirley"},
+            "data2": {"first_name": "Morning", "last_name": "Lisa"}
+        }
+        """
+        parsed_res = run_find_fields_on_string(input_data)
+        self.assertEqual({"first_name": "Shirley", "last_name": "Lisa"}, parsed_res)
+
+    def test_find_fields_skips_nested_empty_value(self):
+        """
+        Tests that an empty nested value is passed over for a later instance, while the rest of that dict is skipped
+        for the same field, matching find_field
+        """
+        input_data = """
+        {
+            "data3": {"first_name": "", "child": {"first_name": "Hidden"}},
+            "data4": {"first_name": "Shirley"}
+        }
+        """
+        parsed_res = run_find_fields_on_string(input_data)
+        self.assertEqual("Shirley", parsed_res["first_name"])
+        self.assertEqual(process_json.find_field("first_name", json.loads(input_data)), parsed_res["first_name"])
+
+    def test_find_fields_top_level_empty_value(self):
+        """
+        Tests that an empty value at the top level is returned as the result rather than a nested instance
+        """
+        input_data = """
+        {
+            "first_name": "",
+            "data": {"first_name": "Shirley"}
+        }
+        """
+        parsed_res = run_find_fields_on_string(input_data)
+        self.assertEqual("", parsed_res["first_name"])
+
+    def test_find_fields_stops_when_all_found(self):
+        """
+        Tests that the walk stops once every field is found, by placing an object that fails on iteration after them
+        """
+        class Exploding(dict):
+            def items(self):
+                raise AssertionError("walked past the point where all fields were found")
+
+        data = {"first_name": "Shirley", "middle_name": "Rivera", "last_name": "Anne", "zip_code": 12345,
+                "data": Exploding(first_name="Morning")}
+        parsed_res = extract.find_fields(process_json.field_names, data)
+        self.assertEqual(4, len(parsed_res))
@@ -0,0 +1,78 @@
+from unittest import TestCase
+import json
+import process_json
+import storage
+from extract import FieldMatcher, find_records
+
+
+class TestFindRecords(TestCase):
+
+    fields = ['zip_code', 'first_name', 'middle_name', 'last_name']
+
+    def test_records_in_lists(self):
+        """
+        Tests that every person in a list is found as its own record, that nested dicts which aren't records fill in
+        their fields, and that members take the fields their household holds directly
+        """
+        data = {"household": {"zip_code": "12345", "members": [
+            {"first_name": "Lisa", "last_name": "Doe", "address": {"zip_code": "54321"}},
+            {"first_name": "Steve", "last_name": "Doe"},
+            {"first_name": "", "last_name": ""}]}}
+
+        self.assertEqual([{"first_name": "Lisa", "last_name": "Doe", "zip_code": "54321"},
+                          {"first_name": "Steve", "last_name": "Doe", "zip_code": "12345"}],
+                         find_records(self.fields, data))
+
+    def test_nested_records(self):
+        """
+        Tests that a record nested in another is kept separate, and takes the fields its parent is missing
+        """
+        data = {"data": {"first_name": "June", "middle_name": "Anne",
+                         "child": {"first_name": "Mike", "middle_name": "Steve"}, "last_name": "Brown"}}
+
+        self.assertEqual([{"first_name": "June", "middle_name": "Anne", "last_name": "Brown"},
+                          {"first_name": "Mike", "middle_name": "Steve", "last_name": "Brown"}],
+                         find_records(self.fields, data))
+        self.assertEqual([{"first_name": "June", "middle_name": "Anne", "last_name": "Brown"}],
+                         find_records(self.fields, data, min_fields=3))
+
+    def test_sparse_payload(self):
+        """
+        Tests that a payload without any dict holding enough fields is taken as one record, and that aliases are
+        matched through a rule set
+        """
+        self.assertEqual([{"first_name": "Shirley", "zip_code": 12345}],
+                         find_records(self.fields, {"person": {"first_name": ["Shirley"]}, "zip": {"zip_code": 12345}}))
+        self.assertEqual([], find_records(self.fields, {"data": [1, 2]}))
+        matcher = FieldMatcher({"first_name": ["given_name"], "last_name": ["surname"]}, normalize=True)
+        self.assertEqual([{"first_name": "A", "last_name": "B"}, {"first_name": "C", "last_name": "D"}],
+                         find_records(matcher, [{"GivenName": "A", "Surname": "B"}, {"given_name": "C", "surname": "D"}]))
+
+    def test_lambda_handler_records(self):
+        """
+        Tests that the Lambda writes a parsed row for each record, each with its own record ID and the ID of the one
+        raw object they came from, and that the rows are written together as one object with a line for each
+        """
+        backend = storage.MemoryBackend()
+        original = process_json.backend, process_json.extract_records
+        process_json.backend, process_json.extract_records = backend, True
+        self.addCleanup(setattr, process_json, "backend", original[0])
+        self.addCleanup(setattr, process_json, "extract_records", original[1])
+
+        event = {"people": [{"first_name": "Lisa", "last_name": "Doe"}, {"first_name": "Steve", "last_name": "Doe"}]}
+        res = process_json.lambda_handler(event, None)
+        body = json.loads(res['body'])
+
+        self.assertEqual(200, res['statusCode'])
+        self.assertEqual(["Lisa", "Steve"], [row['first_name'] for row in body['data']])
+        self.assertEqual(2, len({row['record_id'] for row in body['data']}))
+        parsed_keys = backend.keys("parsed_data/")
+        self.assertEqual(1, len(parsed_keys))
+        self.assertTrue(parsed_keys[0].endswith("/" + body['payload_id'] + ".json"))
+        lines = backend.objects[parsed_keys[0]].splitlines(keepends=True)
+        self.assertEqual([parsed_keys[0] + "#0", parsed_keys[0] + "#" + str(len(lines[0]))], body['paths'])
+        self.assertEqual(body['data'], [json.loads(line) for line in lines])
+        raw_keys = backend.keys("raw_data/processed/")
+        self.assertEqual(1, len(raw_keys))
+        self.assertTrue(raw_keys[0].endswith("/" + body['payload_id'] + ".json"))
+        self.assertEqual(400, process_json.lambda_handler({"people": []}, None)['statusCode'])
@@ -0,0 +1,42 @@
+from unittest import TestCase
+import json
+import process_json
+import storage
+
+
+class TestLambdaHandler(TestCase):
+
+    def setUp(self):
+        self.backend = storage.MemoryBackend()
+        self.original_backend = process_json.backend
+        process_json.backend = self.backend
+
+    def tearDown(self):
+        process_json.backend = self.original_backend
+
+    def test_lambda_handler_found(self):
+        """
+        Tests that a payload with fields is stored as parsed data and raw data under the same record ID
+        """
+        event = {"person": {"first_name": "Shirley", "last_name": "Anne"}, "zip_code": 12345}
+        res = process_json.lambda_handler(event, None)
+        body = json.loads(res['body'])
+        record_id = body['data']['record_id']
+
+        self.assertEqual(200, res['statusCode'])
+        self.assertEqual(body['path'], self.backend.keys("parsed_data/")[0])
+        self.assertEqual(body['data'], json.loads(self.backend.get(body['path'])))
+        raw_keys = self.backend.keys("raw_data/processed/")
+        self.assertEqual(1, len(raw_keys))
+        self.assertTrue(raw_keys[0].endswith("/" + record_id + ".json"))
+        self.assertEqual(event, json.loads(self.backend.get(raw_keys[0])))
+
+    def test_lambda_handler_not_found(self):
+        """
+        Tests that a payload without any fields is only stored as unprocessed raw data
+        """
+        res = process_json.lambda_handler({"data": 1}, None)
+
+        self.assertEqual(400, res['statusCode'])
+        self.assertEqual([], self.backend.keys("parsed_data/"))
+        self.assertEqual(1, len(self.backend.keys("raw_data/unprocessed/")))
@@ -0,0 +1,62 @@
+from unittest import TestCase
+import json
+import metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram_render(self):
+        """
+        Tests that a histogram renders cumulative buckets, a sum and a count for each set of labels
+        """
+        histogram = metrics.Histogram("stage_seconds", "Stage times", (0.1, 1.0), ("stage",))
+        for value in [0.05, 0.5, 0.5, 2.0]:
+            histogram.observe(value, "parse")
+
+        self.assertEqual(['stage_seconds_bucket{stage="parse",le="0.1"} 1',
+                          'stage_seconds_bucket{stage="parse",le="1"} 3',
+                          'stage_seconds_bucket{stage="parse",le="+Inf"} 4',
+                          'stage_seconds_sum{stage="parse"} 3.05',
+                          'stage_seconds_count{stage="parse"} 4'], histogram.render())
+
+    def test_service_metrics(self):
+        """
+        Tests that a finished request adds its stage times, payload size, fields found and status to the metrics
+        """
+        service = metrics.ServiceMetrics()
+        request = service.started()
+        with request.stage("parse_data"):
+            pass
+        request.payload_bytes = 100
+        request.fields_found = 4
+        request.status = 200
+        self.assertIn("ingest_requests_in_flight 1", service.render())
+
+        service.finished(request, "/")
+        service.record(request, "/")
+        text = service.render()
+        self.assertIn("ingest_requests_in_flight 0", text)
+        self.assertIn('ingest_stage_seconds_count{stage="parse_data"} 1', text)
+        self.assertIn('ingest_payload_bytes_bucket{le="256"} 1', text)
+        self.assertIn('ingest_fields_found_bucket{le="3"} 0', text)
+        self.assertIn('ingest_responses_total{route="/",status="200"} 1', text)
+
+    def test_emf_line(self):
+        """
+        Tests that the embedded metric format line declares every measurement it holds
+        """
+        request = metrics.RequestMetrics()
+        with request.stage("write_raw"):
+            pass
+        request.fields_found = 2
+        request.status = 400
+        record = json.loads(metrics.emf_line(request, "JsonIngest", {"function": "ingest"}))
+
+        declared = record["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual("JsonIngest", declared["Namespace"])
+        self.assertEqual([["function"]], declared["Dimensions"])
+        for metric in declared["Metrics"]:
+            self.assertIn(metric["Name"], record)
+        self.assertEqual(2, record["fields_found"])
+        self.assertEqual(400, record["status"])
+        self.assertEqual("ingest", record["function"])
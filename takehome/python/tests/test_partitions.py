@@ -0,0 +1,115 @@
+from unittest import TestCase
+import datetime
+import partitions
+import storage
+
+
+class TestPartitions(TestCase):
+
+    def setUp(self):
+        self.time = datetime.datetime(2020, 10, 1, 9, 30)
+
+    def test_partition_format_date(self):
+        """
+        Tests the original YYYY/MM/DD layout, with and without the hour level
+        """
+        self.assertEqual("2020/10/01", self.time.strftime(partitions.partition_format("date")))
+        self.assertEqual("2020/10/01/09", self.time.strftime(partitions.partition_format("date", True)))
+
+    def test_partition_format_hive(self):
+        """
+        Tests the Hive style layout, with and without the hour level
+        """
+        self.assertEqual("year=2020/month=10/day=01", self.time.strftime(partitions.partition_format("hive")))
+        self.assertEqual("year=2020/month=10/day=01/hour=09",
+                         self.time.strftime(partitions.partition_format("hive", True)))
+
+    def test_partition_format_unknown(self):
+        """
+        Tests that an unknown partition style is rejected
+        """
+        with self.assertRaises(ValueError):
+            partitions.partition_format("monthly")
+
+    def test_projection_table_ddl(self):
+        """
+        Tests that the table definition's location template matches the paths the writers produce
+        """
+        ddl = partitions.projection_table_ddl("db", "parsed_data", "s3://bucket/parsed_data/",
+                                              ["first_name", "record_id"], style="hive", hourly=True)
+
+        template = "s3://bucket/parsed_data/year=${year}/month=${month}/day=${day}/hour=${hour}"
+        self.assertIn("'storage.location.template'='" + template + "'", ddl)
+        self.assertIn("'projection.enabled'='true'", ddl)
+        self.assertIn("`hour` string", ddl)
+        self.assertIn("LOCATION 's3://bucket/parsed_data/'", ddl)
+        filled = template.replace("${year}", "2020").replace("${month}", "10").replace("${day}", "01")
+        filled = filled.replace("${hour}", "09")
+        self.assertEqual("s3://bucket/parsed_data/" + self.time.strftime(partitions.partition_format("hive", True)),
+                         filled)
+
+    def test_projection_table_ddl_parquet(self):
+        """
+        Tests that Parquet data is declared as Parquet rather than through the JSON SerDe
+        """
+        ddl = partitions.projection_table_ddl("db", "parsed_data", "s3://bucket/parsed_data", ["first_name"],
+                                              data_format="parquet")
+
+        self.assertIn("STORED AS PARQUET", ddl)
+        self.assertNotIn("JsonSerDe", ddl)
+
+    def test_time_ordered_id(self):
+        """
+        Tests that IDs sort in the order they were made, including within a millisecond, and that the time they were
+        made at can be read back from them
+        """
+        ids = [partitions.time_ordered_id() for _ in range(5000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(5000, len(set(ids)))
+
+        record_id = partitions.time_ordered_id(self.time.timestamp())
+        self.assertEqual(self.time, partitions.id_time(record_id))
+        self.assertEqual(self.time, partitions.id_time(record_id.replace("-", "")))
+        self.assertIsNone(partitions.id_time("4e0a9b6a-6c47-4c2c-9f3e-2f1d0c3b5a79"))
+
+    def test_shards(self):
+        """
+        Tests that an object's shard is picked by its name, and that the table definition gets a shard column that
+        matches the shard levels
+        """
+        shard = partitions.shard_directory("01a14a8e-47ac-7757-b8e4-fddf0eb4c4f1", 16, "hive")
+        self.assertRegex(shard, r"^/shard=\d\d$")
+        self.assertEqual(shard[7:], partitions.shard_directory("01a14a8e-47ac-7757-b8e4-fddf0eb4c4f1", 16)[1:])
+        self.assertEqual("", partitions.shard_directory("01a14a8e-47ac-7757-b8e4-fddf0eb4c4f1", 0))
+
+        ddl = partitions.projection_table_ddl("db", "parsed_data", "s3://bucket/parsed_data", ["first_name"],
+                                              style="hive", shards=16)
+        self.assertIn("'storage.location.template'='s3://bucket/parsed_data/year=${year}/month=${month}/day=${day}"
+                      "/shard=${shard}'", ddl)
+        self.assertIn("'projection.shard.range'='0,15'", ddl)
+        self.assertIn("'projection.shard.digits'='2'", ddl)
+
+    def test_list_range(self):
+        """
+        Tests that listing a time range reads only the partitions it overlaps, and gives their objects in the order
+        they were made across every shard
+        """
+        backend = storage.MemoryBackend()
+        path_format = partitions.partition_format("date", True)
+        written = []
+        for hours in range(4):
+            when = self.time + datetime.timedelta(hours=hours)
+            for minutes in range(3):
+                record_id = partitions.time_ordered_id((when + datetime.timedelta(minutes=minutes)).timestamp())
+                key = ("parsed_data/" + when.strftime(path_format) + partitions.shard_directory(record_id, 4) + "/" +
+                       record_id + ".json")
+                backend.put(key, b"{}")
+                written.append(key)
+
+        self.assertEqual(8, len(partitions.partition_prefixes("parsed_data", self.time + datetime.timedelta(hours=1),
+                                                              self.time + datetime.timedelta(hours=2, minutes=30),
+                                                              hourly=True, shards=4)))
+        self.assertEqual(written[3:9], partitions.list_range(backend, "parsed_data",
+                                                             self.time + datetime.timedelta(hours=1),
+                                                             self.time + datetime.timedelta(hours=2, minutes=30),
+                                                             hourly=True, shards=4))
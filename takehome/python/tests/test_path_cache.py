@@ -0,0 +1,121 @@
+from unittest import TestCase
+import extract
+import process_json
+
+
+class TestPathCache(TestCase):
+
+    def setUp(self):
+        self.cache = extract.PathCache(max_size=2, depth=3)
+        self.fields = process_json.field_names
+
+    def make_payload(self, first_name, zip_code=12345):
+        return {"id": 1, "person": {"first_name": first_name, "last_name": "Anne"}, "address": {"zip_code": zip_code}}
+
+    def test_path_cache_hit(self):
+        """
+        Tests that a second payload with the same shape is answered from the cache with its own values
+        """
+        self.cache.find_fields(self.fields, self.make_payload("Shirley"))
+        parsed_res = self.cache.find_fields(self.fields, self.make_payload("Morning", 54321))
+
+        self.assertEqual({"first_name": "Morning", "last_name": "Anne", "zip_code": 54321}, parsed_res)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_path_cache_winner_now_empty(self):
+        """
+        Tests that when the cached winning path now holds an empty value, the cache walks the payload again rather
+        than trusting the cached path
+        """
+        payload = {"person": {"first_name": "Shirley"}, "other": {"first_name": "Morning"}}
+        self.cache.find_fields(self.fields, payload)
+
+        payload["person"]["first_name"] = ""
+        parsed_res = self.cache.find_fields(self.fields, payload)
+
+        self.assertEqual(extract.find_fields(self.fields, payload), parsed_res)
+        self.assertEqual("Morning", parsed_res["first_name"])
+        self.assertEqual(1, self.cache.stale)
+
+    def test_path_cache_earlier_match_now_filled(self):
+        """
+        Tests that an instance which was passed over for being empty is used once it has a value
+        """
+        payload = {"person": {"first_name": ""}, "other": {"first_name": "Morning"}}
+        self.cache.find_fields(self.fields, payload)
+
+        payload["person"]["first_name"] = "Shirley"
+        parsed_res = self.cache.find_fields(self.fields, payload)
+
+        self.assertEqual("Shirley", parsed_res["first_name"])
+        self.assertEqual(1, self.cache.hits)
+
+    def test_path_cache_deep_shape(self):
+        """
+        Tests that a shape where the fields sit below the fingerprinted levels is never answered from the cache
+        """
+        payload = {"a": {"b": {"c": {"first_name": "Shirley"}}}}
+        self.cache.find_fields(self.fields, payload)
+
+        payload["a"]["b"]["c"] = {"first_name": "Morning"}
+        parsed_res = self.cache.find_fields(self.fields, payload)
+
+        self.assertEqual({"first_name": "Morning"}, parsed_res)
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(2, self.cache.misses)
+
+    def test_path_cache_eviction(self):
+        """
+        Tests that the least recently used shape is evicted once the cache is full
+        """
+        for i in range(3):
+            self.cache.find_fields(self.fields, {"key_%d" % i: {"first_name": "Shirley"}})
+
+        self.assertEqual(1, self.cache.evictions)
+        self.assertEqual(2, self.cache.stats()["size"])
+
+        self.cache.find_fields(self.fields, {"key_0": {"first_name": "Shirley"}})
+        self.assertEqual(0, self.cache.hits)
+
+    def test_path_cache_value_types(self):
+        """
+        Tests that payloads with the same keys are told apart by which of their values are nested dicts
+        """
+        self.cache.find_fields(self.fields, {"a": {"first_name": "Shirley"}, "b": 1})
+        parsed_res = self.cache.find_fields(self.fields, {"a": 1, "b": {"first_name": "Morning"}})
+
+        self.assertEqual({"first_name": "Morning"}, parsed_res)
+        self.assertEqual(0, self.cache.hits)
+
+    def test_path_cache_budget(self):
+        """
+        Tests that fingerprinting a payload counts towards the traversal budget, even for a shape that's cached
+        """
+        payload = {"key_%d" % i: i for i in range(10)}
+        self.cache.find_fields(self.fields, payload)
+
+        with self.assertRaises(extract.BudgetExceeded) as raised:
+            self.cache.find_fields(self.fields, payload, extract.TraversalBudget(max_nodes=5))
+        self.assertEqual("max_nodes", raised.exception.limit)
+
+    def test_path_cache_hash_collision(self):
+        """
+        Tests that two shapes whose fingerprints hash the same are still told apart, rather than the second payload
+        being answered with the first one's paths
+        """
+        class Colliding(tuple):
+            def __hash__(self):
+                return 1
+
+        fingerprint = extract.shape_fingerprint
+        extract.shape_fingerprint = lambda data, depth, budget=None: Colliding(fingerprint(data, depth, budget))
+        try:
+            self.cache.find_fields(self.fields, {"a": {"first_name": "Shirley"}})
+            parsed_res = self.cache.find_fields(self.fields, {"b": {"first_name": "Morning"}})
+        finally:
+            extract.shape_fingerprint = fingerprint
+
+        self.assertEqual({"first_name": "Morning"}, parsed_res)
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(2, self.cache.misses)
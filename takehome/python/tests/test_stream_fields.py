@@ -0,0 +1,138 @@
+from unittest import TestCase
+import json
+import extract
+import process_json
+
+
+def run_stream_fields_on_string(data:str, chunk_size:int = 1):
+    """
+    Runs extract.stream_fields on the supplied data string, feeding it in chunks of chunk_size bytes
+
+    :param data: a JSON formatted string to be searched
+    :param chunk_size: the number of bytes to feed the extractor at a time
+    :return: the results of running stream_fields for process_json.field_names
+    """
+    raw = data.encode("utf-8")
+    chunks = [raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size)]
+    return extract.stream_fields(process_json.field_names, chunks)
+
+
+class TestStreamFields(TestCase):
+
+    def assertMatchesFindFields(self, data:str):
+        expected = extract.find_fields(process_json.field_names, json.loads(data))
+        for chunk_size in [1, 3, len(data)]:
+            self.assertEqual(expected, run_stream_fields_on_string(data, chunk_size))
+
+    def test_stream_fields(self):
+        """
+        Tests a structure with fields at several levels, with lists, escapes and empty values along the way
+        """
+        self.assertMatchesFindFields("""
+        {
+            "adata": ["one", {"first_name": "Hidden"}, "th\\"ree"],
+            "data":
+            {
+                "first_name": "",
+                "middle_name": ["Rivera", "Elise"],
+                "data3": {"last_name": "Bob", "first_name": "Shirley"}
+            },
+            "data4": {"first_name": "Morning", "zip_code": 12345, "last_name": {"first_name": "Inner"}}
+        }
+        """)
+
+    def test_stream_fields_matched_dict(self):
+        """
+        Tests that a dict stored under a matching key is returned as the value, and still searched for other fields
+        """
+        self.assertMatchesFindFields('{"last_name": {"first_name": "Shirley", "zip_code": 12345}}')
+
+    def test_stream_fields_top_level_empty_value(self):
+        """
+        Tests that an empty value at the top level is returned rather than a nested instance
+        """
+        self.assertMatchesFindFields('{"first_name": "", "data": {"first_name": "Shirley"}}')
+
+    def test_stream_fields_stops_when_all_found(self):
+        """
+        Tests that the extractor stops reading once every field is found, so invalid trailing data is never seen
+        """
+        extractor = extract.StreamingExtractor(process_json.field_names)
+        done = extractor.feed(b'{"first_name": "Shirley", "middle_name": "Rivera", "last_name": "Anne", '
+                              b'"zip_code": 12345, ')
+        self.assertTrue(done)
+        self.assertEqual(4, len(extractor.close()))
+
+    def test_stream_fields_bounded_buffer(self):
+        """
+        Tests that skipped values are not held in memory while they stream past
+        """
+        extractor = extract.StreamingExtractor(process_json.field_names)
+        extractor.feed(b'{"blob": "')
+        for i in range(1000):
+            extractor.feed(b'x' * 1000)
+            self.assertLess(len(extractor._buf), 1000)
+        extractor.feed(b'", "list": [')
+        for i in range(1000):
+            extractor.feed(b'{"first_name": "Hidden"},')
+            self.assertLess(len(extractor._buf), 100)
+        extractor.feed(b'1], "first_name": "Shirley"}')
+
+        self.assertEqual({"first_name": "Shirley"}, extractor.close())
+
+    def test_stream_fields_not_an_object(self):
+        """
+        Tests that a document that isn't an object finds nothing, and reports what it was
+        """
+        extractor = extract.StreamingExtractor(process_json.field_names)
+        extractor.feed(b'["Shirley", "Bob"]')
+
+        self.assertEqual({}, extractor.close())
+        self.assertEqual("array", extractor.top_level)
+
+    def test_stream_fields_byte_order_mark(self):
+        """
+        Tests that a leading UTF-8 byte order mark is skipped, as json.loads skips it in bytes, however it's split
+        """
+        document = b'\xef\xbb\xbf{"first_name": "Shirley"}'
+        for chunk_size in [1, 2, 3, len(document)]:
+            extractor = extract.StreamingExtractor(process_json.field_names)
+            for i in range(0, len(document), chunk_size):
+                extractor.feed(document[i:i + chunk_size])
+            self.assertEqual({"first_name": "Shirley"}, extractor.close())
+            self.assertEqual("object", extractor.top_level)
+
+    def test_stream_fields_invalid_json(self):
+        """
+        Tests that truncated or malformed documents raise a ValueError
+        """
+        for bad_input in ['', '{"first_name": "Shirley"', '{"first_name" "Shirley"}', '{"first_name": Shirley}']:
+            with self.assertRaises(ValueError):
+                run_stream_fields_on_string(bad_input, 4)
+
+    def test_syntax_checker(self):
+        """
+        Tests that the syntax checker accepts and rejects the same documents as json.loads, whichever chunks they're
+        fed in, including in the parts of a document the extractor skips or never reaches
+        """
+        documents = [b'{"first_name": "Shirley", "other": [1, -2.5e3, true, null, NaN, "\\u00e9\\n", {}, []]}',
+                     b' [{"a": {"b": [[], -Infinity]}}] ', b'"Shirley"', b'{"first_name": "Shirley"} trailing',
+                     b'{"other": [1, 2,]}', b'{"other": {"a": tru}}', b'{"a" 1}', b'[1}', b'01', b'{"a": "\\x"}',
+                     b'{"a": "\x01"}', b'{"a": "\xff"}', b'{"a": 1', b'', b'\xef\xbb\xbf{"a": [1]}', b'\xef\xbb\xbf',
+                     b'\xef\xbb{"a": 1}', b' \xef\xbb\xbf{"a": 1}']
+        for document in documents:
+            try:
+                json.loads(document)
+                valid = True
+            except ValueError:
+                valid = False
+            for chunk_size in [1, 3, len(document) or 1]:
+                checker = extract.SyntaxChecker()
+                try:
+                    for i in range(0, len(document), chunk_size):
+                        checker.feed(document[i:i + chunk_size])
+                    checker.close()
+                    checked = True
+                except ValueError:
+                    checked = False
+                self.assertEqual(valid, checked, (document, chunk_size))
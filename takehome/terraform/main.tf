@@ -37,7 +37,8 @@ provider "aws" {
 # Create the archive for the lambda upload
 data "archive_file" "lambda_pkg" {
   type = "zip"
-  source_file = "${path.module}/../python/process_json.py"
+  source_dir = "${path.module}/../python"
+  excludes = ["tests", "__pycache__", "requirements.txt"]
   output_path = "${path.module}/lambda_payload.zip"
 }
 
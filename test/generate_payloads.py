@@ -0,0 +1,219 @@
+"""
+Generates synthetic JSON payloads for load tests and benchmarks. The payloads are seeded, so the same settings and seed
+always produce the same files, and each payload can be regenerated on its own from its index.
+
+The shape of each payload is set by:
+* depth: how many levels of nesting there are below the top level
+* fanout: how many keys each level has
+* list_density: the chance that a value is a list rather than a plain value, and that the next level down is reached
+  through a list. The parser doesn't search inside lists, so fields below such a link are only walked past
+* placement: where the name and zip code fields are put. "top" puts them at the top level, "deep" at the deepest
+  level, "random" at a random level each, "list" inside list items (so they're walked past but never found), "decoy"
+  at the deepest level with empty copies above them, and "missing" leaves them out
+* value_size: the length of the filler string values
+
+The presets include pathological shapes, such as "deep" (10,000 levels) and "wide" (1,000,000 keys), which are
+written without recursion. Payloads are written as a directory of .json files or as one .ndjson file, both of which
+remote_test_driver.py can send:
+> python generate_payloads.py --preset realistic --count 1000 --output data/generated/realistic.ndjson
+"""
+import argparse
+import json
+import os
+import random
+
+# settings for common workloads. Any setting can be overridden from the command line
+presets = {
+    "reference": dict(depth=1, fanout=4, list_density=0.0, placement="top", value_size=8),
+    "realistic": dict(depth=6, fanout=12, list_density=0.1, placement="random", value_size=24),
+    "list_heavy": dict(depth=8, fanout=8, list_density=0.9, placement="list", value_size=16),
+    "decoy": dict(depth=12, fanout=6, list_density=0.0, placement="decoy", value_size=16),
+    "large_values": dict(depth=4, fanout=16, list_density=0.1, placement="random", value_size=16384),
+    "deep": dict(depth=10000, fanout=2, list_density=0.0, placement="deep", value_size=8),
+    "wide": dict(depth=0, fanout=1000000, list_density=0.0, placement="random", value_size=8),
+}
+
+placements = ("top", "deep", "random", "list", "decoy", "missing")
+
+first_names = ["Shirley", "Morning", "Bob", "Elise", "Marcus", "Priya", "Tomas", "Yuki"]
+last_names = ["Anne", "Rivera", "Okafor", "Lindqvist", "Chen", "Haddad", "Novak", "Santos"]
+
+
+def person(rng: random.Random):
+    """
+    :return: dict: the fields the parser looks for, with random values
+    """
+    return {"first_name": rng.choice(first_names), "middle_name": rng.choice(first_names),
+            "last_name": rng.choice(last_names), "zip_code": rng.randint(501, 99950)}
+
+
+def filler(rng: random.Random, value_size: int):
+    """
+    :return: a random plain value: mostly strings of value_size characters, with some numbers, booleans and nulls
+    """
+    kind = rng.random()
+    if kind < 0.7:
+        return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=value_size))
+    if kind < 0.85:
+        return rng.randint(-1000000, 1000000)
+    if kind < 0.95:
+        return rng.random() < 0.5
+    return None
+
+
+def generate_payload(seed: int, index: int, depth: int, fanout: int, list_density: float, placement: str,
+                     value_size: int):
+    """
+    Builds one payload. The payload is a chain of depth + 1 objects, each holding fanout keys: one key leads on to the
+    next level, and the rest hold filler values or lists of them. The structure is built without recursion, so any
+    depth works, though it must be written with write_json rather than json.dumps past a few hundred levels.
+
+    :param seed: the seed for the whole set of payloads
+    :param index: the position of this payload in the set
+    :param depth: the number of levels below the top level
+    :param fanout: the number of keys at each level
+    :param list_density: the chance, from 0 to 1, that a value is a list
+    :param placement: where to put the fields, one of placements
+    :param value_size: the length of the filler strings
+    :return: dict: the payload
+    """
+    if placement not in placements:
+        raise ValueError("Unknown placement " + repr(placement) + ", expected one of " + ", ".join(placements))
+    rng = random.Random(seed * 1000003 + index)
+    levels = []
+    for level in range(depth + 1):
+        node = {"id": index} if level == 0 else {}
+        for i in range(fanout - (1 if level < depth else 0) - len(node)):
+            if rng.random() < list_density:
+                node["list_%d" % i] = [filler(rng, value_size) for j in range(rng.randint(0, 4))]
+            else:
+                node["value_%d" % i] = filler(rng, value_size)
+        levels.append(node)
+
+    # link each level to the next, sometimes as an item in a list
+    for level in range(depth):
+        if rng.random() < list_density:
+            levels[level]["items_%d" % level] = [filler(rng, value_size), levels[level + 1]]
+        else:
+            levels[level]["level_%d" % level] = levels[level + 1]
+
+    fields = person(rng)
+    if placement == "top":
+        levels[0].update(fields)
+    elif placement == "deep":
+        levels[-1].update(fields)
+    elif placement == "random":
+        for key, value in fields.items():
+            levels[rng.randint(0, depth)][key] = value
+    elif placement == "list":
+        for key, value in fields.items():
+            levels[rng.randint(0, depth)]["people_" + key] = [{key: value}]
+    elif placement == "decoy":
+        # empty copies of every field sit between the top and the real ones, which the parser has to look past. None
+        # go at the top level, where even an empty match is final
+        for level in range(1, depth):
+            levels[level].update(dict.fromkeys(fields, ""))
+        levels[-1].update(fields)
+    return levels[0]
+
+
+def write_json(value, out):
+    """
+    Writes a value as JSON text, without recursion, so that payloads of any depth can be written
+
+    :param value: the value to write
+    :param out: a text file object to write to
+    """
+    stack = [iter([value])]
+    closers = [""]
+    first = [True]
+    while stack:
+        try:
+            item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            first.pop()
+            out.write(closers.pop())
+            continue
+        if not first[-1]:
+            out.write(", ")
+        first[-1] = False
+        if isinstance(item, tuple):  # a key and value from a dict
+            out.write(json.dumps(item[0]) + ": ")
+            item = item[1]
+        if isinstance(item, dict):
+            out.write("{")
+            stack.append(iter(item.items()))
+            closers.append("}")
+            first.append(True)
+        elif isinstance(item, list):
+            out.write("[")
+            stack.append(iter(item))
+            closers.append("]")
+            first.append(True)
+        else:
+            out.write(json.dumps(item))
+
+
+def write_payloads(output: str, count: int, seed: int, **settings):
+    """
+    Writes count payloads, either as a directory of .json files or as one .ndjson file with a payload per line
+
+    :param output: a path ending in .ndjson to write one file, or a directory to write .json files to
+    :param count: the number of payloads to write
+    :param seed: the seed for the payloads
+    :param settings: the shape settings passed to generate_payload
+    """
+    if output.endswith(".ndjson"):
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as out:
+            for index in range(count):
+                write_json(generate_payload(seed, index, **settings), out)
+                out.write("\n")
+    else:
+        os.makedirs(output, exist_ok=True)
+        for index in range(count):
+            with open(os.path.join(output, "payload_%06d.json" % index), "w") as out:
+                write_json(generate_payload(seed, index, **settings), out)
+
+
+def read_payloads(path: str):
+    """
+    Reads back payloads written by write_payloads, without decoding them
+
+    :param path: a .ndjson file, a .json file, or a directory of them
+    :return: a generator of the raw text of each payload
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            yield from read_payloads(os.path.join(path, name))
+    elif path.endswith(".ndjson"):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield line.rstrip("\n")
+    elif path.endswith(".json"):
+        with open(path) as f:
+            yield f.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates seeded synthetic JSON payloads")
+    parser.add_argument("--preset", default="realistic", choices=sorted(presets), help="the starting shape settings")
+    parser.add_argument("--count", type=int, default=100, help="the number of payloads to generate")
+    parser.add_argument("--seed", type=int, default=0, help="the seed; the same seed gives the same payloads")
+    parser.add_argument("--output", required=True,
+                        help="a path ending in .ndjson for one file, or a directory for one .json file per payload")
+    parser.add_argument("--depth", type=int, help="the number of levels below the top level")
+    parser.add_argument("--fanout", type=int, help="the number of keys at each level")
+    parser.add_argument("--list-density", type=float, help="the chance, from 0 to 1, that a value is a list")
+    parser.add_argument("--placement", choices=placements, help="where to put the fields")
+    parser.add_argument("--value-size", type=int, help="the length of the filler strings")
+    args = parser.parse_args()
+
+    settings = dict(presets[args.preset])
+    for key in settings:
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    write_payloads(args.output, args.count, args.seed, **settings)
+    print("Wrote", args.count, args.preset, "payloads to", args.output, settings)